@@ -25,7 +25,7 @@ import sys
 sys.path.append(str(Path(__file__).parent.parent / "src"))
 from brickgpt.models import BrickGPT, BrickGPTConfig, LLM, create_instruction
 from brickgpt.data import BrickStructure, Brick, brick_library, max_brick_dimension
-from brickgpt.stability_analysis import stability_score, StabilityConfig
+from brickgpt.stability_analysis import StabilityConfig, StabilityCache
 
 
 @dataclass
@@ -61,6 +61,7 @@ class GRPOConfig:
     use_gurobi: bool = True
     stability_weight: float = 1.0
     connectivity_weight: float = 0.5
+    stability_cache_path: Optional[str] = None  # SQLite database of stability scores shared across runs; None keeps them in memory
     
     # Action space parameters
     max_offset_distance: int = 5  # Maximum offset from pivot brick
@@ -122,6 +123,7 @@ class GRPOTrainer:
             world_dimension=(config.world_dim,) * 3,
             print_log=False
         )
+        self.stability_cache = StabilityCache(config.stability_cache_path)
         
         # Initialize action space
         self._setup_action_space()
@@ -358,7 +360,7 @@ class GRPOTrainer:
         try:
             # Calculate stability score using Gurobi
             if self.config.use_gurobi and len(bricks) > 1:
-                stability_scores, _, _, _, _ = stability_score(
+                stability_scores = self.stability_cache.stability_scores(
                     bricks.to_json(), 
                     brick_library, 
                     self.stability_config
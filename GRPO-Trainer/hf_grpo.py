@@ -19,7 +19,7 @@ from peft import PeftModel
 sys.path.append(str(Path(__file__).parent.parent / "src"))
 from brickgpt.models import BrickGPT, BrickGPTConfig, create_instruction
 from brickgpt.data import BrickStructure, Brick, brick_library
-from brickgpt.stability_analysis import stability_score, StabilityConfig
+from brickgpt.stability_analysis import StabilityConfig, StabilityCache
 
 
 @dataclass
@@ -39,6 +39,7 @@ class BrickGRPOConfig:
     use_gurobi: bool = True
     stability_weight: float = 1.0
     connectivity_weight: float = 0.5
+    stability_cache_path: Optional[str] = None  # SQLite database of stability scores shared across runs; None keeps them in memory
     
     # Training parameters - will be passed to TRLGRPOConfig
     learning_rate: float = 1e-5
@@ -69,6 +70,9 @@ class BrickGRPOConfig:
 # Global counter for tracking reward function calls
 _reward_call_counter = 0
 
+# Stability score caches by database path, kept between reward function calls
+_stability_caches: Dict[Optional[str], StabilityCache] = {}
+
 def brick_reward_function(completions, **kwargs):
     """
     Reward function for GRPO that calculates stability and connectivity scores.
@@ -95,6 +99,9 @@ def brick_reward_function(completions, **kwargs):
         world_dimension=(config.world_dim,) * 3,
         print_log=False
     )
+    if config.stability_cache_path not in _stability_caches:
+        _stability_caches[config.stability_cache_path] = StabilityCache(config.stability_cache_path)
+    stability_cache = _stability_caches[config.stability_cache_path]
     
     def parse_bricks_from_text(text: str) -> BrickStructure:
         """Parse brick structure from generated text."""
@@ -122,7 +129,7 @@ def brick_reward_function(completions, **kwargs):
             # Calculate stability score using Gurobi
             if config.use_gurobi and len(bricks) > 1:
                 try:
-                    stability_scores, _, _, _, _ = stability_score(
+                    stability_scores = stability_cache.stability_scores(
                         bricks.to_json(), 
                         brick_library, 
                         stability_config
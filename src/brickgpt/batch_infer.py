@@ -0,0 +1,193 @@
+import dataclasses
+import functools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+import transformers
+from transformers import HfArgumentParser
+
+from brickgpt.models import BrickGPT, BrickGPTConfig
+
+
+@dataclass
+class BatchInferArguments:
+    input_path: str = field(
+        metadata={'help': 'Path to a JSONL file with one generation job per line. Each line is a JSON object with '
+                          'the field "caption", and optionally the fields "seed" (default=42) and "name", '
+                          'which is used to name the output files (default=the line number).'},
+    )
+    output_dir: str = field(
+        default='outputs',
+        metadata={'help': 'Path to the directory in which to save the outputs. For each job, the brick structure is '
+                          'saved as [name].txt, [name].ldr, and [name].json, and a line with the result is appended to '
+                          'manifest.jsonl. Jobs which are already in the manifest are skipped, so an interrupted run '
+                          'can be resumed by running the same command again.'},
+    )
+    num_workers: int = field(
+        default=1,
+        metadata={'help': 'The number of worker processes, each of which loads its own copy of the model. '
+                          'Unless num_threads is given, the CPU cores are divided evenly between the workers.'},
+    )
+    render: bool = field(
+        default=False,
+        metadata={'help': 'Whether to also render each brick structure to [name].png. '
+                          'Rendering runs in a separate pool of processes, concurrently with generation.'},
+    )
+    num_render_workers: int = field(
+        default=1,
+        metadata={'help': 'The number of rendering processes. Has no effect if render=False.'},
+    )
+
+
+_brickgpt: BrickGPT | None = None  # The model of this worker process
+
+
+def _init_worker(cfg: BrickGPTConfig) -> None:
+    global _brickgpt
+    _brickgpt = BrickGPT(cfg)
+
+
+def _generate(job: dict, output_dir: str) -> dict:
+    """
+    Generates the brick structure for a job in a worker process, saves the output files, and returns the result.
+    """
+    transformers.set_seed(job['seed'])
+    start_time = time.time()
+    output = _brickgpt(job['caption'])
+    end_time = time.time()
+
+    bricks = output['bricks']
+    base_name = os.path.join(output_dir, job['name'])
+    with open(base_name + '.txt', 'w') as f:
+        f.write(bricks.to_txt())
+    with open(base_name + '.ldr', 'w') as f:
+        f.write(bricks.to_ldr())
+    with open(base_name + '.json', 'w') as f:
+        json.dump(bricks.to_json(), f)
+
+    return {
+        **job,
+        'n_bricks': len(bricks),
+        'rejection_reasons': dict(output['rejection_reasons']),
+        'n_regenerations': output['n_regenerations'],
+        'stability_paths': dict(output['stability_paths']),
+        'time': end_time - start_time,
+    }
+
+
+def _render(ldr_filename: str, img_filename: str) -> None:
+    from brickgpt.render_bricks import render_bricks  # Imported here, as only the rendering processes need Blender
+    render_bricks(ldr_filename, img_filename)
+
+
+def read_jobs(input_path: str) -> list[dict]:
+    """
+    Returns the jobs in the input file. Raises a ValueError if the names of the jobs are not unique, or if a name is
+    not a plain file name, as the output files are named after it.
+    """
+    jobs = []
+    with open(input_path) as f:
+        for line_num, line in enumerate(f):
+            if not line.strip():
+                continue
+            job = json.loads(line)
+            jobs.append({
+                'name': str(job.get('name', f'{line_num:06d}')),
+                'caption': job['caption'],
+                'seed': int(job.get('seed', 42)),
+            })
+    names = [job['name'] for job in jobs]
+    for name in names:
+        if (not name or name in ('.', '..') or os.path.isabs(name) or
+                any(sep in name for sep in (os.sep, os.altsep, '/') if sep)):
+            raise ValueError(f'Invalid job name {name!r}: names must be file names, without a directory.')
+    if len(set(names)) != len(names):
+        raise ValueError('The names of the jobs must be unique.')
+    return jobs
+
+
+def read_manifest(manifest_path: str) -> dict[str, dict]:
+    """
+    Returns the result of each finished job in the manifest, by name.
+    A partially written last line, e.g. from a crash, is ignored.
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    results = {}
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            results[result['name']] = result
+    return results
+
+
+def repair_manifest(manifest_path: str) -> None:
+    """
+    Terminates a partially written last line of the manifest, e.g. from a crash,
+    so that it does not corrupt the next line appended to it.
+    """
+    if os.path.exists(manifest_path) and os.path.getsize(manifest_path) > 0:
+        with open(manifest_path, 'rb+') as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                f.write(b'\n')
+
+
+def main():
+    parser = HfArgumentParser((BatchInferArguments, BrickGPTConfig))
+    args, cfg = parser.parse_args_into_dataclasses()
+    if cfg.num_threads is None:
+        cfg = dataclasses.replace(cfg, num_threads=max(1, os.cpu_count() // args.num_workers))
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = os.path.join(args.output_dir, 'manifest.jsonl')
+    jobs = read_jobs(args.input_path)
+    finished = read_manifest(manifest_path)
+    pending_jobs = [job for job in jobs if job['name'] not in finished]
+    print(f'{len(jobs)} jobs, of which {len(finished)} are already finished.')
+
+    mp_context = multiprocessing.get_context('spawn')
+    render_pool = None
+    render_futures: list[Future] = []
+    if args.render:
+        render_pool = ProcessPoolExecutor(args.num_render_workers, mp_context=mp_context)
+
+    def submit_render(name: str) -> None:
+        base_name = os.path.join(args.output_dir, name)
+        if render_pool is not None and not os.path.exists(base_name + '.png'):
+            render_futures.append(render_pool.submit(_render, base_name + '.ldr', base_name + '.png'))
+
+    # Render finished jobs that were not rendered before an interruption
+    for name in finished:
+        submit_render(name)
+
+    repair_manifest(manifest_path)
+
+    start_time = time.time()
+    with (mp_context.Pool(args.num_workers, initializer=_init_worker, initargs=(cfg,)) as pool,
+          open(manifest_path, 'a') as manifest):
+        results = pool.imap_unordered(functools.partial(_generate, output_dir=args.output_dir), pending_jobs)
+        for n_done, result in enumerate(results, start=1):
+            manifest.write(json.dumps(result) + '\n')
+            manifest.flush()
+            submit_render(result['name'])
+            elapsed = time.time() - start_time
+            print(f'[{n_done}/{len(pending_jobs)}] {result["name"]}: {result["n_bricks"]} bricks '
+                  f'in {result["time"]:.2f}s ({n_done / elapsed:.2f} structures/s overall)')
+
+    if render_pool is not None:
+        for future in render_futures:
+            future.result()
+        render_pool.shutdown()
+    print(f'Finished in {time.time() - start_time:.2f}s. Results are in {args.output_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,2 @@
-from .brick_structure import Brick, BrickStructure
+from .brick_structure import Brick, BrickStructure, stability_tier_counts
 from .brick_library import brick_library, max_brick_dimension, dimensions_to_brick_id, brick_id_to_part_id
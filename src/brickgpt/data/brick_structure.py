@@ -1,14 +1,22 @@
 import re
+import threading
 import warnings
+from collections import Counter
 from dataclasses import dataclass
+from typing import Callable, Literal
 
 import numpy as np
 
-from brickgpt.stability_analysis import stability_score, StabilityConfig, connectivity_score
+from brickgpt.stability_analysis import (stability_score, StabilityConfig, connectivity_score, IncrementalStabilityModel,
+                                        prescreen_stability, StabilityCache)
 from .brick_library import (brick_library,
                            dimensions_to_brick_id, brick_id_to_dimensions,
                            brick_id_to_part_id, part_id_to_brick_id)
 
+# The number of stability checks decided by each tier of BrickStructure.check_stability
+stability_tier_counts: Counter[str] = Counter()
+_stability_tier_counts_lock = threading.Lock()
+
 
 @dataclass(frozen=True, order=True, kw_only=True)
 class Brick:
@@ -130,6 +138,7 @@ class BrickStructure:
         # Build structure from bricks
         self.bricks = []
         self.voxel_occupancy = np.zeros((world_dim, world_dim, world_dim), dtype=int)
+        self._placement_masks = {}  # Maps brick dimensions (h, w) to the positions where such a brick fits
         for brick in bricks:
             self.add_brick(brick)
 
@@ -157,10 +166,39 @@ class BrickStructure:
         self.bricks.append(brick)
         self.voxel_occupancy[brick.slice] += 1
 
+        # Update the cached placement masks in the brick's layer only
+        if not self.brick_in_bounds(brick):
+            self._placement_masks.clear()
+        for (h, w), placement_mask in self._placement_masks.items():
+            placement_mask[max(0, brick.x - h + 1):brick.x + brick.h,
+                           max(0, brick.y - w + 1):brick.y + brick.w, brick.z] = False
+
     def undo_add_brick(self) -> None:
         brick = self.bricks[-1]
         self.voxel_occupancy[brick.slice] -= 1
         self.bricks.pop()
+        self._placement_masks.clear()
+
+    def placement_mask(self, h: int, w: int) -> np.ndarray:
+        """
+        Returns a boolean array which is True at (x, y, z) if an hxw brick at position (x, y, z) would be
+        in bounds and would not collide with any existing brick.
+        The result is cached and updated incrementally as bricks are added, so it must not be modified.
+        """
+        if (h, w) not in self._placement_masks:
+            self._placement_masks[(h, w)] = self._compute_placement_mask(h, w)
+        return self._placement_masks[(h, w)]
+
+    def _compute_placement_mask(self, h: int, w: int) -> np.ndarray:
+        result = np.zeros_like(self.voxel_occupancy, dtype=bool)
+        if h > self.world_dim or w > self.world_dim:
+            return result
+
+        # Count the occupied voxels under each hxw footprint using a summed-area table over each layer
+        occupied = np.pad(self.voxel_occupancy > 0, ((1, 0), (1, 0), (0, 0))).cumsum(axis=0).cumsum(axis=1)
+        n_occupied = occupied[h:, w:] - occupied[:-h, w:] - occupied[h:, :-w] + occupied[:-h, :-w]
+        result[:self.world_dim - h + 1, :self.world_dim - w + 1] = n_occupied == 0
+        return result
 
     def has_out_of_bounds_bricks(self) -> bool:
         return any(not self.brick_in_bounds(brick) for brick in self.bricks)
@@ -187,19 +225,79 @@ class BrickStructure:
             return False  # Supported from above
         return True
 
-    def is_stable(self) -> bool:
-        if self.has_floating_bricks() or self.has_collisions():
-            return False
-        return self.stability_scores().max() < 1
-
-    def stability_scores(self) -> np.ndarray:
+    def is_stable(self, solver: Literal['gurobi', 'highs'] = 'gurobi') -> bool:
+        return self.check_stability(lambda bricks: bricks.stability_scores(solver))
+
+    def check_stability(
+            self,
+            stability_scores: Callable[['BrickStructure'], np.ndarray],
+            prescreen: bool = True,
+    ) -> bool:
+        """
+        Checks whether the structure is stable in tiers, from the cheapest to the most expensive, and counts the tier
+        which decided in stability_tier_counts: 'floating', 'collision', 'prescreen', or 'solver'.
+        :param stability_scores: Returns the stability scores of a structure. Only called if no cheaper tier decides.
+        :param prescreen: Whether to try prescreen_stability before stability_scores. It only agrees with
+                          physics-based stability scores.
+        """
+        if self.has_floating_bricks():
+            tier, stable = 'floating', False
+        elif self.has_collisions():
+            tier, stable = 'collision', False
+        elif prescreen and not self.has_out_of_bounds_bricks() and (result := prescreen_stability(
+                self.to_json(), brick_library, StabilityConfig(world_dimension=(self.world_dim,) * 3))) is not None:
+            tier, stable = 'prescreen', result
+        else:
+            tier, stable = 'solver', stability_scores(self).max() < 1
+        with _stability_tier_counts_lock:
+            stability_tier_counts[tier] += 1
+        return stable
+
+    def stability_scores(
+            self,
+            solver: Literal['gurobi', 'highs'] = 'gurobi',
+            model: IncrementalStabilityModel | None = None,
+            cache: StabilityCache | None = None,
+            time_limit: float | None = None,
+            return_path: bool = False,
+    ) -> np.ndarray | tuple[np.ndarray, str]:
+        """
+        :param solver: The solver to use for stability analysis. 'highs' uses SciPy's HiGHS solver,
+                       which needs no license.
+        :param model: If given, the structure is analysed by updating this model with the bricks that changed
+                      since it was last solved, instead of building a new model. Then, solver is ignored.
+        :param cache: If given, the scores are looked up in this cache before they are computed, and stored in it after
+                      if the solve succeeded.
+        :param time_limit: If given, the wall-clock seconds to compute the scores in, as in StabilityConfig.
+                           Ignored if model is given.
+        :param return_path: Whether to also return the path by which the scores were computed, as stability_score
+                            with return_path=True. Scores from the cache are always from an 'optimal' solve.
+        """
         if self.has_collisions():
             raise ValueError('Cannot compute stability scores - structure has colliding bricks.')
         if self.has_out_of_bounds_bricks():
             raise ValueError('Cannot compute stability scores - structure has out of bounds bricks.')
-        scores, _, _, _, _ = stability_score(self.to_json(), brick_library,
-                                             StabilityConfig(world_dimension=(self.world_dim,) * 3))
-        return scores
+        brick_structure = self.to_json()
+        if model is not None:
+            cfg = model.cfg
+        else:
+            cfg = StabilityConfig(world_dimension=(self.world_dim,) * 3, solver=solver, time_limit=time_limit)
+
+        def compute() -> tuple[np.ndarray, str]:
+            nonlocal path
+            if model is not None:
+                model.set_bricks(brick_structure)
+                scores, _, _, _, _, path = model.solve(return_path=True)
+            else:
+                scores, _, _, _, _, path = stability_score(brick_structure, brick_library, cfg, return_path=True)
+            return scores, path
+
+        path = 'optimal'
+        if cache is not None:
+            scores = cache.get_or_compute(brick_structure, cfg, compute)
+        else:
+            scores, _ = compute()
+        return (scores, path) if return_path else scores
 
     def is_connected(self) -> bool:
         if self.has_floating_bricks() or self.has_collisions():
@@ -53,6 +53,12 @@ def main():
         print('Total # brick rejections:', output['rejection_reasons'].total())
         print('Brick rejection reasons:', dict(output['rejection_reasons']))
         print('Total # regenerations:', output['n_regenerations'])
+        if output['stability_paths']:
+            print('Stability solves by path:', dict(output['stability_paths']))
+        if 'profile' in output:
+            print('Time per phase:')
+            for phase, stats in output['profile'].items():
+                print(f'  {phase}: {stats["time"]:.2f}s in {stats["count"]} calls')
         print(f'Saved results to {txt_filename}, {ldr_filename}, and {img_filename}')
         print('--------------------')
 
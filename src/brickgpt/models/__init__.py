@@ -1,3 +1,7 @@
 from .brickgpt import (BrickGPT, BrickGPTConfig,
-                      create_instruction, create_instruction_zero_shot, create_instruction_few_shot)
+                      create_instruction, create_instruction_zero_shot, create_instruction_few_shot,
+                      create_instruction_few_shot_examples_first)
+from .brick_codec import BrickCodec
+from .brick_decoder import BrickDecoder
+from .events import BrickPlacedEvent, BrickRejectedEvent, RollbackEvent, FinishedEvent, GenerationEvent
 from .llm import LLM
@@ -0,0 +1,349 @@
+import warnings
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Callable
+
+import torch
+from transformers.cache_utils import DynamicCache
+
+from brickgpt.data import BrickStructure
+from .brick_codec import BrickFields, GEOMETRY_STEPS
+
+if TYPE_CHECKING:
+    from .brickgpt import BrickGPT
+
+
+@dataclass(eq=False)
+class BatchRow:
+    """
+    The generation state of one brick structure in a batch.
+    """
+    caption: str
+    generator: torch.Generator
+    temperature: float
+    max_bricks: int
+    bricks: BrickStructure = field(default_factory=lambda: BrickStructure([]))
+    rejection_reasons: Counter = field(default_factory=Counter)
+    n_regenerations: int = 0
+    result: dict | None = None  # Set once the brick structure is finished
+
+    # Token state
+    token_ids: list[int] = field(default_factory=list)  # Token ids of the sequence that are in the KV cache
+    slots: list[int] = field(default_factory=list)  # Position of each of those tokens in the shared KV cache
+    pending_token_id: int | None = None  # The last sampled token id, which has not been fed to the model yet
+    brick_ends: list[int] = field(default_factory=list)  # Sequence length after the prompt and after each brick
+
+    # State of the brick currently being generated
+    step: int = 0
+    sample_idxs: list[int] = field(default_factory=list)
+    start_logits: torch.Tensor | None = None  # Logits for the first token of the brick
+    brick_temperature: float = 0.0
+    rejected_bricks: set[BrickFields] = field(default_factory=set)
+    n_brick_rejections: int = 0
+    n_new_bricks: int = 0  # The number of bricks generated since the last regeneration
+
+
+class BatchedBrickGenerator:
+    """
+    Generates multiple brick structures at once. Each row of the batch has its own caption, random generator,
+    grammar state, rejection sampling, and physics-informed rollback, but all rows share one KV cache
+    and are decoded together with one batched forward pass per token.
+    Rolled-back tokens are masked out of the attention instead of being removed from the KV cache,
+    and the KV cache is compacted once more than half of it has been masked out.
+    Rows leave the batch as soon as their brick structure is finished, and new rows can join between steps.
+    """
+
+    def __init__(self, brickgpt: 'BrickGPT'):
+        self.brickgpt = brickgpt
+        self.llm = brickgpt.llm
+        self.decoder = brickgpt.decoder
+        self.rows: list[BatchRow] = []
+        self.kv_cache = DynamicCache()
+        self.attention_mask = torch.zeros((0, 0), dtype=torch.long, device=self.llm.device)
+
+    def add(
+            self,
+            caption: str,
+            seed: int | None = None,
+            temperature: float | None = None,
+            max_bricks: int | None = None,
+            world_dim: int | None = None,
+    ) -> BatchRow:
+        """
+        Adds a new brick structure to the batch, to be generated based on the given caption.
+        The prompt is prefilled immediately, and the row joins the batch at the next step.
+        If adding the row fails, the batch is left as it was.
+        :param world_dim: The dimension of the box in which the brick structure should fit.
+                          Must be at most the world_dim of the BrickGPT model. If None, uses that world_dim.
+        :return: The new row, whose result is set once its brick structure is finished.
+        """
+        if world_dim is None:
+            world_dim = self.brickgpt.world_dim
+        if world_dim > self.brickgpt.world_dim:
+            raise ValueError(f'world_dim must be at most {self.brickgpt.world_dim}, got {world_dim}')
+        generator = torch.Generator(device=self.llm.device)
+        if seed is None:
+            generator.seed()
+        else:
+            generator.manual_seed(seed)
+        row = BatchRow(
+            caption=caption,
+            generator=generator,
+            temperature=self.brickgpt.temperature if temperature is None else temperature,
+            max_bricks=self.brickgpt.max_bricks if max_bricks is None else max_bricks,
+            bricks=BrickStructure([], world_dim=world_dim),
+        )
+
+        prompt_ids = self.brickgpt._build_prompt(caption).to(self.llm.device)
+        cache = self.llm.prefix_kv_cache(prompt_ids)
+        cache_length = cache.get_seq_length()
+        with torch.no_grad():
+            outputs = self.llm.model(
+                input_ids=prompt_ids[:, cache_length:],
+                past_key_values=cache,
+                cache_position=torch.arange(cache_length, prompt_ids.shape[1], device=self.llm.device),
+                use_cache=True,
+            )
+        row.token_ids = prompt_ids[0].tolist()
+        row.slots = self._merge(cache)
+        row.brick_ends = [len(row.token_ids)]
+        self.rows.append(row)
+
+        try:
+            self._start_brick(row)
+            row.start_logits = outputs.logits[0, -1]
+            self._sample(len(self.rows) - 1, row, row.start_logits)
+        except Exception:  # Leave no row behind that would go on generating for nobody
+            self._remove([row])
+            raise
+        if row.result is not None:
+            self._remove([row])
+        return row
+
+    @torch.no_grad()
+    def step(self) -> list[BatchRow]:
+        """
+        Generates the next token of every row in the batch.
+        :return: The rows whose brick structures were finished in this step, which have been removed from the batch.
+        """
+        if not self.rows:
+            return []
+
+        cache_length = self.attention_mask.shape[1]
+        input_ids = torch.tensor([[row.pending_token_id] for row in self.rows], device=self.llm.device)
+        position_ids = torch.tensor([[len(row.token_ids)] for row in self.rows], device=self.llm.device)
+        self.attention_mask = torch.cat([self.attention_mask, torch.ones_like(input_ids)], dim=1)
+        outputs = self.llm.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            position_ids=position_ids,
+            past_key_values=self.kv_cache,
+            cache_position=torch.tensor([cache_length], device=self.llm.device),
+            use_cache=True,
+        )
+
+        for idx, (row, logits) in enumerate(zip(self.rows, outputs.logits[:, -1])):
+            row.token_ids.append(row.pending_token_id)
+            row.slots.append(cache_length)
+            row.pending_token_id = None
+            if row.step == 0:
+                row.start_logits = logits
+            self._sample(idx, row, logits)
+
+        finished_rows = [row for row in self.rows if row.result is not None]
+        self._remove(finished_rows)
+        self._compact_if_needed()
+        return finished_rows
+
+    def remove(self, row: BatchRow) -> None:
+        """
+        Removes an unfinished row from the batch, e.g. because its result is no longer needed.
+        """
+        self._remove([row])
+        self._compact_if_needed()
+
+    def run(self, on_finished: Callable[[BatchRow], None] | None = None) -> None:
+        """
+        Steps until every row in the batch is finished.
+        :param on_finished: A function called with each finished row, which may add more rows to the batch.
+        """
+        while self.rows:
+            for row in self.step():
+                if on_finished is not None:
+                    on_finished(row)
+
+    def _sample(self, idx: int, row: BatchRow, logits: torch.Tensor) -> None:
+        """
+        Samples the next token of the row's brick from the given logits.
+        """
+        allowed_ids = self.decoder.grammar[row.step]
+        logits = logits[allowed_ids]
+        if self.brickgpt.use_geometry_masking and row.step in GEOMETRY_STEPS:
+            geometry_mask = self.decoder.geometry_mask(row.step, row.bricks, row.sample_idxs)
+            logits = logits.masked_fill(~torch.tensor(geometry_mask, device=self.llm.device), -torch.inf)
+        probs = torch.softmax(logits / row.brick_temperature, dim=-1)
+        sample_idx = torch.multinomial(probs, num_samples=1, generator=row.generator).item()
+        next_token_id = allowed_ids[sample_idx].item()
+
+        if next_token_id == self.llm.tokenizer.eos_token_id:  # Generation is finished
+            self._finish_structure(idx, row)
+            return
+
+        row.sample_idxs.append(sample_idx)
+        row.pending_token_id = next_token_id
+        row.step += 1
+        if row.step == len(self.decoder.grammar):
+            self._finish_brick(idx, row)
+
+    def _finish_brick(self, idx: int, row: BatchRow) -> None:
+        """
+        Checks the generated brick, and either adds it to the brick structure or rejects it and samples again.
+        """
+        brick_start = row.brick_ends[-1]
+        brick = self.decoder.codec.decode(row.token_ids[brick_start:] + [row.pending_token_id])
+        if self.brickgpt.max_brick_rejections == 0:
+            add_brick_result = 'success'
+        else:
+            add_brick_result = self.brickgpt._try_adding_brick(brick, row.bricks, row.rejected_bricks)
+
+        if add_brick_result == 'success' or row.n_brick_rejections == self.brickgpt.max_brick_rejections:
+            if add_brick_result != 'success':
+                warnings.warn(f'Failed to generate a valid brick after {row.n_brick_rejections + 1} attempts.\n'
+                              f'Last generated brick: {brick}\n'
+                              f'Brick structure: {row.bricks.to_txt()}\n')
+            row.bricks.add_brick(self.brickgpt._to_brick(brick))
+            row.brick_ends.append(len(row.token_ids) + 1)
+            row.n_new_bricks += 1
+            self._start_brick(row)
+            if row.n_new_bricks == row.max_bricks:
+                self._finish_structure(idx, row)
+            return
+
+        # Reset if brick is invalid
+        row.rejection_reasons.update([add_brick_result])
+        row.rejected_bricks.add(brick)
+        row.n_brick_rejections += 1
+        if add_brick_result == 'already_rejected':  # Increase temperature if brick has already been generated and rejected
+            row.brick_temperature = min(self.brickgpt.max_temperature,
+                                        row.brick_temperature + self.brickgpt.temperature_increase)
+        self._truncate(idx, row, brick_start)
+        row.pending_token_id = None
+        row.step = 0
+        row.sample_idxs = []
+        self._sample(idx, row, row.start_logits)
+
+    def _finish_structure(self, idx: int, row: BatchRow) -> None:
+        """
+        Checks the stability of the finished brick structure. If it is unstable, removes all bricks after the first
+        unstable brick and rolls the row back to continue generation from there.
+        """
+        if self.brickgpt.max_regenerations > 0 and not self.brickgpt._is_stable(row.bricks):
+            if row.n_regenerations < self.brickgpt.max_regenerations:
+                row.bricks = self.brickgpt._remove_all_bricks_after_first_unstable_brick(row.bricks)
+                row.n_regenerations += 1
+                self._rollback_to_brick(idx, row, len(row.bricks))
+                return
+            warnings.warn(f'Failed to generate a stable structure after {row.n_regenerations + 1} attempts.\n')
+
+        row.result = {
+            'bricks': row.bricks,
+            'rejection_reasons': row.rejection_reasons,
+            'n_regenerations': row.n_regenerations,
+        }
+
+    def _rollback_to_brick(self, idx: int, row: BatchRow, n_bricks: int) -> None:
+        """
+        Rolls the row back to just after its first n_bricks bricks.
+        The last token before that point is taken out of the KV cache, so that feeding it again yields
+        the logits for the next brick.
+        """
+        length = row.brick_ends[n_bricks]
+        sequence = row.token_ids + ([row.pending_token_id] if row.pending_token_id is not None else [])
+        row.pending_token_id = sequence[length - 1]
+        self._truncate(idx, row, length - 1)
+        del row.brick_ends[n_bricks + 1:]
+        row.n_new_bricks = 0
+        self._start_brick(row)
+
+    def _start_brick(self, row: BatchRow) -> None:
+        row.step = 0
+        row.sample_idxs = []
+        row.start_logits = None
+        row.brick_temperature = row.temperature
+        row.rejected_bricks = set()
+        row.n_brick_rejections = 0
+
+    def _truncate(self, idx: int, row: BatchRow, length: int) -> None:
+        """
+        Truncates the row's sequence to the given length, masking the removed tokens out of the attention.
+        """
+        self.attention_mask[idx, row.slots[length:]] = 0
+        del row.token_ids[length:]
+        del row.slots[length:]
+
+    def _merge(self, cache: DynamicCache) -> list[int]:
+        """
+        Merges the KV cache of a single new row into the shared KV cache, left-padding whichever is shorter.
+        :return: The positions of the new row's tokens in the shared KV cache.
+        """
+        new_length = cache.get_seq_length()
+        if not self.rows:
+            self.kv_cache = cache
+            self.attention_mask = torch.ones((1, new_length), dtype=torch.long, device=self.llm.device)
+            return list(range(new_length))
+
+        length = self.attention_mask.shape[1]
+        merged_length = max(length, new_length)
+        pad, new_pad = merged_length - length, merged_length - new_length
+        for layer_idx in range(len(self.kv_cache.key_cache)):
+            for tensors, new_tensors in [(self.kv_cache.key_cache, cache.key_cache),
+                                         (self.kv_cache.value_cache, cache.value_cache)]:
+                tensors[layer_idx] = torch.cat([torch.nn.functional.pad(tensors[layer_idx], (0, 0, pad, 0)),
+                                                torch.nn.functional.pad(new_tensors[layer_idx], (0, 0, new_pad, 0))])
+        self.attention_mask = torch.cat([
+            torch.nn.functional.pad(self.attention_mask, (pad, 0)),
+            torch.nn.functional.pad(torch.ones((1, new_length), dtype=torch.long, device=self.llm.device), (new_pad, 0)),
+        ])
+        for row in self.rows:
+            row.slots = [slot + pad for slot in row.slots]
+        return list(range(new_pad, merged_length))
+
+    def _remove(self, rows: list[BatchRow]) -> None:
+        """
+        Removes the given rows from the batch.
+        """
+        if not rows:
+            return
+        keep_idxs = [idx for idx, row in enumerate(self.rows) if row not in rows]
+        self.rows = [self.rows[idx] for idx in keep_idxs]
+        if not self.rows:
+            self.kv_cache = DynamicCache()
+            self.attention_mask = self.attention_mask[:0, :0]
+            return
+        self.kv_cache.batch_select_indices(torch.tensor(keep_idxs, device=self.llm.device))
+        self.attention_mask = self.attention_mask[keep_idxs]
+
+    def _compact_if_needed(self) -> None:
+        """
+        Removes the masked-out positions from the shared KV cache, once they make up more than half of it.
+        """
+        if not self.rows:
+            return
+        length = max(len(row.slots) for row in self.rows)
+        if self.attention_mask.shape[1] <= 2 * length:
+            return
+
+        gather_idxs = torch.zeros((len(self.rows), length), dtype=torch.long, device=self.llm.device)
+        self.attention_mask = torch.zeros_like(gather_idxs)
+        for idx, row in enumerate(self.rows):
+            start = length - len(row.slots)
+            gather_idxs[idx, start:] = torch.tensor(row.slots, dtype=torch.long)
+            self.attention_mask[idx, start:] = 1
+            row.slots = list(range(start, length))
+
+        for tensors in [self.kv_cache.key_cache, self.kv_cache.value_cache]:
+            for layer_idx, layer_tensor in enumerate(tensors):
+                n_heads, head_dim = layer_tensor.shape[1], layer_tensor.shape[3]
+                tensors[layer_idx] = layer_tensor.gather(
+                    2, gather_idxs[:, None, :, None].expand(-1, n_heads, -1, head_dim)
+                )
@@ -0,0 +1,85 @@
+from collections.abc import Sequence
+
+from transformers import PreTrainedTokenizerBase
+
+from brickgpt.data import max_brick_dimension, BrickStructure
+
+# Indices of the grammar steps at which each field of a brick is generated
+_H_STEP, _W_STEP, _X_STEP, _Y_STEP, _Z_STEP = 0, 2, 4, 6, 8
+GEOMETRY_STEPS = (_H_STEP, _W_STEP, _X_STEP, _Y_STEP, _Z_STEP)
+
+BrickFields = tuple[int, int, int, int, int]  # The (h, w, x, y, z) fields of a brick
+
+
+class BrickCodec:
+    """
+    Converts between token ids and bricks in the brick syntax "hxw (x,y,z)\\n", without going through text.
+    Each brick is represented by exactly one token per grammar step, and each step has a precomputed lookup table
+    from token ids to field values.
+    WARNING: Assumes each number in the brick dimensions and positions is represented by 1 token.
+    """
+
+    def __init__(self, tokenizer: PreTrainedTokenizerBase, world_dim: int):
+        self.tokenizer = tokenizer
+        self.eos_token_id = tokenizer.eos_token_id
+
+        dims = range(1, max_brick_dimension + 1)
+        posns = range(world_dim)
+        self._number_ids = {}  # Token id of each number that has been encoded or can be decoded
+        steps = [dims, 'x', dims, ' (', posns, ',', posns, ',', posns, ')\n']
+
+        # For each grammar step, the allowed token ids, and a lookup table from each allowed token id to its value
+        self.grammar: list[list[int]] = []
+        self._values: list[dict[int, int | None]] = []
+        for step in steps:
+            if isinstance(step, str):
+                values = {self._token_id(step): None}
+            else:
+                values = {self._number_id(value): value for value in step}
+            self.grammar.append(list(values))
+            self._values.append(values)
+        self.grammar[_H_STEP].append(self.eos_token_id)  # Generation can end instead of starting a new brick
+
+    def decode(self, token_ids: Sequence[int]) -> BrickFields | None:
+        """
+        Decodes the token ids of one brick into its (h, w, x, y, z) fields.
+        :param token_ids: The token ids of the brick, or a sequence starting with the EOS token.
+        :return: The fields of the brick, or None if the sequence starts with the EOS token.
+        :raises ValueError: If the token ids do not follow the brick syntax.
+        """
+        if token_ids and token_ids[0] == self.eos_token_id:
+            return None
+        if len(token_ids) != len(self._values):
+            raise ValueError(f'Expected {len(self._values)} token ids per brick, got {len(token_ids)}')
+        try:
+            values = [step_values[token_id] for step_values, token_id in zip(self._values, token_ids)]
+        except KeyError:
+            raise ValueError(f'Token ids do not follow the brick syntax: {list(token_ids)}') from None
+        return tuple(values[step] for step in GEOMETRY_STEPS)
+
+    def encode_brick(self, fields: BrickFields) -> list[int]:
+        """
+        Encodes the (h, w, x, y, z) fields of a brick into token ids.
+        """
+        h, w, x, y, z = fields
+        literal_ids = [step_ids[0] for step_ids in self.grammar[1::2]]
+        number_ids = [self._number_id(value) for value in (h, w, x, y, z)]
+        return [token_id for pair in zip(number_ids, literal_ids) for token_id in pair]
+
+    def encode(self, bricks: BrickStructure) -> list[int]:
+        """
+        Encodes a brick structure into token ids, as if each of its bricks had been generated in order.
+        """
+        return [token_id for brick in bricks.bricks
+                for token_id in self.encode_brick((brick.h, brick.w, brick.x, brick.y, brick.z))]
+
+    def _number_id(self, value: int) -> int:
+        if value not in self._number_ids:
+            self._number_ids[value] = self._token_id(str(value))
+        return self._number_ids[value]
+
+    def _token_id(self, s: str) -> int:
+        tokens = self.tokenizer.tokenize(s)
+        if len(tokens) != 1:
+            raise ValueError('Each allowed string must tokenize to exactly 1 token')
+        return self.tokenizer.convert_tokens_to_ids(tokens[0])
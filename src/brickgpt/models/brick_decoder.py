@@ -0,0 +1,241 @@
+from typing import NamedTuple
+
+import numpy as np
+import torch
+
+from brickgpt.data import max_brick_dimension, dimensions_to_brick_id, BrickStructure
+from .brick_codec import BrickCodec, BrickFields, GEOMETRY_STEPS, _H_STEP, _W_STEP, _X_STEP, _Y_STEP
+from .llm import LLM
+
+
+class BrickCandidate(NamedTuple):
+    brick: BrickFields | None  # The (h, w, x, y, z) fields of the brick, or None if the EOS token was generated
+    n_tokens: int  # The number of tokens generated for this brick, including the EOS token if present
+    log_likelihood: float  # The log-likelihood of the generated tokens under the constrained sampling distribution
+
+
+class BrickDecoder:
+    """
+    Generates bricks token by token by running the model's forward pass directly on the LLM's KV cache.
+    Each token is sampled from the tokens allowed at that point in the brick syntax "hxw (x,y,z)\\n".
+    WARNING: Assumes each number in the brick dimensions and positions is represented by 1 token.
+    """
+
+    def __init__(self, llm: LLM, world_dim: int):
+        self.llm = llm
+        self.world_dim = world_dim
+        self.codec = BrickCodec(llm.tokenizer, world_dim)
+
+        self.dims = range(1, max_brick_dimension + 1)
+        self.library_dims = {(h, w) for h in self.dims for w in self.dims if _in_library(h, w)}
+        self.grammar = [torch.tensor(allowed_ids, device=llm.device) for allowed_ids in self.codec.grammar]
+        self._allowed_idxs = [{token_id: idx for idx, token_id in enumerate(allowed_ids)}
+                              for allowed_ids in self.codec.grammar]
+
+    def generate_brick(
+            self,
+            prompt: str | torch.Tensor | None = None,
+            temperature: float = 1.0,
+            bricks: BrickStructure | None = None,
+            draft: BrickFields | None = None,
+    ) -> BrickFields | None:
+        """
+        Generates a brick as its (h, w, x, y, z) fields.
+        :param prompt: The prompt to be given to the LLM preceding brick generation.
+                       If None, continues generation from the previously generated tokens.
+        :param temperature: The temperature to use when sampling from the LLM.
+        :param bricks: If given, only bricks that are in the brick library, are in bounds,
+                       and do not collide with this brick structure can be generated.
+        :param draft: If given, a proposed brick to be verified with speculative decoding.
+        :return: The fields of the brick, or None if generation is finished.
+        """
+        return self.generate_brick_candidates(1, prompt, temperature, bricks, draft)[0].brick
+
+    def generate_brick_candidates(
+            self,
+            n: int,
+            prompt: str | torch.Tensor | None = None,
+            temperature: float = 1.0,
+            bricks: BrickStructure | None = None,
+            draft: BrickFields | None = None,
+    ) -> list[BrickCandidate]:
+        """
+        Forks the generated sequence into n rows and generates a candidate brick in each row,
+        decoding all rows together in one batched forward pass per token.
+        The LLM is left with n rows; use LLM.select_row to keep one of them.
+        :param n: The number of candidate bricks to generate.
+        :param prompt: The prompt to be given to the LLM preceding brick generation.
+                       If None, continues generation from the previously generated tokens.
+        :param temperature: The temperature to use when sampling from the LLM.
+        :param bricks: If given, only bricks that are in the brick library, are in bounds,
+                       and do not collide with this brick structure can be generated.
+        :param draft: If given and n=1, a proposed brick to be verified with speculative decoding.
+        :return: A list of n candidate bricks.
+        """
+        if prompt is not None:
+            self.llm.set_prompt(prompt)
+        if n == 1 and draft is not None:
+            return [self._generate_brick_speculatively(draft, temperature, bricks)]
+        self.llm.fork(n)
+
+        eos_token_id = self.llm.tokenizer.eos_token_id
+        result_ids = []
+        sample_idxs_by_step = []
+        log_likelihoods = torch.zeros(n, device=self.llm.device)
+        finished = torch.zeros(n, dtype=torch.bool, device=self.llm.device)
+        for step, allowed_ids in enumerate(self.grammar):
+            logits = self.llm.next_token_logits()
+            with self.llm.profiler.section('masking'):
+                logits = logits[:, allowed_ids]
+                if bricks is not None and step in GEOMETRY_STEPS:
+                    geometry_mask = self._geometry_mask(step, bricks, sample_idxs_by_step, finished)
+                    logits = logits.masked_fill(~geometry_mask, -torch.inf)
+            log_probs = torch.log_softmax(logits / temperature, dim=-1)
+            sample_idxs = torch.multinomial(log_probs.exp(), num_samples=1)
+            next_token_ids = allowed_ids[sample_idxs]
+            self.llm.append_tokens(next_token_ids)
+
+            result_ids.append(next_token_ids)
+            sample_idxs_by_step.append(sample_idxs.squeeze(1).tolist() if bricks is not None else None)
+            log_likelihoods += torch.where(finished, 0, log_probs.gather(1, sample_idxs).squeeze(1))
+            finished |= next_token_ids.squeeze(1) == eos_token_id
+            if finished.all():  # Generation is finished
+                break
+
+        result_ids = torch.cat(result_ids, dim=1).tolist()
+        candidates = []
+        for row_ids, log_likelihood in zip(result_ids, log_likelihoods.tolist()):
+            n_tokens = row_ids.index(eos_token_id) + 1 if eos_token_id in row_ids else len(row_ids)
+            candidates.append(BrickCandidate(self.codec.decode(row_ids[:n_tokens]), n_tokens, log_likelihood))
+        return candidates
+
+    def _generate_brick_speculatively(
+            self,
+            draft: BrickFields,
+            temperature: float,
+            bricks: BrickStructure | None,
+    ) -> BrickCandidate:
+        """
+        Generates a brick with speculative decoding. The tokens of the drafted brick are verified in one forward pass,
+        and each is accepted with its probability under the constrained sampling distribution.
+        At the first rejected token, a token is sampled from the distribution with the drafted token removed,
+        and the rest of the brick is decoded one token at a time. This samples bricks from the same distribution
+        as non-speculative decoding, with one forward pass for the whole brick if the draft is accepted.
+        """
+        draft_ids = self.codec.encode_brick(draft)
+        draft_idxs = [self._allowed_idxs[step].get(token_id) for step, token_id in enumerate(draft_ids)]
+        n_draft = draft_idxs.index(None) if None in draft_idxs else len(draft_idxs)  # Drop disallowed tokens
+
+        start_length = self.llm.sequence_length
+        self.llm.append_tokens(torch.tensor([draft_ids[:n_draft]], dtype=torch.long, device=self.llm.device))
+        draft_logits = self.llm.tail_logits(n_draft + 1)[0]  # Logits for each drafted token and the token after
+
+        eos_token_id = self.llm.tokenizer.eos_token_id
+        result_ids = []
+        sample_idxs = []
+        log_likelihood = 0.0
+        verifying = True
+        for step, allowed_ids in enumerate(self.grammar):
+            logits = draft_logits[step] if verifying else self.llm.next_token_logits()[0]
+            with self.llm.profiler.section('masking'):
+                logits = logits[allowed_ids]
+                if bricks is not None and step in GEOMETRY_STEPS:
+                    geometry_mask = torch.tensor(self.geometry_mask(step, bricks, sample_idxs), device=self.llm.device)
+                    logits = logits.masked_fill(~geometry_mask, -torch.inf)
+            log_probs = torch.log_softmax(logits / temperature, dim=-1)
+
+            if verifying and step < n_draft:
+                draft_idx = draft_idxs[step]
+                if torch.rand(()) < log_probs[draft_idx].exp():  # Drafted token is accepted
+                    result_ids.append(draft_ids[step])
+                    sample_idxs.append(draft_idx)
+                    log_likelihood += log_probs[draft_idx].item()
+                    continue
+
+                # Drafted token is rejected, so sample from the remaining tokens and stop verifying
+                verifying = False
+                self.llm.truncate(start_length + step)
+                sample_probs = log_probs.exp().index_fill(0, torch.tensor(draft_idx, device=self.llm.device), 0)
+            else:
+                verifying = False
+                sample_probs = log_probs.exp()
+
+            sample_idx = torch.multinomial(sample_probs, num_samples=1).item()
+            next_token_id = allowed_ids[sample_idx].item()
+            self.llm.append_tokens(torch.tensor([[next_token_id]], device=self.llm.device))
+            result_ids.append(next_token_id)
+            sample_idxs.append(sample_idx)
+            log_likelihood += log_probs[sample_idx].item()
+            if next_token_id == eos_token_id:  # Generation is finished
+                break
+
+        if verifying:  # The whole draft was accepted, so its last token must be taken back out of the KV cache
+            self.llm.truncate(self.llm.sequence_length)
+        return BrickCandidate(self.codec.decode(result_ids), len(result_ids), log_likelihood)
+
+    def geometry_mask(self, step: int, bricks: BrickStructure, sample_idxs: list[int]) -> np.ndarray:
+        """
+        Returns a boolean mask over the allowed tokens at the given grammar step, which is True for the tokens
+        that can still complete a brick which fits into the brick structure.
+        :param step: The index of the grammar step. Must be a step at which a dimension or position is generated.
+        :param bricks: The brick structure to which the brick will be added.
+        :param sample_idxs: For each previous step of the brick, the index of the allowed token that was sampled.
+        """
+        if step == _H_STEP:
+            allowed_hs = [any(self._fits(bricks, h, w) for w in self.dims) for h in self.dims]
+            return np.array(allowed_hs + [True])  # EOS token is always allowed
+
+        h = sample_idxs[_H_STEP] + 1
+        if step == _W_STEP:
+            return np.array([self._fits(bricks, h, w) for w in self.dims])
+
+        w = sample_idxs[_W_STEP] + 1
+        placement_mask = bricks.placement_mask(h, w)
+        if step == _X_STEP:
+            mask = placement_mask.any(axis=(1, 2))
+        elif step == _Y_STEP:
+            mask = placement_mask[sample_idxs[_X_STEP]].any(axis=1)
+        else:
+            mask = placement_mask[sample_idxs[_X_STEP], sample_idxs[_Y_STEP]]
+        return _resize(mask, self.world_dim)
+
+    def _geometry_mask(
+            self,
+            step: int,
+            bricks: BrickStructure,
+            sample_idxs_by_step: list[list[int]],
+            finished: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        Returns the geometry mask over the allowed tokens at the given step for each row.
+        """
+        row_masks = []
+        for row, is_finished in enumerate(finished.tolist()):
+            if is_finished:  # The rest of the brick is ignored, so all tokens are allowed
+                row_masks.append(np.ones(len(self.grammar[step]), dtype=bool))
+            else:
+                row_masks.append(self.geometry_mask(step, bricks, [idxs[row] for idxs in sample_idxs_by_step]))
+        return torch.tensor(np.stack(row_masks), device=self.llm.device)
+
+    def _fits(self, bricks: BrickStructure, h: int, w: int) -> bool:
+        """
+        Returns whether an hxw brick is in the brick library and fits somewhere in the brick structure.
+        """
+        return (h, w) in self.library_dims and bricks.placement_mask(h, w).any()
+
+
+def _in_library(h: int, w: int) -> bool:
+    try:
+        dimensions_to_brick_id(h, w)
+        return True
+    except ValueError:
+        return False
+
+
+def _resize(mask: np.ndarray, length: int) -> np.ndarray:
+    """
+    Truncates or pads a 1D boolean mask with False to the given length.
+    """
+    result = np.zeros(length, dtype=bool)
+    result[:min(length, len(mask))] = mask[:length]
+    return result
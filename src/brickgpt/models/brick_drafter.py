@@ -0,0 +1,31 @@
+from collections.abc import Collection
+
+from brickgpt.data import Brick, BrickStructure
+from .brick_codec import BrickFields
+
+
+def draft_brick(bricks: BrickStructure, exclude: Collection[BrickFields] = ()) -> BrickFields | None:
+    """
+    Proposes the next brick of a brick structure from the pattern of its last bricks, for speculative decoding.
+    The proposed brick has the same dimensions as the last brick. Its position is the first of the following
+    that is valid: the last brick moved by the offset between the last two bricks, or the last brick moved
+    by its own length along y or x, or placed on top of the last brick.
+    :param bricks: The brick structure to which the brick will be added.
+    :param exclude: Bricks that should not be proposed, e.g. because they have already been rejected.
+    :return: The (h, w, x, y, z) fields of the proposed brick, or None if there is no valid proposal.
+    """
+    if not bricks.bricks:
+        return None
+
+    last = bricks.bricks[-1]
+    offsets = [(0, last.w, 0), (last.h, 0, 0), (0, 0, 1)]
+    if len(bricks.bricks) > 1:
+        prev = bricks.bricks[-2]
+        offsets.insert(0, (last.x - prev.x, last.y - prev.y, last.z - prev.z))
+
+    for dx, dy, dz in offsets:
+        brick = Brick(h=last.h, w=last.w, x=last.x + dx, y=last.y + dy, z=last.z + dz)
+        fields = (brick.h, brick.w, brick.x, brick.y, brick.z)
+        if fields not in exclude and bricks.brick_in_bounds(brick) and not bricks.brick_collides(brick):
+            return fields
+    return None
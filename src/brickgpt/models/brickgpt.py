@@ -1,18 +1,31 @@
+import asyncio
 import copy
 import functools
 import json
+import threading
 import warnings
-from collections import Counter
+from collections import Counter, OrderedDict
+from collections.abc import AsyncIterator, Generator, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Callable, Literal
+from typing import Literal, TypeVar
 
 import numpy as np
 import torch
-from transformers.generation.logits_process import PrefixConstrainedLogitsProcessor, LogitsProcessorList
 
-from brickgpt.data import max_brick_dimension, BrickStructure, Brick
+from brickgpt.data import BrickStructure, Brick, brick_library
+from brickgpt.stability_analysis import IncrementalStabilityModel, StabilityCache, StabilityConfig
+from .batch_generation import BatchedBrickGenerator
+from .brick_codec import BrickFields
+from .brick_decoder import BrickDecoder
+from .brick_drafter import draft_brick
+from .events import BrickPlacedEvent, BrickRejectedEvent, RollbackEvent, FinishedEvent, GenerationEvent
 from .llm import LLM
+from .profiling import Profiler
+from .stability_monitor import StabilityMonitor
+
+_STABILITY_SCORES_CACHE_SIZE = 256  # The number of recently checked brick structures whose stability scores are kept
 
 
 @dataclass
@@ -38,6 +51,21 @@ class BrickGPTConfig:
         metadata={'help': 'The maximum number of rejections per generated brick during rejection sampling. '
                           'Set to 0 if you want to disable rejection sampling.'},
     )
+    rejection_batch_size: int = field(
+        default=1,
+        kw_only=True,
+        metadata={'help': 'The number of candidate bricks to decode in parallel during rejection sampling, '
+                          'once the first generated brick has been rejected. '
+                          'Set to 1 to sample candidates one at a time. '
+                          'Has no effect if use_logit_masking=False.'},
+    )
+    rejection_batch_selection: Literal['first', 'likelihood'] = field(
+        default='first',
+        kw_only=True,
+        metadata={'help': 'Which valid brick to keep from a batch of candidates during rejection sampling: '
+                          'the first valid brick, or the valid brick with the highest likelihood. '
+                          'Has no effect if rejection_batch_size=1.'},
+    )
     use_logit_masking: bool = field(
         default=True,
         kw_only=True,
@@ -45,6 +73,23 @@ class BrickGPTConfig:
                           'to enforce compliance with the brick syntax. '
                           'If False, the brick will be checked for validity after generation.'},
     )
+    use_geometry_masking: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to also use the partial brick structure during logit masking, '
+                          'so that only bricks which are in the brick library, are in bounds, '
+                          'and do not collide with existing bricks can be generated. '
+                          'Has no effect if use_logit_masking=False.'},
+    )
+    use_speculative_decoding: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to use speculative decoding, where a brick is drafted from the pattern of the '
+                          'previous bricks and all of its tokens are verified by the LLM in one forward pass. '
+                          'Bricks are sampled from the same distribution as without speculative decoding. '
+                          'Has no effect if use_logit_masking=False, or on candidate bricks that are decoded '
+                          'in parallel batches, or in generate_batch.'},
+    )
     max_regenerations: int = field(
         default=100,
         kw_only=True,
@@ -52,6 +97,28 @@ class BrickGPTConfig:
                           'if it is physically unstable. '
                           'Set to 0 if you want to disable physics-informed rollback.'},
     )
+    stability_check_interval: int = field(
+        default=0,
+        kw_only=True,
+        metadata={'help': 'If greater than 0, the partial brick structure is checked for stability every this many '
+                          'bricks during generation, and rolled back as soon as it is unstable, instead of only '
+                          'after the whole structure is generated. Each such rollback counts as a regeneration. '
+                          'Partial structures that only become stable once later bricks are added are also rolled '
+                          'back. Has no effect if max_regenerations=0, or in generate_batch.'},
+    )
+    stability_check_per_layer: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to check the partial brick structure for stability during generation whenever '
+                          'a layer of bricks is completed, as for stability_check_interval.'},
+    )
+    stability_check_in_background: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to run the stability checks during generation in a background thread, '
+                          'so that decoding continues while the structure is checked. If a check fails, '
+                          'the bricks generated in the meantime are discarded.'},
+    )
     use_gurobi: bool = field(
         default=True,
         kw_only=True,
@@ -59,6 +126,37 @@ class BrickGPTConfig:
                           'If False, will default to a simpler, but less accurate connectivity-based stability check. '
                           'This option is useful if you do not have a Gurobi licence.'},
     )
+    stability_solver: Literal['gurobi', 'highs'] = field(
+        default='gurobi',
+        kw_only=True,
+        metadata={'help': 'The solver to use for physics-based stability analysis. "highs" uses SciPy\'s HiGHS solver, '
+                          'which needs no licence, so it can run in any number of processes at once. '
+                          'Has no effect if use_gurobi=False.'},
+    )
+    stability_warm_start: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to keep one stability model between stability checks, and update it with only the '
+                          'bricks that were added or removed since the last check, re-solving it from the previous '
+                          'solution, instead of building a new model for every check. '
+                          'Has no effect unless use_gurobi=True and stability_solver="gurobi".'},
+    )
+    stability_time_limit: float | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'The maximum wall-clock seconds for each physics-based stability check. If a check runs out '
+                          'of time, the best solution found so far is used, or if there is none, the simpler '
+                          'connectivity-based stability check. If None, checks run until they are solved. '
+                          'Has no effect if use_gurobi=False.'},
+    )
+    stability_cache_path: str | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'The path of an SQLite database in which to keep the stability scores of every checked brick '
+                          'structure, so that they are reused across generations, runs, and processes. '
+                          'If None, stability scores are only reused within a generation. '
+                          'Has no effect if use_gurobi=False.'},
+    )
     temperature: float = field(
         default=0.6,
         kw_only=True,
@@ -87,20 +185,70 @@ class BrickGPTConfig:
         metadata={'help': 'The cumulative probability threshold for nucleus sampling. '
                           'Has no effect if use_logit_masking=True.'},
     )
-    instruction_format: Literal['brickgpt', 'few_shot', 'zero_shot'] = field(
+    instruction_format: Literal['brickgpt', 'few_shot', 'few_shot_examples_first', 'zero_shot'] = field(
         default='brickgpt',
         kw_only=True,
-        metadata={'help': 'The format of the brick-structure-generating instruction to give to the LLM.'},
+        metadata={'help': 'The format of the brick-structure-generating instruction to give to the LLM. '
+                          'few_shot_examples_first gives the same instructions and examples as few_shot, '
+                          'but with the caption after the examples, so that the examples are in the prompt prefix '
+                          'cached by use_prefix_cache.'},
+    )
+    use_prefix_cache: bool = field(
+        default=True,
+        kw_only=True,
+        metadata={'help': 'Whether to precompute the KV cache for the part of the prompt that is the same for every '
+                          'caption, so that only the caption-dependent rest of the prompt needs to be prefilled. '
+                          'With instruction_format=few_shot, the caption comes before the examples, so the examples '
+                          'are not cached; use few_shot_examples_first to cache them.'},
+    )
+    prefix_cache_dir: str | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'A directory in which to save the precomputed prompt prefix KV cache for this model, '
+                          'one file per instruction format and quantization, so that it is loaded instead of '
+                          'recomputed next time. A file saved for a different model is recomputed and overwritten, '
+                          'so use a separate directory for each model, e.g. the model checkpoint directory. '
+                          'If None, the prompt prefix KV cache is only kept in memory. '
+                          'Has no effect if use_prefix_cache=False.'},
     )
     device: Literal['auto', 'cuda', 'mps', 'cpu'] = field(
         default='auto',
         kw_only=True,
         metadata={'help': 'The device to use for inference. '
-                          'If "auto", will be set to "cuda" if available, otherwise "mps" if available, otherwise "cpu".'},
+                          'If "auto", will be set to "cuda" if available, otherwise "mps" if available, otherwise "cpu". '
+                          'If "auto" and quantization="int8", will be set to "cpu".'},
+    )
+    quantization: Literal['none', 'int8', 'bf16'] = field(
+        default='none',
+        kw_only=True,
+        metadata={'help': 'How to quantize the model weights to reduce memory footprint and bandwidth. '
+                          '"int8" quantizes all linear layers to int8 with dynamic quantization of activations, '
+                          'and is only supported on CPU. "bf16" loads the weights in bfloat16. '
+                          '"none" loads the weights at full precision.'},
+    )
+    profile: bool = field(
+        default=False,
+        kw_only=True,
+        metadata={'help': 'Whether to record the time and number of calls of each phase of generation, '
+                          'and return them in the "profile" entry of the result.'},
+    )
+    profile_trace_path: str | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'If given, a trace of every profiled call is saved to this file in Chrome trace format '
+                          'after each generated brick structure, overwriting the file. '
+                          'Has no effect if profile=False.'},
+    )
+    num_threads: int | None = field(
+        default=None,
+        kw_only=True,
+        metadata={'help': 'The number of threads to use for inference on CPU. If None, uses the PyTorch default.'},
     )
 
 
-def get_device() -> str:
+def get_device(quantization: Literal['none', 'int8', 'bf16'] = 'none') -> str:
+    if quantization == 'int8':
+        return 'cpu'  # Dynamic int8 quantization is only supported on CPU
     if torch.backends.mps.is_available() and torch.backends.mps.is_built():
         return 'mps'  # Apple Silicon
     else:
@@ -112,47 +260,173 @@ class BrickGPT:
         self.world_dim = cfg.world_dim
         self.max_bricks = cfg.max_bricks
         self.max_brick_rejections = cfg.max_brick_rejections
+        self.rejection_batch_size = cfg.rejection_batch_size
+        self.rejection_batch_selection = cfg.rejection_batch_selection
         self.use_logit_masking = cfg.use_logit_masking
+        self.use_geometry_masking = cfg.use_geometry_masking
+        self.use_speculative_decoding = cfg.use_speculative_decoding
         self.max_regenerations = cfg.max_regenerations
+        self.stability_check_interval = cfg.stability_check_interval
+        self.stability_check_per_layer = cfg.stability_check_per_layer
         self.use_gurobi = cfg.use_gurobi
+        self.stability_solver = cfg.stability_solver
+        self.stability_warm_start = cfg.stability_warm_start and cfg.stability_solver == 'gurobi'
+        self.stability_time_limit = cfg.stability_time_limit
         self.temperature = cfg.temperature
         self.temperature_increase = cfg.temperature_increase
         self.max_temperature = cfg.max_temperature
         self.top_k = cfg.top_k
         self.top_p = cfg.top_p
-        self.device = get_device() if cfg.device == 'auto' else cfg.device
+        self.device = get_device(cfg.quantization) if cfg.device == 'auto' else cfg.device
+        self.profile_trace_path = cfg.profile_trace_path
+        self.profiler = Profiler(enabled=cfg.profile, trace=cfg.profile_trace_path is not None)
+        if cfg.num_threads is not None:
+            torch.set_num_threads(cfg.num_threads)
 
         instruction_fns = {
             'brickgpt': create_instruction,
             'few_shot': create_instruction_few_shot,
+            'few_shot_examples_first': create_instruction_few_shot_examples_first,
             'zero_shot': create_instruction_zero_shot,
         }
         self.instruction_fn = instruction_fns[cfg.instruction_format]
 
-        self.llm = LLM(cfg.model_name_or_path, self.device)
+        # Stability scores of recently checked brick structures, keyed by their contents, in least-recently-used order
+        self.stability_scores_cache: OrderedDict[tuple, np.ndarray] = OrderedDict()
+        self._stability_scores_lock = threading.Lock()  # Stability checks may run in a background thread
+        # Number of stability solves of the current generation by the path they took, as in stability_score
+        self.stability_path_counts = Counter()
+        self.stability_cache = StabilityCache(cfg.stability_cache_path) if cfg.stability_cache_path else None
+        self.stability_executor = ThreadPoolExecutor(1) if cfg.stability_check_in_background else None
+        self._stability_model_lock = threading.Lock()
+
+        self.llm = LLM(cfg.model_name_or_path, self.device, cfg.quantization)
+        self.llm.profiler = self.profiler
+        if cfg.use_prefix_cache:
+            prefix_cache_path = None
+            if cfg.prefix_cache_dir is not None:
+                prefix_cache_path = (Path(cfg.prefix_cache_dir)
+                                     / f'prefix_cache_{cfg.instruction_format}_{cfg.quantization}.pt')
+            self.llm.cache_prefix(self._build_prompt_prefix(), prefix_cache_path)
 
     def __call__(self, caption: str) -> dict:
+        event = None
+        for event in self.stream(caption):
+            pass
+        return event.result
+
+    def stream(self, caption: str) -> Iterator[GenerationEvent]:
+        """
+        Generates a brick structure based on the given caption, yielding events as generation progresses:
+        a BrickPlacedEvent for each brick added to the structure, a BrickRejectedEvent for each brick rejected
+        during rejection sampling, a RollbackEvent each time the structure is unstable and is rolled back,
+        and finally a FinishedEvent with the same result as __call__.
+        Generation can be cancelled by closing the iterator, or by no longer iterating over it.
+        """
+        self.profiler.reset()
+        with self._stability_scores_lock:
+            self.stability_path_counts.clear()
         bricks = None
         starting_bricks = BrickStructure([])
         rejection_reasons = Counter()
         regeneration_num = None
 
         # Generate brick structure. If it is unstable, remove all bricks after the first unstable brick and regenerate.
-        for regeneration_num in range(self.max_regenerations + 1):
-            bricks, this_rejection_reasons = self._generate_structure(caption, starting_bricks=starting_bricks)
-            rejection_reasons.update(this_rejection_reasons)
-            if self.max_regenerations == 0 or self._is_stable(bricks):
-                break
-            if regeneration_num == self.max_regenerations:
-                warnings.warn(f'Failed to generate a stable structure after {regeneration_num + 1} attempts.\n')
-                break
-            starting_bricks = self._remove_all_bricks_after_first_unstable_brick(bricks)
-
-        return {
+        try:
+            for regeneration_num in range(self.max_regenerations + 1):
+                # Check stability during generation, except in the last attempt, which cannot be rolled back
+                check_stability = regeneration_num < self.max_regenerations
+                bricks, this_rejection_reasons, n_unstable_bricks = yield from self._stream_structure(
+                    caption, starting_bricks, check_stability
+                )
+                rejection_reasons.update(this_rejection_reasons)
+                if n_unstable_bricks is not None:  # Generation was stopped early because the structure was unstable
+                    bricks = BrickStructure(bricks.bricks[:n_unstable_bricks], world_dim=bricks.world_dim)
+                elif self.max_regenerations == 0 or self._is_stable(bricks):
+                    break
+                if regeneration_num == self.max_regenerations:
+                    warnings.warn(f'Failed to generate a stable structure after {regeneration_num + 1} attempts.\n')
+                    break
+                starting_bricks = self._remove_all_bricks_after_first_unstable_brick(bricks)
+                yield RollbackEvent(n_bricks=len(starting_bricks), regeneration_num=regeneration_num + 1)
+        finally:
+            self.close_stability_model()
+
+        result = {
             'bricks': bricks,
             'rejection_reasons': rejection_reasons,
             'n_regenerations': regeneration_num,
+            'stability_paths': self.stability_path_counts.copy(),
         }
+        if self.profiler.enabled:
+            result['profile'] = self.profiler.report()
+            if self.profile_trace_path is not None:
+                self.profiler.save_chrome_trace(self.profile_trace_path)
+        yield FinishedEvent(result)
+
+    async def astream(self, caption: str) -> AsyncIterator[GenerationEvent]:
+        """
+        Asynchronous version of stream, which runs generation in a worker thread so as not to block the event loop.
+        If the consumer is cancelled, generation stops as soon as the event in progress has been generated.
+        """
+        events = self.stream(caption)
+        pending = None
+        try:
+            while True:
+                # Shielded so that cancelling the consumer does not abandon the worker thread inside the generator
+                pending = asyncio.ensure_future(asyncio.to_thread(next, events, None))
+                event = await asyncio.shield(pending)
+                if event is None:
+                    break
+                yield event
+        finally:
+            if pending is None or pending.done():
+                events.close()
+            else:
+                # The generator can only be closed once the worker thread has left it, which stops generation there
+                pending.add_done_callback(lambda _: events.close())
+                await asyncio.wait([pending])
+
+    def generate_batch(
+            self,
+            captions: list[str],
+            seeds: list[int] | None = None,
+            batch_size: int | None = None,
+    ) -> list[dict]:
+        """
+        Generates a brick structure for each of the given captions, decoding many structures at once.
+        Each structure has its own rejection sampling and physics-informed rollback, as in __call__.
+        Rejection sampling decodes one candidate brick at a time, regardless of rejection_batch_size.
+        :param captions: The captions of the brick structures to be generated.
+        :param seeds: The random seed to use for each caption. If None, the seeds are chosen randomly.
+        :param batch_size: The maximum number of structures to decode at once. If None, all structures are
+                           decoded at once; otherwise, a new structure joins the batch whenever one is finished.
+        :return: A list containing the result for each caption, in the same format as __call__
+                 but without stability_paths.
+        """
+        if not self.use_logit_masking:
+            raise ValueError('Batched generation requires use_logit_masking=True.')
+        if seeds is None:
+            seeds = [None] * len(captions)
+        if len(seeds) != len(captions):
+            raise ValueError('The number of seeds must match the number of captions.')
+        if batch_size is None:
+            batch_size = max(len(captions), 1)
+
+        generator = BatchedBrickGenerator(self)
+        rows = []
+        pending = list(zip(captions, seeds))
+
+        def fill_batch(_=None) -> None:
+            while pending and len(generator.rows) < batch_size:
+                rows.append(generator.add(*pending.pop(0)))
+
+        fill_batch()
+        try:
+            generator.run(on_finished=fill_batch)
+        finally:
+            self.close_stability_model()
+        return [row.result for row in rows]
 
     def _generate_structure(
             self,
@@ -165,56 +439,121 @@ class BrickGPT:
         :param starting_bricks: A partial brick structure to which the generated bricks will be added.
         :return: A tuple containing the generated brick structure and a brick rejection reasons.
         """
-        starting_bricks = copy.deepcopy(starting_bricks)
+        bricks, rejection_reasons, _ = _run_to_completion(self._stream_structure(caption, starting_bricks))
+        return bricks, rejection_reasons
 
-        # Construct prompt
-        starting_bricks_txt = starting_bricks.to_txt()
-        messages = [
-            {'role': 'system', 'content': 'You are a helpful assistant.'},
-            {'role': 'user', 'content': self.instruction_fn(caption)},
-        ]
-        if starting_bricks_txt:  # Continue generation from a partial structure
-            messages.append({'role': 'assistant', 'content': starting_bricks_txt})
-            prompt = self.llm.tokenizer.apply_chat_template(messages, continue_final_message=True, return_tensors='pt')
-        else:
-            prompt = self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors='pt')
+    def _stream_structure(
+            self,
+            caption: str,
+            starting_bricks: BrickStructure = BrickStructure([]),
+            check_stability: bool = False,
+    ) -> Generator[GenerationEvent, None, tuple[BrickStructure, Counter, int | None]]:
+        """
+        Version of _generate_structure which yields an event for each placed and rejected brick.
+        :param check_stability: Whether to check the stability of the partial brick structure during generation,
+                                as configured by stability_check_interval and stability_check_per_layer,
+                                and stop generating as soon as it is unstable.
+        :return: A tuple containing the generated brick structure, the brick rejection reasons, and the number of
+                 bricks in the first part of the structure found to be unstable during generation, or None.
+        """
+        starting_bricks = copy.deepcopy(starting_bricks)
+        prompt = self._build_prompt(caption, starting_bricks)
+        monitor = None
+        if check_stability and (self.stability_check_interval > 0 or self.stability_check_per_layer):
+            monitor = StabilityMonitor(self._is_stable, self.stability_check_interval,
+                                       self.stability_check_per_layer, self.stability_executor)
 
         # Generate bricks with rejection sampling
         rejection_reasons = Counter()
         for brick_num in range(self.max_bricks):
-            brick, rejection_reasons_brick = self.generate_brick_with_rejection_sampling(
+            brick, rejection_reasons_brick = yield from self._stream_brick_with_rejection_sampling(
                 prompt if brick_num == 0 else None, bricks=starting_bricks
             )
             if not brick:  # EOS token was generated
                 break
             rejection_reasons.update(rejection_reasons_brick)
-            starting_bricks.add_brick(Brick.from_txt(brick))
+            starting_bricks.add_brick(self._to_brick(brick))
+            yield BrickPlacedEvent(starting_bricks.bricks[-1], len(starting_bricks) - 1)
+            if monitor is not None and (n_unstable_bricks := monitor.update(starting_bricks)) is not None:
+                return starting_bricks, rejection_reasons, n_unstable_bricks
+
+        n_unstable_bricks = monitor.finish() if monitor is not None else None
+        return starting_bricks, rejection_reasons, n_unstable_bricks
+
+    def _build_prompt(self, caption: str, starting_bricks: BrickStructure = BrickStructure([])) -> torch.Tensor:
+        """
+        Builds the prompt token ids for generating a brick structure based on the given caption,
+        continuing from a partial brick structure.
+        With logit masking, the partial brick structure is encoded directly into the token ids that would have been
+        generated for it, which also lets the KV cache be reused for bricks that were kept after a rollback.
+        """
+        messages = [
+            {'role': 'system', 'content': 'You are a helpful assistant.'},
+            {'role': 'user', 'content': self.instruction_fn(caption)},
+        ]
+        if self.use_logit_masking:
+            prompt_ids = self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True,
+                                                                return_tensors='pt')
+            bricks_ids = torch.tensor([self.decoder.codec.encode(starting_bricks)], dtype=prompt_ids.dtype)
+            return torch.cat([prompt_ids, bricks_ids], dim=1)
+
+        starting_bricks_txt = starting_bricks.to_txt()
+        if starting_bricks_txt:  # Continue generation from a partial structure
+            messages.append({'role': 'assistant', 'content': starting_bricks_txt})
+            return self.llm.tokenizer.apply_chat_template(messages, continue_final_message=True, return_tensors='pt')
+        else:
+            return self.llm.tokenizer.apply_chat_template(messages, add_generation_prompt=True, return_tensors='pt')
 
-        return starting_bricks, rejection_reasons
+    def _build_prompt_prefix(self) -> torch.Tensor:
+        """
+        Builds the token ids of the longest prompt prefix that does not depend on the caption.
+        """
+        prompt_ids = [self._build_prompt(caption)[0] for caption in ['A', 'The']]
+        length = min(len(ids) for ids in prompt_ids)
+        mismatches = (prompt_ids[0][:length] != prompt_ids[1][:length]).nonzero()
+        prefix_length = mismatches[0].item() if len(mismatches) else length
+        return prompt_ids[0][None, :prefix_length]
 
     def generate_brick_with_rejection_sampling(
             self,
             prompt: str | None = None,
             bricks: BrickStructure = BrickStructure([]),
-    ) -> (str, Counter):
+    ) -> (BrickFields | str | None, Counter):
         """
         Generates a brick to add to the brick structure, using rejection sampling to ensure the brick is valid.
+        The brick is returned as its (h, w, x, y, z) fields if use_logit_masking=True, and in txt format otherwise.
+        A falsy brick means that the EOS token was generated.
         """
+        return _run_to_completion(self._stream_brick_with_rejection_sampling(prompt, bricks))
+
+    def _stream_brick_with_rejection_sampling(
+            self,
+            prompt: str | None = None,
+            bricks: BrickStructure = BrickStructure([]),
+    ) -> Generator[BrickRejectedEvent, None, tuple[BrickFields | str | None, Counter]]:
+        """
+        Version of generate_brick_with_rejection_sampling which yields an event for each rejected brick.
+        """
+        if self.use_logit_masking and self.rejection_batch_size > 1 and self.max_brick_rejections > 0:
+            return (yield from self._stream_brick_with_batched_rejection_sampling(prompt, bricks))
+
         rejection_reasons = Counter()
         rejected_bricks = set()
 
-        brick = ''
+        brick = None
         temperature = self.temperature
         for generation_num in range(self.max_brick_rejections + 1):
-            self.llm.save_state()
-            brick = self.generate_brick(prompt, temperature=temperature)
+            self.llm.save_state('brick')
+            brick = self._sample_brick(prompt, temperature=temperature, bricks=bricks,
+                                       draft=self._draft_brick(bricks, rejected_bricks))
             if not brick:  # EOS token was generated
                 break
             if self.max_brick_rejections == 0:
                 break
 
             # Check if the generated brick is valid
-            add_brick_result = self._try_adding_brick(brick, bricks, rejected_bricks)
+            with self.profiler.section('validation'):
+                add_brick_result = self._try_adding_brick(brick, bricks, rejected_bricks)
             if add_brick_result == 'success':
                 break
             if generation_num == self.max_brick_rejections:
@@ -225,26 +564,98 @@ class BrickGPT:
                 break
 
             # Reset if brick is invalid
-            self.llm.rollback_to_saved_state()
+            self.llm.rollback_to_saved_state('brick')
             rejection_reasons.update([add_brick_result])
             rejected_bricks.add(brick)
+            yield BrickRejectedEvent(brick, add_brick_result)
 
             if add_brick_result == 'already_rejected':  # Increase temperature if brick has already been generated and rejected
                 temperature = min(self.max_temperature, temperature + self.temperature_increase)
 
         return brick, rejection_reasons
 
+    def _stream_brick_with_batched_rejection_sampling(
+            self,
+            prompt: str | None = None,
+            bricks: BrickStructure = BrickStructure([]),
+    ) -> Generator[BrickRejectedEvent, None, tuple[BrickFields | None, Counter]]:
+        """
+        Generates a brick to add to the brick structure, using rejection sampling to ensure the brick is valid.
+        After the first rejection, candidate bricks are decoded in parallel batches of size rejection_batch_size.
+        An EOS token ends generation if it comes before the first valid brick in the batch.
+        """
+        rejection_reasons = Counter()
+        rejected_bricks = set()
+
+        if prompt is not None:
+            self.llm.set_prompt(prompt)
+        self.llm.save_state('brick')
+        start_length = self.llm.sequence_length
+
+        temperature = self.temperature
+        n_generated = 0
+        while True:
+            n_candidates = 1 if n_generated == 0 else min(self.rejection_batch_size,
+                                                          self.max_brick_rejections + 1 - n_generated)
+            candidates = self.decoder.generate_brick_candidates(
+                n_candidates, temperature=temperature, bricks=bricks if self.use_geometry_masking else None,
+                draft=self._draft_brick(bricks, rejected_bricks),
+            )
+            n_generated += n_candidates
+
+            # Check which of the generated bricks are valid
+            chosen_idx = None
+            for idx, candidate in enumerate(candidates):
+                if candidate.brick is None:  # EOS token was generated
+                    if chosen_idx is None:
+                        chosen_idx = idx
+                        break
+                    continue
+                with self.profiler.section('validation'):
+                    add_brick_result = self._try_adding_brick(candidate.brick, bricks, rejected_bricks)
+                if add_brick_result == 'success':
+                    if chosen_idx is None or candidate.log_likelihood > candidates[chosen_idx].log_likelihood:
+                        chosen_idx = idx
+                    if self.rejection_batch_selection == 'first':
+                        break
+                    continue
+
+                rejection_reasons.update([add_brick_result])
+                rejected_bricks.add(candidate.brick)
+                yield BrickRejectedEvent(candidate.brick, add_brick_result)
+                if add_brick_result == 'already_rejected':  # Increase temperature if brick has already been generated and rejected
+                    temperature = min(self.max_temperature, temperature + self.temperature_increase)
+
+            if chosen_idx is None and n_generated == self.max_brick_rejections + 1:
+                chosen_idx = len(candidates) - 1
+                warnings.warn(f'Failed to generate a valid brick after {n_generated} attempts.\n'
+                              f'Last generated brick: {candidates[chosen_idx].brick}\n'
+                              f'Reasons for rejection: {rejection_reasons}\n'
+                              f'Brick structure: {bricks.to_txt()}\n')
+            if chosen_idx is not None:
+                self.llm.select_row(chosen_idx)
+                self.llm.truncate(start_length + candidates[chosen_idx].n_tokens)
+                return candidates[chosen_idx].brick, rejection_reasons
+
+            # Reset if all bricks are invalid
+            self.llm.select_row(0)
+            self.llm.rollback_to_saved_state('brick')
+
     @staticmethod
-    def _try_adding_brick(brick_str: str, bricks: BrickStructure, rejected_bricks: set[str]) -> str:
+    def _try_adding_brick(
+            brick: BrickFields | str,
+            bricks: BrickStructure,
+            rejected_bricks: set[BrickFields | str],
+    ) -> str:
         """
-        Tries to add the brick, represented by a string, to the given brick structure.
+        Tries to add the brick, represented by its (h, w, x, y, z) fields or by a string, to the given brick structure.
         Returns the result: 'success' if the add was successful, and the failure reason otherwise.
         """
-        if brick_str in rejected_bricks:
+        if brick in rejected_bricks:
             return 'already_rejected'
 
         try:
-            brick = Brick.from_txt(brick_str)
+            brick = BrickGPT._to_brick(brick)
         except ValueError:  # Brick is badly formatted
             return 'ill_formatted'
         try:
@@ -258,14 +669,53 @@ class BrickGPT:
             return 'collision'
         return 'success'
 
-    def generate_brick(self, prompt: str | None = None, temperature: float | None = None) -> str:
+    @staticmethod
+    def _to_brick(brick: BrickFields | str) -> Brick:
+        if isinstance(brick, str):
+            return Brick.from_txt(brick)
+        h, w, x, y, z = brick
+        return Brick(h=h, w=w, x=x, y=y, z=z)
+
+    def generate_brick(
+            self,
+            prompt: str | None = None,
+            temperature: float | None = None,
+            bricks: BrickStructure | None = None,
+    ) -> str:
         if temperature is None:
             temperature = self.temperature
         if self.use_logit_masking:
-            return self._generate_brick_with_logit_masking(prompt, temperature)
+            return self._generate_brick_with_logit_masking(prompt, temperature, bricks)
         else:
             return self._generate_brick_no_logit_masking(prompt, temperature)
 
+    def _sample_brick(
+            self,
+            prompt: str | None = None,
+            temperature: float | None = None,
+            bricks: BrickStructure | None = None,
+            draft: BrickFields | None = None,
+    ) -> BrickFields | str | None:
+        """
+        Generates a brick as its (h, w, x, y, z) fields if use_logit_masking=True, and in txt format otherwise.
+        Returns a falsy value if generation is finished.
+        """
+        if temperature is None:
+            temperature = self.temperature
+        if not self.use_logit_masking:
+            return self._generate_brick_no_logit_masking(prompt, temperature)
+        if not self.use_geometry_masking:
+            bricks = None
+        return self.decoder.generate_brick(prompt, temperature=temperature, bricks=bricks, draft=draft)
+
+    def _draft_brick(self, bricks: BrickStructure, rejected_bricks: set[BrickFields | str]) -> BrickFields | None:
+        """
+        Returns a drafted brick for speculative decoding, or None if speculative decoding is disabled.
+        """
+        if not (self.use_logit_masking and self.use_speculative_decoding):
+            return None
+        return draft_brick(bricks, exclude=rejected_bricks)
+
     def _generate_brick_no_logit_masking(
             self,
             prompt: str | None = None,
@@ -293,103 +743,131 @@ class BrickGPT:
             self,
             prompt: str | None = None,
             temperature: float | None = None,
+            bricks: BrickStructure | None = None,
     ) -> str:
         """
         Generates a brick in txt format, using logit masking to enforce compliance with the brick syntax.
+        If use_geometry_masking=True, also masks out bricks that do not fit into the given brick structure.
         WARNING: Assumes each number in the brick dimensions and positions is represented by 1 token.
         :param prompt: The prompt to be given to the LLM preceding brick generation.
+        :param bricks: The brick structure to which the generated brick will be added.
         :return: A brick in txt format, or the empty string if generation is finished.
         """
         if temperature is None:
             temperature = self.temperature
+        if not self.use_geometry_masking:
+            bricks = None
+        brick = self.decoder.generate_brick(prompt, temperature=temperature, bricks=bricks)
+        return '' if brick is None else self._to_brick(brick).to_txt()
 
-        allowed_dims = tuple(str(i) for i in range(1, max_brick_dimension + 1))
-        allowed_posns = tuple(str(i) for i in range(self.world_dim))
-
-        # Generate tokens one by one to fit the format "hxw (x,y,z)\n"
-        result_ids = []
-        for allowed_strs in [
-            allowed_dims + (self.llm.tokenizer.eos_token,), ('x',), allowed_dims,
-            (' (',), allowed_posns, (',',), allowed_posns, (',',), allowed_posns, (')\n',),
-        ]:
-            next_token_id = self.llm(
-                prompt,
-                return_as_ids=True,
-                max_new_tokens=1,
-                temperature=temperature,
-                top_k=None,
-                top_p=None,
-                logits_processor=self._build_allow_tokens_logits_processor(allowed_strs)
-            )[0]
-            result_ids.append(next_token_id)
-
-            if next_token_id == self.llm.tokenizer.eos_token_id:  # Generation is finished
-                break
-            if prompt is not None:
-                prompt = None  # Only use prompt on first iteration; continue generation thereafter
-
-        return self.llm.tokenizer.decode(result_ids, skip_special_tokens=True)
-
-    @functools.cache
-    def _build_allow_tokens_logits_processor(self, allowed_strs: tuple[str]) -> LogitsProcessorList:
+    @functools.cached_property
+    def decoder(self) -> BrickDecoder:
         """
-        Builds a logits processor that constrains the next token to be one of the allowed strings.
+        The decoder used to generate bricks with logit masking.
         """
-        return LogitsProcessorList(
-            [PrefixConstrainedLogitsProcessor(self._build_allowed_token_ids_fn(allowed_strs), num_beams=1)]
-        )
+        return BrickDecoder(self.llm, self.world_dim)
 
-    @functools.cache
-    def _build_allowed_token_ids_fn(self, allowed_strs: tuple[str]) -> Callable[[int, torch.Tensor], list[int]]:
+    @functools.cached_property
+    def stability_model(self) -> IncrementalStabilityModel:
         """
-        Builds a function that returns a set of allowed token IDs, to be used by PrefixConstrainedLogitsProcessor.
+        The stability model which is kept between stability checks if stability_warm_start=True.
         """
-        allowed_tokens = [self.llm.tokenizer.tokenize(s) for s in allowed_strs]
-        if not all(len(tokens) == 1 for tokens in allowed_tokens):
-            raise ValueError('Each allowed string must tokenize to exactly 1 token')
-        allowed_ids = self.llm.tokenizer.convert_tokens_to_ids(tokens[0] for tokens in allowed_tokens)
-
-        def allowed_token_ids_fn(_: int, __: torch.Tensor) -> list[int]:
-            return allowed_ids
+        return IncrementalStabilityModel(brick_library, StabilityConfig(world_dimension=(self.world_dim,) * 3,
+                                                                        time_limit=self.stability_time_limit))
 
-        return allowed_token_ids_fn
+    def close_stability_model(self) -> None:
+        """
+        Frees the stability model kept if stability_warm_start=True, returning its Gurobi environment to the pool.
+        The model only speeds up the stability checks of one generation, and is rebuilt by the next stability check.
+        """
+        with self._stability_model_lock:  # Waits for any stability check which is running in the background
+            stability_model = self.__dict__.pop('stability_model', None)
+        if stability_model is not None:
+            stability_model.close()
 
     def _is_stable(self, bricks: BrickStructure) -> bool:
-        return bricks.is_stable() if self.use_gurobi else bricks.is_connected()
+        return bricks.check_stability(self._stability_scores, prescreen=self.use_gurobi)
 
     def _stability_scores(self, bricks: BrickStructure) -> np.ndarray:
-        return bricks.stability_scores() if self.use_gurobi else bricks.connectivity_scores()
+        """
+        Returns the stability scores of the brick structure, reusing the scores if the same bricks were checked recently,
+        so that each brick structure is solved at most once per generation.
+        """
+        key = (bricks.world_dim, tuple(bricks.bricks))
+        with self._stability_scores_lock:
+            scores = self.stability_scores_cache.get(key)
+            if scores is not None:
+                self.stability_scores_cache.move_to_end(key)
+                return scores
+
+        path = None
+        with self.profiler.section('stability'):
+            if self.use_gurobi and self.stability_warm_start:
+                with self._stability_model_lock:
+                    scores, path = bricks.stability_scores(model=self.stability_model, cache=self.stability_cache,
+                                                           return_path=True)
+            elif self.use_gurobi:
+                scores, path = bricks.stability_scores(self.stability_solver, cache=self.stability_cache,
+                                                       time_limit=self.stability_time_limit, return_path=True)
+            else:
+                scores = bricks.connectivity_scores()
+        with self._stability_scores_lock:
+            if path is not None:
+                self.stability_path_counts[path] += 1
+            self.stability_scores_cache[key] = scores
+            if len(self.stability_scores_cache) > _STABILITY_SCORES_CACHE_SIZE:
+                self.stability_scores_cache.popitem(last=False)
+        return scores
 
     def _remove_all_bricks_after_first_unstable_brick(self, bricks: BrickStructure) -> BrickStructure:
         """
         Removes all bricks starting from the first unstable brick. Repeats this process until the strucure is stable.
         """
-        while True:
-            if self._is_stable(bricks):
-                return bricks
-            scores = self._stability_scores(bricks)
-            first_unstable_brick_idx = next((i for i, brick in enumerate(bricks.bricks)
-                                             if np.any(scores[brick.slice] >= 1)), -1)
-            bricks = BrickStructure(bricks.bricks[:first_unstable_brick_idx])
+        with self.profiler.section('rollback_truncation'):
+            while True:
+                if self._is_stable(bricks):
+                    return bricks
+                scores = self._stability_scores(bricks)
+                first_unstable_brick_idx = next((i for i, brick in enumerate(bricks.bricks)
+                                                 if np.any(scores[brick.slice] >= 1)), -1)
+                bricks = BrickStructure(bricks.bricks[:first_unstable_brick_idx], world_dim=bricks.world_dim)
+
+
+_instruction_header = ('Create a LEGO model of the input. Format your response as a list of bricks: '
+                       '<brick dimensions> <brick position>, where the brick position is (x,y,z).\n'
+                       'Allowed brick dimensions are 2x4, 4x2, 2x6, 6x2, 1x2, 2x1, 1x4, 4x1, 1x6, 6x1, 1x8, 8x1, 1x1, 2x2.\n'
+                       'All bricks are 1 unit tall.')
+
+_zero_shot_instructions = (
+    'Each line of your output should be a LEGO brick in the format `<brick dimensions> <brick position>`. For example:\n'
+    '2x4 (2,1,0)\n'
+    'DO NOT output any other text. Only output LEGO bricks. The first brick should have a z-coordinate of 0.'
+)
+
+
+_T = TypeVar('_T')
+
+
+def _run_to_completion(generator: Generator[object, None, _T]) -> _T:
+    """
+    Runs a generator to completion, discarding the values it yields, and returns its return value.
+    """
+    while True:
+        try:
+            next(generator)
+        except StopIteration as e:
+            return e.value
 
 
 def create_instruction(caption: str) -> str:
-    instruction = ('Create a LEGO model of the input. Format your response as a list of bricks: '
-                   '<brick dimensions> <brick position>, where the brick position is (x,y,z).\n'
-                   'Allowed brick dimensions are 2x4, 4x2, 2x6, 6x2, 1x2, 2x1, 1x4, 4x1, 1x6, 6x1, 1x8, 8x1, 1x1, 2x2.\n'
-                   'All bricks are 1 unit tall.\n\n'
+    instruction = (f'{_instruction_header}\n\n'
                    '### Input:\n'
                    f'{caption}')
     return instruction
 
 
 def create_instruction_zero_shot(caption: str) -> str:
-    zero_shot_instructions = (
-        'Each line of your output should be a LEGO brick in the format `<brick dimensions> <brick position>`. For example:\n'
-        '2x4 (2,1,0)\n'
-        'DO NOT output any other text. Only output LEGO bricks. The first brick should have a z-coordinate of 0.'
-    )
-    return '\n\n'.join([create_instruction(caption), zero_shot_instructions])
+    return '\n\n'.join([create_instruction(caption), _zero_shot_instructions])
 
 
 _few_shot_examples_filename = Path(__file__).parent / 'few_shot_examples.json'
@@ -398,16 +876,29 @@ with open(_few_shot_examples_filename) as f:
 
 
 def create_instruction_few_shot(caption: str) -> str:
+    return '\n\n'.join([create_instruction_zero_shot(caption), _few_shot_examples_prompt(), _few_shot_input(caption)])
+
+
+def create_instruction_few_shot_examples_first(caption: str) -> str:
+    """
+    Version of create_instruction_few_shot in which the caption only comes after the examples,
+    so that everything before it is the same for every caption.
+    """
+    return '\n\n'.join([_instruction_header, _zero_shot_instructions, _few_shot_examples_prompt(),
+                        _few_shot_input(caption)])
+
+
+def _few_shot_examples_prompt() -> str:
     example_prompt = 'Here are some example LEGO models:'
     example_instructions = '\n\n'.join(_create_example_instruction(x) for x in _few_shot_examples)
-    few_shot_instructions = (
-        'Do NOT copy the examples, but create your own LEGO model for the following input.\n\n'
-        '### Input:\n'
-        f'{caption}\n\n'
-        '### Output:\n'
-    )
-    return '\n\n'.join([create_instruction_zero_shot(caption), example_prompt,
-                        example_instructions, few_shot_instructions])
+    return '\n\n'.join([example_prompt, example_instructions])
+
+
+def _few_shot_input(caption: str) -> str:
+    return ('Do NOT copy the examples, but create your own LEGO model for the following input.\n\n'
+            '### Input:\n'
+            f'{caption}\n\n'
+            '### Output:\n')
 
 
 def _create_example_instruction(x: dict) -> str:
@@ -0,0 +1,43 @@
+from dataclasses import dataclass
+
+from brickgpt.data import Brick
+from .brick_codec import BrickFields
+
+
+@dataclass(frozen=True)
+class BrickPlacedEvent:
+    """
+    A brick was added to the brick structure.
+    """
+    brick: Brick
+    brick_idx: int  # The index of the brick in the brick structure
+
+
+@dataclass(frozen=True)
+class BrickRejectedEvent:
+    """
+    A generated brick was rejected during rejection sampling.
+    """
+    brick: BrickFields | str  # The (h, w, x, y, z) fields of the brick, or the brick in txt format
+    reason: str  # The reason for rejection, e.g. 'collision'
+
+
+@dataclass(frozen=True)
+class RollbackEvent:
+    """
+    The brick structure was unstable, so all bricks from index n_bricks onwards were removed,
+    and generation continues from the remaining bricks.
+    """
+    n_bricks: int
+    regeneration_num: int  # The number of the regeneration that starts after this rollback, starting from 1
+
+
+@dataclass(frozen=True)
+class FinishedEvent:
+    """
+    Generation is finished. The result is in the same format as returned by BrickGPT.__call__.
+    """
+    result: dict
+
+
+GenerationEvent = BrickPlacedEvent | BrickRejectedEvent | RollbackEvent | FinishedEvent
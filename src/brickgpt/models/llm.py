@@ -1,24 +1,48 @@
-import copy
+from pathlib import Path
+from typing import Literal
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 from transformers.cache_utils import DynamicCache
 
+from .profiling import Profiler
+
 
 class LLM:
     """
     A small wrapper class for a language model.
     """
 
-    def __init__(self, model_name: str, device: str = 'cuda' if torch.cuda.is_available() else 'cpu'):
+    def __init__(
+            self,
+            model_name: str,
+            device: str = 'cuda' if torch.cuda.is_available() else 'cpu',
+            quantization: Literal['none', 'int8', 'bf16'] = 'none',
+    ):
+        """
+        :param model_name: The model checkpoint to load.
+        :param device: The device on which to run the model.
+        :param quantization: 'int8' to quantize the weights of all linear layers to int8 with dynamic quantization
+                             of activations, which is only supported on CPU; 'bf16' to load the weights in bfloat16;
+                             or 'none' to load the weights at full precision.
+        """
+        if quantization == 'int8' and device != 'cpu':
+            raise ValueError(f'int8 quantization is only supported on CPU, not on device: {device}')
+
+        self.model_name = model_name
+        self.quantization = quantization
         self.device = device
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForCausalLM.from_pretrained(model_name).to(device)
+        torch_dtype = torch.bfloat16 if quantization == 'bf16' else None
+        self.model = AutoModelForCausalLM.from_pretrained(model_name, torch_dtype=torch_dtype).to(device)
+        if quantization == 'int8':
+            self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
 
         self.kv_cache = None
-        self.kv_cache_saved = None
         self.input_ids_cache = None
-        self.input_ids_cache_saved = None
+        self.checkpoints = []  # Stack of (name, sequence length) pairs saved by save_state
+        self.prefix_cache = None  # Pair of (token ids, KV cache) for a fixed prompt prefix, set by cache_prefix
+        self.profiler = Profiler()  # Disabled by default
 
     def __call__(
             self,
@@ -31,32 +55,27 @@ class LLM:
         Generates text, given a prompt.
         """
 
-        # If prompt is None, continue generation from previously generated tokens
+        # If prompt is None, continue generation from previously generated tokens.
+        # Otherwise, encode the prompt and reuse the KV cache for any prefix it shares with the previous sequence.
         if prompt is None:
-            prompt = self.input_ids_cache
+            input_ids = self.input_ids_cache
         else:
-            self.reset_cache()
-
-        # If prompt is a string, encode it into token ids
-        if isinstance(prompt, str):
-            encoded_input = self.tokenizer(prompt, return_tensors='pt')
-            input_ids = encoded_input['input_ids'].to(self.device)
-            attention_mask = encoded_input['attention_mask'].to(self.device)
-        else:
-            input_ids = prompt.to(self.device)
-            attention_mask = torch.ones_like(input_ids)
+            input_ids = self._encode(prompt)
+            self._crop_cache_to_common_prefix(input_ids)
+        attention_mask = torch.ones_like(input_ids)
 
         # Run generation
-        output_dict = self.model.generate(
-            input_ids,
-            attention_mask=attention_mask,
-            pad_token_id=self.tokenizer.pad_token_id,
-            do_sample=True,
-            num_return_sequences=1,
-            past_key_values=self.kv_cache,
-            return_dict_in_generate=True,
-            **kwargs,
-        )
+        with self.profiler.section('generate'):
+            output_dict = self.model.generate(
+                input_ids,
+                attention_mask=attention_mask,
+                pad_token_id=self.tokenizer.pad_token_id,
+                do_sample=True,
+                num_return_sequences=1,
+                past_key_values=self.kv_cache,
+                return_dict_in_generate=True,
+                **kwargs,
+            )
         self.input_ids_cache = output_dict['sequences']
 
         # Return result as token ids or as a string
@@ -66,13 +85,209 @@ class LLM:
 
         return (result, output_dict) if return_dict else result
 
+    def set_prompt(self, prompt: str | torch.Tensor) -> None:
+        """
+        Sets the prompt as the sequence to be continued by next_token_logits.
+        The KV cache is kept for the longest prefix that the prompt shares with the previous sequence.
+        """
+        input_ids = self._encode(prompt)
+        self._crop_cache_to_common_prefix(input_ids)
+        self.input_ids_cache = input_ids
+
+    def next_token_logits(self) -> torch.Tensor:
+        """
+        Runs a forward pass over the tokens not yet in the KV cache, and returns the logits for the next token.
+        """
+        return self.tail_logits(1)[:, -1, :]
+
+    @torch.no_grad()
+    def tail_logits(self, n_tokens: int) -> torch.Tensor:
+        """
+        Runs a forward pass over the tokens not yet in the KV cache, and returns the logits for the token following
+        each of the last n_tokens tokens, with shape (batch_size, n_tokens, vocab_size).
+        At most the number of tokens not yet in the KV cache can be requested.
+        """
+        cache_length = self.kv_cache.get_seq_length()
+        cache_position = torch.arange(cache_length, self.input_ids_cache.shape[1], device=self.device)
+        with self.profiler.section('decode' if len(cache_position) == 1 else 'prefill'):
+            outputs = self.model(
+                input_ids=self.input_ids_cache[:, cache_length:],
+                past_key_values=self.kv_cache,
+                cache_position=cache_position,
+                use_cache=True,
+                logits_to_keep=n_tokens,
+            )
+        return outputs.logits[:, -n_tokens:, :]
+
+    def append_tokens(self, token_ids: torch.Tensor) -> None:
+        """
+        Appends token ids of shape (batch_size, n_tokens) to the sequence being generated.
+        """
+        self.input_ids_cache = torch.cat([self.input_ids_cache, token_ids.to(self.device)], dim=1)
+
+    def fork(self, n: int) -> None:
+        """
+        Repeats the generated sequence and its KV cache into n identical rows, which can then be decoded as a batch.
+        """
+        if n == 1:
+            return
+        self.kv_cache.batch_repeat_interleave(n)
+        self.input_ids_cache = self.input_ids_cache.repeat(n, 1)
+
+    def select_row(self, idx: int) -> None:
+        """
+        Keeps only the given row of the generated sequence and its KV cache, discarding all other rows.
+        """
+        if self.input_ids_cache.shape[0] == 1:
+            return
+        self.kv_cache.batch_select_indices(torch.tensor([idx], device=self.device))
+        self.input_ids_cache = self.input_ids_cache[idx:idx + 1]
+
+    @torch.no_grad()
+    def cache_prefix(self, prefix: str | torch.Tensor, path: str | Path | None = None) -> None:
+        """
+        Precomputes the KV cache for a fixed prompt prefix, such as an instruction template,
+        so that new prompts starting with this prefix only need to prefill the tokens after it.
+        :param prefix: The prompt prefix.
+        :param path: If given, the KV cache is loaded from this file if it was saved there for the same prefix,
+                     model and quantization, and is otherwise computed and saved to this file.
+        """
+        input_ids = self._encode(prefix)
+        kv_cache = self._load_prefix_cache(input_ids, path) if path is not None and Path(path).exists() else None
+        if kv_cache is None:
+            kv_cache = DynamicCache()
+            self.model(input_ids=input_ids, past_key_values=kv_cache, use_cache=True)
+            if path is not None:
+                Path(path).parent.mkdir(parents=True, exist_ok=True)
+                torch.save({
+                    'model_name': self.model_name,
+                    'quantization': self.quantization,
+                    'input_ids': input_ids.cpu(),
+                    'kv_cache': [(k.cpu(), v.cpu()) for k, v in kv_cache.to_legacy_cache()],
+                }, path)
+        self.prefix_cache = (input_ids, kv_cache)
+
+    def prefix_kv_cache(self, input_ids: torch.Tensor) -> DynamicCache:
+        """
+        Returns a new KV cache holding the cached prompt prefix if the given token ids start with the prefix
+        and extend beyond it, or an empty KV cache otherwise. The cached prefix itself is never modified.
+        """
+        if self._cached_prefix_length(input_ids) == 0:
+            return DynamicCache()
+        return DynamicCache.from_legacy_cache(self.prefix_cache[1].to_legacy_cache())
+
+    def _load_prefix_cache(self, input_ids: torch.Tensor, path: str | Path) -> DynamicCache | None:
+        """
+        Loads a KV cache saved by cache_prefix, or returns None if it was saved for a different prefix, model,
+        quantization or dtype. Int8 quantization keeps the model dtype, so the dtype alone does not identify the model.
+        """
+        saved = torch.load(path, map_location=self.device)
+        if saved.get('model_name') != self.model_name or saved.get('quantization') != self.quantization:
+            return None
+        if not torch.equal(saved['input_ids'], input_ids.cpu()):
+            return None
+        if any(k.dtype != self.model.dtype for k, _ in saved['kv_cache']):
+            return None
+        return DynamicCache.from_legacy_cache(tuple(saved['kv_cache']))
+
+    def _cached_prefix_length(self, input_ids: torch.Tensor) -> int:
+        """
+        Returns the length of the cached prompt prefix if the given token ids start with it and extend beyond it,
+        and 0 otherwise.
+        """
+        if self.prefix_cache is None or input_ids.shape[0] != 1:
+            return 0
+        prefix_ids = self.prefix_cache[0]
+        prefix_length = prefix_ids.shape[1]
+        if input_ids.shape[1] <= prefix_length or not torch.equal(input_ids[:, :prefix_length], prefix_ids):
+            return 0
+        return prefix_length
+
+    def _crop_cache_to_common_prefix(self, input_ids: torch.Tensor) -> None:
+        """
+        Crops the KV cache to the longest common prefix of the given token ids and the previous sequence,
+        so that only the rest of the token ids need to be prefilled. If the cached prompt prefix is longer,
+        starts from a copy of that instead. Resets the cache if there is no common prefix.
+        """
+        common_length = self._common_prefix_length(input_ids)
+        if self._cached_prefix_length(input_ids) > common_length:
+            self.kv_cache = self.prefix_kv_cache(input_ids)
+        elif common_length == 0:
+            self.reset_cache()
+        else:
+            self.kv_cache.crop(common_length)
+
+    def _common_prefix_length(self, input_ids: torch.Tensor) -> int:
+        """
+        Returns the length of the longest common prefix of the given token ids and the previous sequence
+        that can be kept in the KV cache.
+        """
+        if (self.kv_cache is None or self.input_ids_cache is None
+                or self.input_ids_cache.shape[0] != 1 or input_ids.shape[0] != 1):
+            return 0
+
+        # The last token must stay out of the KV cache, so that the next forward pass can produce its logits
+        max_length = min(self.kv_cache.get_seq_length(), input_ids.shape[1] - 1)
+        mismatches = (self.input_ids_cache[0, :max_length] != input_ids[0, :max_length]).nonzero()
+        return mismatches[0].item() if len(mismatches) else max_length
+
+    def _encode(self, prompt: str | torch.Tensor) -> torch.Tensor:
+        if isinstance(prompt, str):
+            return self.tokenizer(prompt, return_tensors='pt')['input_ids'].to(self.device)
+        return prompt.to(self.device)
+
     def reset_cache(self) -> None:
         self.kv_cache = DynamicCache()
 
-    def save_state(self) -> None:
-        self.kv_cache_saved = copy.deepcopy(self.kv_cache)
-        self.input_ids_cache_saved = self.input_ids_cache
+    @property
+    def sequence_length(self) -> int:
+        """
+        The length of the sequence being generated, including the prompt.
+        """
+        return 0 if self.input_ids_cache is None else self.input_ids_cache.shape[1]
+
+    def save_state(self, name: str = 'default') -> None:
+        """
+        Saves a named checkpoint of the generation state, which can be restored with rollback_to_saved_state.
+        Only the sequence length is recorded, so saving is O(1) regardless of the size of the KV cache.
+        Saving a checkpoint discards any existing checkpoint with the same name, along with all checkpoints after it.
+        """
+        with self.profiler.section('save_state'):
+            self._discard_checkpoints(name)
+            self.checkpoints.append((name, self.sequence_length))
+
+    def rollback_to_saved_state(self, name: str = 'default') -> None:
+        """
+        Rolls back to the named checkpoint by truncating the generated sequence and cropping the KV cache in place.
+        The checkpoint is kept, but all checkpoints saved after it are discarded.
+        """
+        with self.profiler.section('rollback'):
+            idx = self._checkpoint_idx(name)
+            del self.checkpoints[idx + 1:]
+            self.truncate(self.checkpoints[idx][1])
+
+    def truncate(self, length: int) -> None:
+        """
+        Truncates the generated sequence to the given length, cropping the KV cache accordingly.
+        """
+        if length == 0:
+            self.input_ids_cache = None
+            self.kv_cache = DynamicCache()
+            return
+
+        self.input_ids_cache = self.input_ids_cache[:, :length]
+        # The last token must stay out of the KV cache, so that the next forward pass can produce its logits
+        if self.kv_cache.get_seq_length() >= length:
+            self.kv_cache.crop(length - 1)
+
+    def _discard_checkpoints(self, name: str) -> None:
+        try:
+            del self.checkpoints[self._checkpoint_idx(name):]
+        except KeyError:
+            pass
 
-    def rollback_to_saved_state(self) -> None:
-        self.kv_cache = self.kv_cache_saved
-        self.input_ids_cache = self.input_ids_cache_saved
+    def _checkpoint_idx(self, name: str) -> int:
+        for idx in range(len(self.checkpoints) - 1, -1, -1):
+            if self.checkpoints[idx][0] == name:
+                return idx
+        raise KeyError(f'No saved checkpoint named: {name}')
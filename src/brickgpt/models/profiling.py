@@ -0,0 +1,69 @@
+import contextlib
+import json
+import threading
+import time
+from collections import defaultdict
+
+
+class Profiler:
+    """
+    Records the total time and number of calls of named sections of code, and optionally a trace of every call
+    which can be saved in the Chrome trace event format (viewable in chrome://tracing or Perfetto).
+    When disabled, sections are no-ops, so instrumented code pays almost nothing.
+    """
+
+    def __init__(self, enabled: bool = False, trace: bool = False):
+        self.enabled = enabled
+        self.trace = trace
+        self.reset()
+
+    def reset(self) -> None:
+        self.times = defaultdict(int)  # Total time of each section in nanoseconds
+        self.counts = defaultdict(int)  # Number of calls of each section
+        self.trace_events = []
+        self.start_time = time.perf_counter_ns()
+
+    def section(self, name: str) -> contextlib.AbstractContextManager:
+        """
+        Returns a context manager which records the time spent inside it under the given section name.
+        """
+        return _Section(self, name) if self.enabled else _null_section
+
+    def report(self) -> dict:
+        """
+        Returns the total time in seconds and the number of calls of each section.
+        """
+        return {name: {'time': self.times[name] / 1e9, 'count': self.counts[name]} for name in self.times}
+
+    def save_chrome_trace(self, path: str) -> None:
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.trace_events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _Section:
+    __slots__ = ('profiler', 'name', 'start')
+
+    def __init__(self, profiler: Profiler, name: str):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        profiler = self.profiler
+        profiler.times[self.name] += end - self.start
+        profiler.counts[self.name] += 1
+        if profiler.trace:
+            profiler.trace_events.append({
+                'name': self.name,
+                'ph': 'X',  # Complete event
+                'ts': (self.start - profiler.start_time) / 1e3,  # Microseconds
+                'dur': (end - self.start) / 1e3,
+                'pid': 0,
+                'tid': threading.get_ident(),
+            })
+
+
+_null_section = contextlib.nullcontext()
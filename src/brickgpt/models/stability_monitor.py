@@ -0,0 +1,94 @@
+from concurrent.futures import Executor, Future
+from typing import Callable
+
+from brickgpt.data import BrickStructure
+
+
+class StabilityMonitor:
+    """
+    Checks the stability of a brick structure while it is being generated, every k bricks and/or whenever a layer
+    is completed, so that an unstable brick can be rolled back without generating the rest of the structure.
+    Checks can run in the background on an executor while decoding continues. Then, a failed check is reported
+    at the first update after it finishes, and the bricks generated in the meantime are discarded by the rollback.
+    """
+
+    def __init__(
+            self,
+            is_stable: Callable[[BrickStructure], bool],
+            interval: int = 0,
+            per_layer: bool = False,
+            executor: Executor | None = None,
+    ):
+        """
+        :param is_stable: The function which checks whether a brick structure is stable.
+        :param interval: Check the structure every this many bricks. Set to 0 to disable.
+        :param per_layer: Whether to check the structure whenever a brick is placed in a different layer than the
+                          previous brick, i.e. whenever a layer has been completed.
+        :param executor: If given, checks run in the background on this executor.
+        """
+        self.is_stable = is_stable
+        self.interval = interval
+        self.per_layer = per_layer
+        self.executor = executor
+
+        self.pending: tuple[int, Future] | None = None  # The number of bricks being checked in the background
+        self.waiting: tuple[int, BrickStructure] | None = None  # The part of the structure waiting to be checked
+
+    def update(self, bricks: BrickStructure) -> int | None:
+        """
+        Called after each brick is added to the brick structure.
+        :return: The number of bricks in the first part of the structure found to be unstable, or None if no
+                 instability has been found so far.
+        """
+        n_bricks_due = self._n_bricks_due(bricks)
+        if self.executor is None:
+            if n_bricks_due is not None and not self.is_stable(_first_bricks(bricks, n_bricks_due)):
+                return n_bricks_due
+            return None
+
+        if n_bricks_due is not None:  # Only the latest part of the structure needs checking
+            self.waiting = (n_bricks_due, _first_bricks(bricks, n_bricks_due))
+        if self.pending is not None and self.pending[1].done():
+            unstable_n_bricks = self._collect()
+            if unstable_n_bricks is not None:
+                return unstable_n_bricks
+        if self.pending is None and self.waiting is not None:
+            n_bricks, structure = self.waiting
+            self.pending = (n_bricks, self.executor.submit(self.is_stable, structure))
+            self.waiting = None
+        return None
+
+    def finish(self) -> int | None:
+        """
+        Called when generation of the brick structure is finished. Waits for any check running in the background,
+        and then runs the check waiting for it, if any.
+        :return: The number of bricks in the first part of the structure found to be unstable, or None.
+        """
+        if self.pending is not None and (unstable_n_bricks := self._collect()) is not None:
+            return unstable_n_bricks
+        if self.waiting is not None:
+            n_bricks, structure = self.waiting
+            self.waiting = None
+            if not self.is_stable(structure):
+                return n_bricks
+        return None
+
+    def _collect(self) -> int | None:
+        n_bricks, future = self.pending
+        self.pending = None
+        return None if future.result() else n_bricks
+
+    def _n_bricks_due(self, bricks: BrickStructure) -> int | None:
+        """
+        Returns the number of bricks at the start of the structure that are due to be checked, or None.
+        """
+        n_bricks = len(bricks)
+        if self.interval > 0 and n_bricks % self.interval == 0:
+            return n_bricks
+        if self.per_layer and n_bricks >= 2 and bricks.bricks[-1].z != bricks.bricks[-2].z:
+            return n_bricks - 1
+        return None
+
+
+def _first_bricks(bricks: BrickStructure, n_bricks: int) -> BrickStructure:
+    return BrickStructure(bricks.bricks[:n_bricks], world_dim=bricks.world_dim)
@@ -0,0 +1,82 @@
+import dataclasses
+import time
+from dataclasses import dataclass, field
+
+import transformers
+from transformers import HfArgumentParser
+
+from brickgpt.models import BrickGPT, BrickGPTConfig
+
+_default_captions = [
+    'A basic chair with four legs.',
+    'Table featuring a flat rectangular surface over four evenly spaced legs.',
+    'A tall, narrow tower with a square base.',
+    'A simple bench with a long flat seat.',
+]
+
+
+@dataclass
+class ReportConfig:
+    captions_file: str | None = field(
+        default=None,
+        metadata={'help': 'A text file with one caption per line to generate brick structures for. '
+                          'If None, uses a small set of default captions.'},
+    )
+    seed: int = field(
+        default=42,
+        metadata={'help': 'The generation seed to use for each caption.'},
+    )
+
+
+def evaluate(brickgpt: BrickGPT, captions: list[str], seed: int) -> dict:
+    """
+    Generates a brick structure for each caption, and returns statistics on speed and brick validity.
+    """
+    n_bricks = n_rejections = n_stable = 0
+    start_time = time.time()
+    for caption in captions:
+        transformers.set_seed(seed)
+        output = brickgpt(caption)
+        n_bricks += len(output['bricks'])
+        n_rejections += output['rejection_reasons'].total()
+        n_stable += brickgpt._is_stable(output['bricks'])
+    total_time = time.time() - start_time
+
+    return {
+        'bricks/s': n_bricks / total_time,
+        'valid brick rate': n_bricks / max(n_bricks + n_rejections, 1),
+        'stable structure rate': n_stable / len(captions),
+        'total time (s)': total_time,
+    }
+
+
+def main():
+    """
+    Reports the impact of the configured quantization on generation speed and brick validity,
+    compared to the same configuration without quantization.
+    """
+    parser = HfArgumentParser((ReportConfig, BrickGPTConfig))
+    report_cfg, cfg = parser.parse_args_into_dataclasses()
+    if cfg.quantization == 'none':
+        raise ValueError('Specify a quantization to compare against, e.g. --quantization int8')
+
+    captions = _default_captions
+    if report_cfg.captions_file is not None:
+        with open(report_cfg.captions_file) as f:
+            captions = [line.strip() for line in f if line.strip()]
+
+    results = {}
+    for quantization in ['none', cfg.quantization]:
+        brickgpt = BrickGPT(dataclasses.replace(cfg, quantization=quantization))
+        results[quantization] = evaluate(brickgpt, captions, report_cfg.seed)
+        del brickgpt
+
+    print('--------------------')
+    print(f'{"":<24}' + ''.join(f'{q:>12}' for q in results))
+    for metric in results['none']:
+        print(f'{metric:<24}' + ''.join(f'{r[metric]:>12.3f}' for r in results.values()))
+    print('--------------------')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+import json
+import math
+import os
+import queue
+import socketserver
+import statistics
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable
+
+from transformers import HfArgumentParser
+
+from brickgpt.models import BrickGPT, BrickGPTConfig
+from brickgpt.models.batch_generation import BatchedBrickGenerator, BatchRow
+
+
+@dataclass
+class ServerConfig:
+    host: str = field(
+        default='127.0.0.1',
+        metadata={'help': 'The host on which to listen for HTTP requests.'},
+    )
+    port: int = field(
+        default=8000,
+        metadata={'help': 'The port on which to listen for HTTP requests.'},
+    )
+    unix_socket: str | None = field(
+        default=None,
+        metadata={'help': 'If given, listen on this Unix socket instead of on a host and port.'},
+    )
+    max_batch_size: int = field(
+        default=8,
+        metadata={'help': 'The maximum number of brick structures to generate at once. '
+                          'Further requests wait in the queue, and join the batch as soon as a structure is finished.'},
+    )
+    request_timeout: float = field(
+        default=3600.0,
+        metadata={'help': 'The maximum time in seconds that a request waits for its result.'},
+    )
+
+
+@dataclass(eq=False)
+class Job:
+    """
+    A request to generate a brick structure, and its result once it is finished.
+    """
+    caption: str
+    seed: int | None = None
+    temperature: float | None = None
+    max_bricks: int | None = None
+    world_dim: int | None = None
+
+    submit_time: float = field(default_factory=time.monotonic)
+    start_time: float | None = None
+    end_time: float | None = None
+    result: dict | None = None
+    error: str | None = None
+    done: threading.Event = field(default_factory=threading.Event)
+    cancelled: bool = False  # Set when the result is no longer needed
+
+    def finish(self, result: dict | None = None, error: str | None = None) -> None:
+        self.end_time = time.monotonic()
+        self.result = result
+        self.error = error
+        self.done.set()
+
+
+class Scheduler:
+    """
+    Generates brick structures for queued jobs with continuous batching. A single worker thread owns the model and
+    decodes all running jobs together; queued jobs join the running batch between steps whenever there is room.
+    """
+
+    def __init__(
+            self,
+            brickgpt: BrickGPT,
+            max_batch_size: int,
+            make_generator: Callable[[BrickGPT], BatchedBrickGenerator] = BatchedBrickGenerator,
+    ):
+        """
+        :param make_generator: Creates the batched generator of the model, whenever the batch is started again.
+        """
+        self.brickgpt = brickgpt
+        self.max_batch_size = max_batch_size
+        self.make_generator = make_generator
+        self.queue: queue.Queue[Job] = queue.Queue()
+        self.generator = make_generator(brickgpt)
+        self.running: dict[BatchRow, Job] = {}
+
+        self.n_completed = 0
+        self.n_failed = 0
+        self.n_cancelled = 0
+        self.queue_times = deque(maxlen=1000)  # Seconds from submission to joining the batch, for recent jobs
+        self.latencies = deque(maxlen=1000)  # Seconds from submission to finishing, for recent jobs
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='brickgpt-scheduler', daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def submit(self, job: Job) -> None:
+        """
+        Queues the job. Raises a ValueError if its options are invalid, so that they cannot fail the whole batch.
+        """
+        world_dim = self.brickgpt.world_dim if job.world_dim is None else job.world_dim
+        if not 1 <= world_dim <= self.brickgpt.world_dim:
+            raise ValueError(f'world_dim must be between 1 and {self.brickgpt.world_dim}, got {world_dim}')
+        if job.temperature is not None and not (job.temperature > 0 and math.isfinite(job.temperature)):
+            raise ValueError(f'temperature must be positive, got {job.temperature}')
+        if job.max_bricks is not None and job.max_bricks < 1:
+            raise ValueError(f'max_bricks must be at least 1, got {job.max_bricks}')
+        self.queue.put(job)
+
+    def cancel(self, job: Job) -> None:
+        """
+        Cancels the job if it is not finished yet. It is removed from the queue or the batch before the next step.
+        """
+        job.cancelled = True
+
+    def metrics(self) -> dict:
+        with self._lock:
+            queue_times = list(self.queue_times)
+            latencies = list(self.latencies)
+            n_completed, n_failed, n_cancelled = self.n_completed, self.n_failed, self.n_cancelled
+        return {
+            'queue_depth': self.queue.qsize(),
+            'batch_size': len(self.running),
+            'max_batch_size': self.max_batch_size,
+            'n_completed': n_completed,
+            'n_failed': n_failed,
+            'n_cancelled': n_cancelled,
+            'queue_time': _summarize(queue_times),
+            'latency': _summarize(latencies),
+        }
+
+    def _run(self) -> None:
+        while True:
+            self._admit_jobs()
+            self._remove_cancelled_jobs()
+            try:
+                finished_rows = self.generator.step()
+            except Exception as e:  # Fail every running job, and start again with an empty batch
+                for job in self.running.values():
+                    self._finish(job, error=repr(e))
+                self.running.clear()
+                self.generator = self.make_generator(self.brickgpt)
+                continue
+            for row in finished_rows:
+                job = self.running.pop(row, None)
+                if job is not None:  # Otherwise the row was left behind by a failed add, and belongs to no job
+                    self._finish(job, result=row.result)
+
+    def _admit_jobs(self) -> None:
+        """
+        Adds queued jobs to the batch until it is full. Blocks until a job arrives if the batch is empty.
+        """
+        while len(self.running) < self.max_batch_size:
+            if not self.running:  # Free the stability model while idle, as it is only reused within a generation
+                self.brickgpt.close_stability_model()
+            try:
+                job = self.queue.get(block=not self.running)
+            except queue.Empty:
+                return
+            if job.cancelled:
+                self._finish(job, error='Cancelled')
+                continue
+            job.start_time = time.monotonic()
+            try:
+                row = self.generator.add(job.caption, seed=job.seed, temperature=job.temperature,
+                                         max_bricks=job.max_bricks, world_dim=job.world_dim)
+            except Exception as e:
+                self._finish(job, error=repr(e))
+                continue
+            if row.result is not None:  # Finished immediately
+                self._finish(job, result=row.result)
+            else:
+                self.running[row] = job
+
+    def _remove_cancelled_jobs(self) -> None:
+        for row, job in list(self.running.items()):
+            if job.cancelled:
+                self.generator.remove(row)
+                del self.running[row]
+                self._finish(job, error='Cancelled')
+
+    def _finish(self, job: Job, result: dict | None = None, error: str | None = None) -> None:
+        job.finish(result, error)
+        with self._lock:
+            if error is None:
+                self.n_completed += 1
+                self.queue_times.append(job.start_time - job.submit_time)
+                self.latencies.append(job.end_time - job.submit_time)
+            elif job.cancelled:
+                self.n_cancelled += 1
+            else:
+                self.n_failed += 1
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    Handles the HTTP API of the server:
+    - POST /generate with a JSON object containing a "caption", and optionally "seed", "temperature", "max_bricks",
+      and "world_dim". Responds with the generated brick structure once it is finished.
+    - GET /metrics responds with the queue depth, batch size, and queue time and latency statistics.
+    - GET /health responds with {"status": "ok"}.
+    """
+    server: 'ThreadingHTTPServer | ThreadingUnixHTTPServer'
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._send_json({'status': 'ok'})
+        elif self.path == '/metrics':
+            self._send_json(self.server.scheduler.metrics())
+        else:
+            self._send_json({'error': f'Not found: {self.path}'}, HTTPStatus.NOT_FOUND)
+
+    def do_POST(self):
+        if self.path != '/generate':
+            self._send_json({'error': f'Not found: {self.path}'}, HTTPStatus.NOT_FOUND)
+            return
+
+        try:
+            job = parse_job(json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0)))))
+            self.server.scheduler.submit(job)
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json({'error': f'Invalid request: {e!r}'}, HTTPStatus.BAD_REQUEST)
+            return
+
+        if not job.done.wait(self.server.request_timeout):
+            self.server.scheduler.cancel(job)  # Free its place in the batch
+            self._send_json({'error': 'Timed out waiting for the result'}, HTTPStatus.GATEWAY_TIMEOUT)
+            return
+        if job.error is not None:
+            self._send_json({'error': job.error}, HTTPStatus.INTERNAL_SERVER_ERROR)
+            return
+        self._send_json({
+            'bricks': job.result['bricks'].to_txt(),
+            'rejection_reasons': dict(job.result['rejection_reasons']),
+            'n_regenerations': job.result['n_regenerations'],
+            'queue_time': job.start_time - job.submit_time,
+            'generation_time': job.end_time - job.start_time,
+        })
+
+    def address_string(self) -> str:
+        return self.client_address[0] if self.client_address else self.server.server_address
+
+    def _send_json(self, obj: dict, status: HTTPStatus = HTTPStatus.OK) -> None:
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def parse_job(body: dict) -> Job:
+    """
+    Returns the job requested by the JSON body of a /generate request.
+    """
+    if not isinstance(body, dict):
+        raise TypeError(f'The request body must be a JSON object, got {type(body).__name__}')
+    return Job(
+        caption=str(body['caption']),
+        seed=_optional(body, 'seed', int),
+        temperature=_optional(body, 'temperature', float),
+        max_bricks=_optional(body, 'max_bricks', int),
+        world_dim=_optional(body, 'world_dim', int),
+    )
+
+
+def _optional(body: dict, key: str, type_: type):
+    return None if body.get(key) is None else type_(body[key])
+
+
+def _summarize(values: list[float]) -> dict:
+    if not values:
+        return {'mean': None, 'p50': None, 'p95': None}
+    values = sorted(values)
+    return {
+        'mean': statistics.fmean(values),
+        'p50': values[int(0.50 * (len(values) - 1))],
+        'p95': values[int(0.95 * (len(values) - 1))],
+    }
+
+
+def main():
+    parser = HfArgumentParser((ServerConfig, BrickGPTConfig))
+    server_cfg, brickgpt_cfg = parser.parse_args_into_dataclasses()
+
+    scheduler = Scheduler(BrickGPT(brickgpt_cfg), server_cfg.max_batch_size)
+    scheduler.start()
+
+    if server_cfg.unix_socket is not None:
+        if os.path.exists(server_cfg.unix_socket):
+            os.remove(server_cfg.unix_socket)
+        server = ThreadingUnixHTTPServer(server_cfg.unix_socket, RequestHandler)
+        address = server_cfg.unix_socket
+    else:
+        server = ThreadingHTTPServer((server_cfg.host, server_cfg.port), RequestHandler)
+        address = f'http://{server_cfg.host}:{server_cfg.port}'
+    server.scheduler = scheduler
+    server.request_timeout = server_cfg.request_timeout
+
+    print(f'Serving BrickGPT on {address}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,6 @@
 from .stability_analysis import StabilityConfig, stability_score
+from .solvers import GurobiEnvPool, gurobi_env_pool
+from .incremental_stability import IncrementalStabilityModel
+from .prescreen import prescreen_stability
+from .cache import StabilityCache
 from .connectivity_analysis import connectivity_score
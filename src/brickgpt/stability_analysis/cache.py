@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from .stability_analysis import StabilityConfig, stability_score
+
+# StabilityConfig fields which do not change the stability scores. Only scores of optimal solves are cached,
+# which do not depend on the time budget.
+_IGNORED_CONFIG_FIELDS = ('visualize', 'print_log', 'n_workers', 'parallel_min_bricks', 'time_limit',
+                          'time_limit_fallback')
+
+
+class StabilityCache:
+    """
+    Caches stability scores by the contents of the brick structure and the stability config. Recently used scores are
+    kept in memory, and all scores can also be kept in an SQLite database on disk, which persists between runs and can
+    be shared by any number of processes. Structures with the same bricks in a different order share their scores.
+    The cached score arrays are read-only.
+    """
+
+    def __init__(self, path: str | os.PathLike | None = None, max_size: int = 1024):
+        """
+        :param path: The path of the SQLite database. If None, scores are only cached in memory.
+        :param max_size: The maximum number of score arrays kept in memory.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.lock = threading.Lock()
+        self.memory_hits = self.disk_hits = self.misses = 0
+
+        self._connection = None
+        self._connection_pid = None
+
+    @property
+    def stats(self) -> dict:
+        hits = self.memory_hits + self.disk_hits
+        return {
+            'hits': hits,
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / max(hits + self.misses, 1),
+        }
+
+    @staticmethod
+    def key(brick_structure: dict, cfg: StabilityConfig) -> str:
+        """
+        Returns a canonical hash of the bricks, in the same format as for stability_score, and the stability config.
+        """
+        bricks = sorted((str(brick['brick_id']), brick['x'], brick['y'], brick['z'], brick['ori'])
+                        for brick in brick_structure.values())
+        config = {name: value for name, value in asdict(cfg).items() if name not in _IGNORED_CONFIG_FIELDS}
+        return hashlib.sha256(json.dumps([bricks, config], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key: str) -> np.ndarray | None:
+        with self.lock:
+            scores = self.memory.get(key)
+            if scores is not None:
+                self.memory.move_to_end(key)
+                self.memory_hits += 1
+                return scores
+            if self.path is not None:
+                row = self._db().execute('SELECT shape, scores FROM stability_scores WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    shape, data = row
+                    scores = np.frombuffer(zlib.decompress(data)).reshape(json.loads(shape))
+                    self._remember(key, scores)
+                    self.disk_hits += 1
+                    return scores
+            self.misses += 1
+            return None
+
+    def put(self, key: str, scores: np.ndarray) -> np.ndarray:
+        """
+        Caches the scores, and returns the read-only copy which is cached.
+        """
+        scores = np.array(scores, dtype=float)
+        scores.flags.writeable = False
+        with self.lock:
+            self._remember(key, scores)
+            if self.path is not None:
+                with self._db() as db:
+                    db.execute('INSERT OR REPLACE INTO stability_scores VALUES (?, ?, ?)',
+                               (key, json.dumps(scores.shape), zlib.compress(scores.tobytes())))
+        return scores
+
+    def get_or_compute(
+            self,
+            brick_structure: dict,
+            cfg: StabilityConfig,
+            compute: Callable[[], tuple[np.ndarray, str]],
+    ) -> np.ndarray:
+        """
+        Returns the cached stability scores of the brick structure, or computes them.
+        :param compute: Returns the scores and the path by which they were computed, as stability_score with
+                        return_path=True. Only scores of the 'optimal' path are cached, as the others are fallbacks
+                        for a solve which failed or ran out of time, and may be solved next time.
+        """
+        key = self.key(brick_structure, cfg)
+        scores = self.get(key)
+        if scores is None:
+            scores, path = compute()
+            if path == 'optimal':
+                scores = self.put(key, scores)
+        return scores
+
+    def stability_scores(self, brick_structure: dict, brick_library: dict,
+                         cfg: StabilityConfig = StabilityConfig()) -> np.ndarray:
+        """
+        Returns the stability scores computed by stability_score, from the cache if possible.
+        """
+        def compute() -> tuple[np.ndarray, str]:
+            scores, _, _, _, _, path = stability_score(brick_structure, brick_library, cfg, return_path=True)
+            return scores, path
+
+        return self.get_or_compute(brick_structure, cfg, compute)
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def _remember(self, key: str, scores: np.ndarray) -> None:
+        self.memory[key] = scores
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def _db(self) -> sqlite3.Connection:
+        # Connections cannot be used in forked processes, so each process opens its own
+        if self._connection is None or self._connection_pid != os.getpid():
+            Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')  # Readers do not block writers in other processes
+            self._connection.execute('CREATE TABLE IF NOT EXISTS stability_scores '
+                                     '(key TEXT PRIMARY KEY, shape TEXT, scores BLOB)')
+            self._connection_pid = os.getpid()
+        return self._connection
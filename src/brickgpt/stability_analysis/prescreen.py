@@ -0,0 +1,75 @@
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+
+from .stability_analysis import (StabilityConfig, _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS,
+                                 _brick_arrays, _brick_grid, _touching_bricks)
+
+
+def prescreen_stability(brick_structure, brick_library, cfg=StabilityConfig()) -> bool | None:
+    """
+    Decides whether a brick structure is stable from cheap sufficient and necessary conditions, where it can,
+    so that the stability model only needs to be solved for the remaining structures.
+    Assumes that the structure has no colliding or out of bounds bricks.
+    - Stable: every voxel rests on a voxel directly below it or on the ground. Then the weight above each voxel can
+      be carried straight down by pushing forces alone, which balances every brick.
+    - Unstable: for some layer z0, a connected group of the bricks at or above z0 has its centre of mass so far
+      outside the connection points below it that its torque exceeds what the pulling forces at those points can
+      hold before a connection breaks. The horizontal forces at those points are all at the same height,
+      so they cancel out and cannot help.
+    :return: True if the structure is stable, False if it is unstable, or None if it cannot be decided cheaply.
+    """
+    keys, brick_x, brick_y, brick_z, brick_h, brick_w, brick_weight = _brick_arrays(brick_structure, brick_library,
+                                                                                    cfg.g)
+    if not keys:
+        return True
+    brick_grid = _brick_grid(brick_x, brick_y, brick_z, brick_h, brick_w, cfg.world_dimension)
+    occupied = brick_grid >= 0
+    if np.all(occupied[:, :, :-1] | ~occupied[:, :, 1:]):
+        return True
+
+    T_ = cfg.T / 1000 * cfg.g
+    n_bricks = len(keys)
+    edges = _touching_bricks(brick_grid)
+    centre_x = brick_x + (brick_h - 1) / 2
+    centre_y = brick_y + (brick_w - 1) / 2
+
+    # Connection points of each voxel with the voxel below it or the ground, by the brick of the voxel
+    vi, vj, vk = np.nonzero(occupied & np.concatenate([np.ones_like(occupied[:, :, :1]), occupied[:, :, :-1]], axis=2))
+    vb = brick_grid[vi, vj, vk]
+    offsets = np.where((np.minimum(brick_h, brick_w) < 2)[vb][:, None, None], _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS)
+    n_pts = np.where(np.minimum(brick_h, brick_w)[vb] < 2, 4, 3)
+    pt_mask = np.arange(4) < n_pts[:, None]
+    pt_x = (vi[:, None] + offsets[:, :, 1])[pt_mask]
+    pt_y = (vj[:, None] + offsets[:, :, 0])[pt_mask]
+    pt_k = np.repeat(vk, n_pts)
+    pt_brick = np.repeat(vb, n_pts)
+
+    for z0 in range(brick_z.max() + 1):
+        # Groups of touching bricks at or above z0, which only connect to the rest of the structure from below
+        above = brick_z >= z0
+        group_edges = edges[:, above[edges[0]] & above[edges[1]]]
+        graph = sp.coo_matrix((np.ones(group_edges.shape[1]), (group_edges[0], group_edges[1])),
+                              shape=(n_bricks, n_bricks))
+        n_groups, labels = connected_components(graph, directed=False)
+        weight = np.bincount(labels[above], weights=brick_weight[above], minlength=n_groups)
+        pts = pt_k == z0
+        pt_group = labels[pt_brick[pts]]
+        n_group_pts = np.bincount(pt_group, minlength=n_groups)
+        if np.any((weight > 0) & (n_group_pts == 0)):
+            return False  # Nothing holds up the group
+
+        for sign in (1, -1):
+            for pt_pos, centre in ((pt_x[pts], centre_x), (pt_y[pts], centre_y)):
+                pt_pos = sign * pt_pos
+                centre_of_mass = np.bincount(labels[above], weights=(sign * centre * brick_weight)[above],
+                                             minlength=n_groups) / np.maximum(weight, 1e-12)
+                extreme = np.full(n_groups, -np.inf)
+                np.maximum.at(extreme, pt_group, pt_pos)
+                extreme[n_group_pts == 0] = 0  # The bricks below z0, which are groups of their own without weight
+                # Pulling forces below T at the points can hold at most T times this torque about the outermost point
+                max_torque = n_group_pts * extreme - np.bincount(pt_group, weights=pt_pos, minlength=n_groups)
+                overhang = centre_of_mass - extreme
+                if np.any((overhang > 0) & (weight * overhang > T_ * max_torque * (1 + 1e-6))):
+                    return False
+    return None
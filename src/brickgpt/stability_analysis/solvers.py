@@ -0,0 +1,220 @@
+import contextlib
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+import gurobipy as gp
+import numpy as np
+import scipy.optimize
+import scipy.sparse as sp
+from gurobipy import GRB
+
+
+@dataclass
+class StabilityModel:
+    """
+    The stability analysis optimization problem, independent of the solver: minimize objective @ x such that
+    - A @ x == rhs, and x >= lb,
+    - x[pulling] * x[pushing] == 0 (both are nonnegative forces at the same connection point),
+    - x[abs_result] == abs(x[abs_arg]),
+    - x[max_result[b]] == max(x[max_args[b]]) for each brick b with a nonempty max_args[b].
+    abs_result, abs_arg, max_result, and max_args have a row for each brick.
+    """
+    lb: np.ndarray
+    A: sp.csr_matrix
+    rhs: np.ndarray
+    pulling: np.ndarray
+    pushing: np.ndarray
+    abs_result: np.ndarray
+    abs_arg: np.ndarray
+    max_result: np.ndarray
+    max_args: list[np.ndarray]
+    objective: np.ndarray
+
+    @property
+    def n_vars(self) -> int:
+        return len(self.lb)
+
+
+@dataclass
+class StabilitySolution:
+    """
+    The values of the variables, or None if the model was not solved successfully. If timed_out, the solve was stopped
+    by the time limit, and the values are those of the best solution found, if any.
+    """
+    values: np.ndarray | None
+    objective: float | None
+    num_vars: int
+    num_constrs: int
+    solve_time: float
+    timed_out: bool = False
+
+
+# The Gurobi parameters of the stability analysis models, which are set once per environment
+GUROBI_PARAMS = {'IterationLimit': 1000000, 'MIPFocus': 1}
+
+
+class GurobiEnvPool:
+    """
+    A pool of Gurobi environments with the stability analysis parameters already set, which are created when they are
+    first needed and then reused, so that each model does not start an environment or set its parameters.
+    An environment must only be used by one thread at a time, so it is checked out of the pool while it is in use.
+    Each process has its own environments.
+    """
+
+    def __init__(self, params: dict | None = None):
+        """
+        :param params: The Gurobi parameters of the environments. If None, GUROBI_PARAMS is used.
+        """
+        self.params = GUROBI_PARAMS if params is None else params
+        self.lock = threading.Lock()
+        self.free_envs: list[gp.Env] = []
+        self.pid = os.getpid()
+
+    def acquire(self) -> gp.Env:
+        """
+        Checks out a free environment, or starts a new one if there are none.
+        """
+        with self.lock:
+            if self.pid != os.getpid():  # Environments cannot be used in forked processes
+                self.free_envs, self.pid = [], os.getpid()
+            if self.free_envs:
+                return self.free_envs.pop()
+        env = gp.Env(empty=True)
+        env.setParam('OutputFlag', 0)
+        for name, value in self.params.items():
+            env.setParam(name, value)
+        env.start()
+        return env
+
+    def release(self, env: gp.Env) -> None:
+        """
+        Returns an environment checked out by acquire to the pool. Its models must have been closed.
+        """
+        with self.lock:
+            if self.pid == os.getpid():
+                self.free_envs.append(env)
+
+    @contextlib.contextmanager
+    def env(self):
+        env = self.acquire()
+        try:
+            yield env
+        finally:
+            self.release(env)
+
+    def warm_up(self, n_envs: int) -> None:
+        """
+        Starts environments until the pool has at least n_envs free ones, e.g. one per worker thread of a service.
+        """
+        envs = [self.acquire() for _ in range(n_envs)]
+        for env in envs:
+            self.release(env)
+
+    def close(self) -> None:
+        """
+        Disposes of the free environments.
+        """
+        with self.lock:
+            for env in self.free_envs:
+                env.dispose()
+            self.free_envs = []
+
+
+gurobi_env_pool = GurobiEnvPool()
+
+
+def solve_gurobi(model: StabilityModel, print_log: bool = False, time_limit: float | None = None) -> StabilitySolution:
+    """
+    Solves the model exactly as formulated, as a nonconvex MIQCP with general constraints.
+    """
+    with gurobi_env_pool.env() as env, gp.Model("stability_analysis", env=env) as gp_model:
+        if print_log:
+            gp_model.setParam("OutputFlag", 1)
+        if time_limit is not None:
+            gp_model.setParam("TimeLimit", time_limit)
+        return _solve_gurobi(model, gp_model)
+
+
+def _solve_gurobi(model: StabilityModel, gp_model: gp.Model) -> StabilitySolution:
+    x = gp_model.addMVar(model.n_vars, lb=model.lb, vtype=GRB.CONTINUOUS)
+    gp_model.addMConstr(model.A, x, '=', model.rhs)
+    if len(model.pulling) > 0:
+        gp_model.addConstr(x[model.pulling] * x[model.pushing] == 0)
+
+    var_list = x.tolist()
+    for abs_results, abs_args, max_result, max_args in zip(model.abs_result, model.abs_arg, model.max_result,
+                                                           model.max_args):
+        for abs_result, abs_arg in zip(abs_results, abs_args):
+            gp_model.addGenConstrAbs(var_list[abs_result], var_list[abs_arg])
+        if len(max_args) > 0:
+            gp_model.addGenConstrMax(var_list[max_result], [var_list[i] for i in max_args])
+
+    objective_vars = np.nonzero(model.objective)[0]
+    gp_model.setObjective(gp.LinExpr(model.objective[objective_vars].tolist(),
+                                     [var_list[i] for i in objective_vars]))
+
+    t_solve_start = time.time()
+    gp_model.modelSense = GRB.MINIMIZE
+    gp_model.update()
+    gp_model.optimize()
+    solve_t = time.time() - t_solve_start
+
+    if gp_model.Status == GRB.Status.TIME_LIMIT:
+        if gp_model.SolCount == 0:
+            return StabilitySolution(None, None, gp_model.NumVars, gp_model.NumConstrs, solve_t, timed_out=True)
+        return StabilitySolution(x.X, gp_model.objVal, gp_model.NumVars, gp_model.NumConstrs, solve_t, timed_out=True)
+    if gp_model.Status != GRB.Status.OPTIMAL:
+        print('Model did not solve successfully. Check status code:', gp_model.Status)
+        return StabilitySolution(None, None, gp_model.NumVars, gp_model.NumConstrs, solve_t)
+    return StabilitySolution(x.X, gp_model.objVal, gp_model.NumVars, gp_model.NumConstrs, solve_t)
+
+
+def solve_highs(model: StabilityModel, print_log: bool = False, time_limit: float | None = None) -> StabilitySolution:
+    """
+    Solves the model as a linear program with HiGHS, which needs no license.
+    The complementarity constraints are dropped: if both forces at a connection point are positive,
+    reducing both by the same amount leaves every force and torque sum unchanged and strictly reduces the
+    objective, so they hold at any optimum anyway. The absolute values and maxima appear only in the minimized
+    objective, with positive coefficients, so they are modelled exactly by their linear upper bounds.
+    A solve stopped by the time limit has no solution, as the intermediate points of the LP solver are not feasible.
+    """
+    # x[abs_result] >= x[abs_arg] and x[abs_result] >= -x[abs_arg]
+    has_max = np.array([len(max_args) > 0 for max_args in model.max_args], dtype=bool)
+    abs_result, abs_arg = model.abs_result.ravel(), model.abs_arg.ravel()
+    max_args = np.concatenate([np.zeros(0, dtype=int)] + list(model.max_args))
+    max_result = np.repeat(model.max_result[has_max], [len(a) for a in model.max_args if len(a) > 0])
+    n_abs, n_max = len(abs_result), len(max_args)
+    ub_rows = np.concatenate([np.arange(2 * n_abs).repeat(2), 2 * n_abs + np.arange(n_max).repeat(2)])
+    ub_cols = np.concatenate([np.stack([abs_arg, abs_result, abs_arg, abs_result], axis=1).ravel(),
+                              np.stack([max_args, max_result], axis=1).ravel()])
+    ub_coefs = np.concatenate([np.tile([1.0, -1.0, -1.0, -1.0], n_abs), np.tile([1.0, -1.0], n_max)])
+    A_ub = sp.csr_matrix((ub_coefs, (ub_rows, ub_cols)), shape=(2 * n_abs + n_max, model.n_vars))
+
+    t_solve_start = time.time()
+    result = scipy.optimize.linprog(
+        model.objective,
+        A_ub=A_ub,
+        b_ub=np.zeros(A_ub.shape[0]),
+        A_eq=model.A,
+        b_eq=model.rhs,
+        bounds=np.stack([model.lb, np.full(model.n_vars, np.inf)], axis=1),
+        method='highs',
+        options={'disp': print_log} if time_limit is None else {'disp': print_log, 'time_limit': time_limit},
+    )
+    solve_t = time.time() - t_solve_start
+
+    num_constrs = model.A.shape[0] + A_ub.shape[0]
+    if result.status == 1 and result.message.startswith('Time limit reached'):  # Status 1 is also the iteration limit
+        return StabilitySolution(None, None, model.n_vars, num_constrs, solve_t, timed_out=True)
+    if result.status != 0:
+        print('Model did not solve successfully. Check status code:', result.status, result.message)
+        return StabilitySolution(None, None, model.n_vars, num_constrs, solve_t)
+    return StabilitySolution(result.x, result.fun, model.n_vars, num_constrs, solve_t)
+
+
+SOLVERS = {
+    'gurobi': solve_gurobi,
+    'highs': solve_highs,
+}
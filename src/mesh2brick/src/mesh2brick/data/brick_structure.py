@@ -7,6 +7,7 @@ import numpy as np
 
 from mesh2brick.data.brick_library import (brick_library, dimensions_to_brick_id, brick_id_to_dimensions,
                                            brick_id_to_part_id, part_id_to_brick_id)
+from mesh2brick.stability_analysis.incremental_stability import IncrementalStabilityModel
 from mesh2brick.stability_analysis.stability_analysis import StabilityConfig, stability_score
 
 
@@ -239,6 +240,8 @@ class ConnectivityBrickStructure:
         self._component_labels = None
         self._node2component = None
 
+        self._stability_model = None  # Kept between stability checks, which only update it with the changed bricks
+
     @property
     def max_x(self) -> int:
         return self.voxel_bricks.shape[0]
@@ -284,9 +287,22 @@ class ConnectivityBrickStructure:
                                     for node in component}
         return self._node2component
 
+    def close(self) -> None:
+        """
+        Frees the stability model, returning its Gurobi environment to the pool.
+        The structure can still be used, and the stability model is rebuilt by the next stability check.
+        """
+        if self._stability_model is not None:
+            self._stability_model.close()
+            self._stability_model = None
+
     def stability_score(self) -> np.ndarray:
-        bricks = BrickStructure(list(self.bricks.values()))
-        return bricks.stability_scores()
+        if self._stability_model is None:
+            self._stability_model = IncrementalStabilityModel(
+                brick_library, StabilityConfig(world_dimension=self.voxel_bricks.shape))
+        self._stability_model.set_bricks({node: brick.to_json() for node, brick in self.bricks.items()})
+        scores, _, _, _, _ = self._stability_model.solve()
+        return scores
 
     def node_exists(self, node_id: int):
         return node_id in self.bricks
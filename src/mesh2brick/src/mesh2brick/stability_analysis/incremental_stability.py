@@ -0,0 +1,367 @@
+import time
+from dataclasses import dataclass, field
+from typing import Hashable
+
+import gurobipy as gp
+import numpy as np
+from gurobipy import GRB
+
+from .stability_analysis import (StabilityConfig, _SKIPPED_BRICK_IDS, _BRICK_VARS, _N_SIGNED_BRICK_VARS,
+                                 _BRICK_CONSTRS, _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS, _OPPOSITE,
+                                 _brick_grid, _brick_scores, _connectivity_scores)
+from .solvers import gurobi_env_pool
+
+# Brick sums that each connection force is added to, by the direction of the force: x_pos, x_neg, y_pos, y_neg
+_PRESS_FORCES = ('force_sum_x_pos', 'force_sum_x_neg', 'force_sum_y_pos', 'force_sum_y_neg')
+_TOP_PRESS_TORQUES = ('torque_sum_2_pos', 'torque_sum_2_neg', 'torque_sum_1_neg', 'torque_sum_1_pos')
+_BOTTOM_PRESS_TORQUES = ('torque_sum_2_neg', 'torque_sum_2_pos', 'torque_sum_1_pos', 'torque_sum_1_neg')
+_EXTERNAL_TORQUES = _BOTTOM_PRESS_TORQUES
+
+_HORIZONTAL_STEPS = ((-1, 0), (1, 0), (0, -1), (0, 1))  # Steps to the adjacent voxel in each direction
+
+
+@dataclass
+class _Brick:
+    x: int
+    y: int
+    z: int
+    h: int
+    w: int
+    weight: float
+    four_pt: bool
+    vars: dict[str, gp.Var] = field(default_factory=dict)
+    constrs: dict[str, gp.Constr] = field(default_factory=dict)
+    gen_constrs: list[gp.GenConstr] = field(default_factory=list)
+    max_constr: gp.GenConstr | None = None
+    contacts: set[tuple] = field(default_factory=set)
+    f_down: dict[tuple, list[gp.Var]] = field(default_factory=dict)  # Pushing forces from below, by contact
+
+    def voxels(self):
+        return ((i, j) for i in range(self.x, self.x + self.h) for j in range(self.y, self.y + self.w))
+
+    def offset(self, i: int, j: int) -> tuple[float, float]:
+        """
+        Returns the offset (dx, dy) of voxel (i, j) from the centre of the brick, in brick unit lengths.
+        """
+        return i - (self.x + (self.h - 1) / 2), j - (self.y + (self.w - 1) / 2)
+
+    def arms(self, i: int, j: int, n_pts: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the torque arms of the points of a knob connection at voxel (i, j) of the brick.
+        """
+        offsets = _FOUR_PT_OFFSETS if n_pts == 4 else _THREE_PT_OFFSETS
+        dx, dy = self.offset(i, j)
+        return dy + offsets[:n_pts, 0], dx + offsets[:n_pts, 1]
+
+
+@dataclass
+class _Contact:
+    bricks: tuple[Hashable, ...]
+    vars: list[gp.Var]
+    q_constrs: list[gp.QConstr]
+
+
+class IncrementalStabilityModel:
+    """
+    A stability analysis model which is kept between solves, for structures that change by a few bricks at a time.
+    Adding or removing a brick only adds or removes the variables and constraints of the brick and its contacts,
+    and each solve is warm-started from the previous solution.
+    The model is equivalent to the one built by stability_score, except that the objective terms are set directly
+    on the variables, and the two sides of each connection share their variables. It is not thread-safe.
+    """
+
+    def __init__(self, brick_library: dict, cfg: StabilityConfig = StabilityConfig()):
+        if cfg.solver != 'gurobi':
+            raise ValueError(f'Incremental stability analysis is only supported with Gurobi, not {cfg.solver}.')
+        self.brick_library = brick_library
+        self.cfg = cfg
+
+        self.env = gurobi_env_pool.acquire()  # Checked out for the lifetime of the model
+        self.model = gp.Model('stability_analysis', env=self.env)
+        if cfg.print_log:
+            self.model.setParam('OutputFlag', 1)
+
+        self.brick_jsons = {}  # Maps the key of each brick to its JSON, including bricks that are not analysed
+        self.bricks: dict[Hashable, _Brick] = {}
+        self.contacts: dict[tuple, _Contact] = {}
+        self.voxel_grid = np.full(cfg.world_dimension, None, dtype=object)  # The key of the brick at each voxel
+        self.big_num = None  # Bound on the force and torque sums, which depends on the number of bricks
+        self.stale_max_constrs = set()  # Keys of the bricks whose maximum pulling force must be constrained again
+        self.has_pending_additions = False
+
+    def __len__(self):
+        return len(self.brick_jsons)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.brick_jsons
+
+    def close(self) -> None:
+        self.model.close()
+        gurobi_env_pool.release(self.env)
+
+    def set_bricks(self, brick_structure: dict) -> None:
+        """
+        Updates the model to the given brick structure, in the same format as for stability_score,
+        by removing the bricks whose key is missing or whose brick has changed, and adding the new ones.
+        """
+        for key in [key for key, brick in self.brick_jsons.items() if brick_structure.get(key) != brick]:
+            self.remove_brick(key)
+        for key, brick in brick_structure.items():
+            if key not in self.brick_jsons:
+                self.add_brick(key, brick)
+
+    def add_brick(self, key: Hashable, brick: dict) -> None:
+        """
+        :param key: A key identifying the brick, to remove it later.
+        :param brick: The brick, in the same format as the values of the brick structure for stability_score.
+        """
+        if key in self.brick_jsons:
+            raise ValueError(f'A brick with key {key} has already been added.')
+        brick_id = str(brick['brick_id'])
+        if brick_id in _SKIPPED_BRICK_IDS:
+            self.brick_jsons[key] = brick
+            return
+
+        h, w = self.brick_library[brick_id]['height'], self.brick_library[brick_id]['width']
+        if brick['ori'] != 0:
+            h, w = w, h
+        b = _Brick(brick['x'], brick['y'], brick['z'], h, w, self.brick_library[brick_id]['mass'] * self.cfg.g,
+                   min(h, w) < 2)
+        if any(self.voxel_grid[i, j, b.z] is not None for i, j in b.voxels()):
+            raise ValueError(f'Cannot add brick {key} due to collisions.')
+        self.brick_jsons[key] = brick
+        self.bricks[key] = b
+        self.voxel_grid[b.x:b.x + b.h, b.y:b.y + b.w, b.z] = key
+        self.has_pending_additions = True
+        self._add_brick_vars(b)
+
+        # Add the contacts with the adjacent bricks and the ground
+        above = set()
+        for i, j in b.voxels():
+            for d, (di, dj) in enumerate(_HORIZONTAL_STEPS):
+                other = self._brick_at(i + di, j + dj, b.z)
+                if other is not None and other != key:
+                    self._add_external_contact(key, (i, j, b.z), d, other)
+            if b.z == 0:
+                self._add_vertical_contact(None, key, (i, j, b.z))
+            elif (other := self._brick_at(i, j, b.z - 1)) is not None:
+                self._add_vertical_contact(other, key, (i, j, b.z))
+            if (other := self._brick_at(i, j, b.z + 1)) is not None:
+                self._add_vertical_contact(key, other, (i, j, b.z + 1))
+                above.add(other)
+
+        for other in above | {key}:
+            self._invalidate_max_constr(other)
+
+    def remove_brick(self, key: Hashable) -> None:
+        brick = self.brick_jsons.pop(key)
+        if str(brick['brick_id']) in _SKIPPED_BRICK_IDS:
+            return
+
+        if self.has_pending_additions:  # Gurobi cannot remove what has not been added to the model yet
+            self.model.update()
+            self.has_pending_additions = False
+        for contact in self.bricks[key].contacts:
+            if contact[0] == 'vertical' and self.contacts[contact].bricks[0] == key:
+                self._invalidate_max_constr(self.contacts[contact].bricks[1])
+        self._invalidate_max_constr(key)
+        self.stale_max_constrs.discard(key)
+        b = self.bricks.pop(key)
+        self.model.remove(b.gen_constrs)
+
+        for contact_key in list(b.contacts):
+            contact = self.contacts.pop(contact_key)
+            for other in contact.bricks:
+                if other is not None and other != key:
+                    self.bricks[other].contacts.discard(contact_key)
+                    self.bricks[other].f_down.pop(contact_key, None)
+            self.model.remove(contact.q_constrs)
+            self.model.remove(contact.vars)
+        self.model.remove(list(b.constrs.values()))
+        self.model.remove(list(b.vars.values()))
+        self.voxel_grid[b.x:b.x + b.h, b.y:b.y + b.w, b.z] = None
+
+    def solve(self, return_path: bool = False) -> tuple:
+        """
+        Solves the model for the current brick structure, starting from the previous solution.
+        :return: The same as stability_score, including if cfg.time_limit runs out.
+        """
+        result = self._solve()
+        return result if return_path else result[:5]
+
+    def _solve(self) -> tuple:
+        cfg = self.cfg
+        world_dim = cfg.world_dimension
+        t_start = time.time()
+
+        big_num = 100 * len(self.brick_jsons)
+        if big_num != self.big_num:
+            signed_vars = [b.vars[name] for b in self.bricks.values() for name in _BRICK_VARS[:_N_SIGNED_BRICK_VARS]]
+            self.model.setAttr('LB', signed_vars, [-big_num] * len(signed_vars))
+            self.big_num = big_num
+        for key in self.stale_max_constrs:
+            self._add_max_constr(self.bricks[key])
+        self.stale_max_constrs.clear()
+
+        self.model.modelSense = GRB.MINIMIZE
+        if cfg.time_limit is not None:
+            self.model.setParam('TimeLimit', max(cfg.time_limit - (time.time() - t_start), 0))
+        self.model.update()
+        self.has_pending_additions = False
+        t_solve_start = time.time()
+        self.model.optimize()
+        solve_t = time.time() - t_solve_start
+        total_t = time.time() - t_start
+        num_vars, num_constr = self.model.NumVars, self.model.NumConstrs
+
+        timed_out = self.model.Status == GRB.Status.TIME_LIMIT
+        if timed_out and (self.model.SolCount == 0 or cfg.time_limit_fallback == 'connectivity'):
+            scores = _connectivity_scores(self.brick_jsons, self.brick_library, world_dim)
+            return scores, num_vars, num_constr, total_t, solve_t, 'connectivity'
+        if self.model.Status != GRB.Status.OPTIMAL and not timed_out:
+            print('Model did not solve successfully. Check status code:', self.model.Status)
+            return np.ones(world_dim), num_vars, num_constr, total_t, solve_t, 'failed'
+
+        # Warm-start the next solve from this solution
+        all_vars = self.model.getVars()
+        self.model.setAttr('Start', all_vars, self.model.getAttr('X', all_vars))
+
+        # Read the solution values of all bricks at once
+        bricks = list(self.bricks.values())
+        f_down_vars = [var for b in bricks for vars_ in b.f_down.values() for var in vars_]
+        f_down_brick = np.repeat(np.arange(len(bricks)), [sum(map(len, b.f_down.values())) for b in bricks])
+        abs_vars = [b.vars[name] for b in bricks for name in _BRICK_VARS[_N_SIGNED_BRICK_VARS:-1]]
+        values = np.array(self.model.getAttr('X', f_down_vars + abs_vars))
+        T_ = cfg.T / 1000 * cfg.g
+        scores = _brick_scores(T_, values[:len(f_down_vars)], f_down_brick,
+                               values[len(f_down_vars):].reshape(-1, len(_BRICK_VARS) - _N_SIGNED_BRICK_VARS - 1), len(bricks))
+
+        brick_x, brick_y, brick_z, brick_h, brick_w = (
+            np.array([getattr(b, name) for b in bricks], dtype=int) for name in ('x', 'y', 'z', 'h', 'w'))
+        brick_grid = _brick_grid(brick_x, brick_y, brick_z, brick_h, brick_w, world_dim)
+        analysis_score = np.append(scores, 0.0)[brick_grid]  # Voxels without a brick (-1) are 0
+        if cfg.print_log:
+            print('Obj Val:', self.model.objVal)
+            print('Num bricks: ', len(self.brick_jsons))
+            print('Total solve time: ', total_t, ' Optimization Solve Time: ', solve_t)
+
+        path = 'incumbent' if timed_out else 'optimal'
+        return analysis_score, num_vars, num_constr, total_t, solve_t, path
+
+    def _brick_at(self, i: int, j: int, k: int) -> Hashable | None:
+        if not all(0 <= c < dim for c, dim in zip((i, j, k), self.voxel_grid.shape)):
+            return None
+        return self.voxel_grid[i, j, k]
+
+    def _add_brick_vars(self, b: _Brick) -> None:
+        """
+        Adds the force and torque sums of the brick, and their absolute values and the maximum pulling force.
+        """
+        for i, name in enumerate(_BRICK_VARS):
+            if i < _N_SIGNED_BRICK_VARS:
+                b.vars[name] = self.model.addVar(lb=-100 * len(self.brick_jsons), vtype=GRB.CONTINUOUS)
+            else:
+                obj = self.cfg.alpha if name == 'brick_max_f_down' else 1.0
+                b.vars[name] = self.model.addVar(lb=0.0, obj=obj, vtype=GRB.CONTINUOUS)
+        self.big_num = None
+
+        # Torques due to the weight of each voxel
+        voxel_weight = b.weight / (b.h * b.w)
+        dx, dy = np.array([b.offset(i, j) for i, j in b.voxels()]).T
+        constants = {'torque_sum_1_neg': dy.sum() * self.cfg.brick_unit_length * voxel_weight,
+                     'torque_sum_2_pos': dx.sum() * self.cfg.brick_unit_length * voxel_weight,
+                     'force_sum_z': -b.weight}
+        for name in _BRICK_CONSTRS:
+            rhs = constants.get(name, 0.0)
+            if name.endswith(('_pos', '_neg')):  # Terms are added with the contacts
+                b.constrs[name] = self.model.addLConstr(b.vars[name], GRB.EQUAL, rhs)
+            else:
+                b.constrs[name] = self.model.addLConstr(
+                    b.vars[name] - b.vars[name + '_pos'] + b.vars[name + '_neg'], GRB.EQUAL, rhs)
+
+        for name in ('force_sum_x', 'force_sum_y', 'force_sum_z', 'torque_sum_1', 'torque_sum_2'):
+            b.gen_constrs.append(self.model.addGenConstrAbs(b.vars[name.replace('_sum', '_abs_sum')], b.vars[name]))
+
+    def _add_var(self, terms: list[tuple[_Brick, str, float]], obj: float = 0.0) -> gp.Var:
+        """
+        Adds a nonnegative connection force, with the given coefficients in the sums of the given bricks.
+        """
+        column = gp.Column([-coef for _, _, coef in terms], [b.constrs[name] for b, name, _ in terms])
+        return self.model.addVar(lb=0.0, obj=obj, vtype=GRB.CONTINUOUS, column=column)
+
+    def _add_contact(self, contact_key: tuple, bricks: tuple, vars_: list[gp.Var], q_constrs: list[gp.QConstr]):
+        self.contacts[contact_key] = _Contact(bricks, vars_, q_constrs)
+        for key in bricks:
+            if key is not None:
+                self.bricks[key].contacts.add(contact_key)
+
+    def _add_external_contact(self, key: Hashable, voxel: tuple[int, int, int], d: int, other: Hashable) -> None:
+        """
+        Adds the horizontal press between the voxel of one brick and the adjacent voxel of another in direction d.
+        """
+        half_height = self.cfg.brick_unit_height / 2
+        b, o = self.bricks[key], self.bricks[other]
+        press = self._add_var([(b, _PRESS_FORCES[d], 1.0), (b, _EXTERNAL_TORQUES[d], half_height),
+                               (o, _PRESS_FORCES[_OPPOSITE[d]], 1.0), (o, _EXTERNAL_TORQUES[_OPPOSITE[d]], half_height)])
+        self._add_contact(('external', voxel, d), (key, other), [press], [])
+
+    def _add_vertical_contact(self, lower: Hashable | None, upper: Hashable, voxel: tuple[int, int, int]) -> None:
+        """
+        Adds the connection between the bottom of a voxel of the upper brick and the top of the voxel below,
+        which belongs to the lower brick, or to the ground if lower is None.
+        """
+        cfg = self.cfg
+        half_height = cfg.brick_unit_height / 2
+        i, j, _ = voxel
+        u = self.bricks[upper]
+        l = self.bricks[lower] if lower is not None else None
+        n_pts = 4 if u.four_pt else 3
+
+        # Horizontal presses, by their direction on the upper brick
+        vars_ = []
+        for d in range(4):
+            terms = [(u, _PRESS_FORCES[d], 1.0), (u, _BOTTOM_PRESS_TORQUES[d], half_height)]
+            if l is not None:
+                terms += [(l, _PRESS_FORCES[_OPPOSITE[d]], 1.0), (l, _TOP_PRESS_TORQUES[_OPPOSITE[d]], half_height)]
+            vars_.append(self._add_var(terms))
+
+        # Pushing (f) and pulling (n) forces at each point, as seen from the upper brick
+        u_arm_1, u_arm_2 = u.arms(i, j, n_pts)
+        if l is not None:
+            l_arm_1, l_arm_2 = l.arms(i, j, n_pts)
+        f_down, q_constrs = [], []
+        for k in range(n_pts):
+            f_terms = [(u, 'force_sum_z_neg', 1.0), (u, 'torque_sum_1_neg', u_arm_1[k] * cfg.brick_unit_length),
+                       (u, 'torque_sum_2_pos', u_arm_2[k] * cfg.brick_unit_length)]
+            n_terms = [(u, 'force_sum_z_pos', 1.0), (u, 'torque_sum_1_pos', u_arm_1[k] * cfg.brick_unit_length),
+                       (u, 'torque_sum_2_neg', u_arm_2[k] * cfg.brick_unit_length)]
+            if l is not None:
+                f_terms += [(l, 'force_sum_z_pos', 1.0), (l, 'torque_sum_1_pos', l_arm_1[k] * cfg.brick_unit_length),
+                            (l, 'torque_sum_2_neg', l_arm_2[k] * cfg.brick_unit_length)]
+                n_terms += [(l, 'force_sum_z_neg', 1.0), (l, 'torque_sum_1_neg', l_arm_1[k] * cfg.brick_unit_length),
+                            (l, 'torque_sum_2_pos', l_arm_2[k] * cfg.brick_unit_length)]
+            f = self._add_var(f_terms, obj=cfg.beta)
+            n = self._add_var(n_terms)
+            f_down.append(f)
+            vars_ += [f, n]
+            q_constrs.append(self.model.addQConstr(f * n == 0))
+
+        contact_key = ('vertical', voxel)
+        self._add_contact(contact_key, (lower, upper), vars_, q_constrs)
+        u.f_down[contact_key] = f_down
+
+    def _add_max_constr(self, b: _Brick) -> None:
+        f_down = [var for vars_ in b.f_down.values() for var in vars_]
+        if f_down:
+            b.max_constr = self.model.addGenConstrMax(b.vars['brick_max_f_down'], f_down)
+
+    def _invalidate_max_constr(self, key: Hashable) -> None:
+        """
+        Removes the constraint on the maximum pulling force of a brick whose pushing forces from below have changed.
+        It is added again before the next solve.
+        """
+        b = self.bricks[key]
+        if b.max_constr is not None:
+            self.model.remove(b.max_constr)
+            b.max_constr = None
+        self.stale_max_constrs.add(key)
@@ -1,9 +1,14 @@
+import functools
+import multiprocessing
 import time
-from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, replace
+from typing import Literal
 
-import gurobipy as gp
-from gurobipy import GRB
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
 
+from .solvers import SOLVERS, StabilityModel
 from .utils import *
 
 
@@ -18,466 +23,351 @@ class StabilityConfig:
     world_dimension: tuple[int, int, int] = (20, 20, 20)
     alpha: float = 0.001
     beta: float = 0.000001
+    solver: Literal['gurobi', 'highs'] = 'gurobi'  # 'highs' uses SciPy's HiGHS solver, which needs no license
+    split_components: bool = False  # Solve each connected component of the structure as a separate model
+    n_workers: int = 1  # Processes to solve the components in, for structures of at least parallel_min_bricks bricks
+    parallel_min_bricks: int = 100
+    time_limit: float | None = None  # Wall-clock seconds to score the structure in; see time_limit_fallback
+    time_limit_fallback: Literal['incumbent', 'connectivity'] = 'incumbent'  # The scores if the time limit runs out
+
+
+# How stability_score may compute the scores, from the most to the least accurate
+_PATHS = ('optimal', 'incumbent', 'connectivity', 'failed')
+
+
+# Brick IDs that are not analysed
+_SKIPPED_BRICK_IDS = ('0', '1', '13')
+
+# Per-brick variables, each a block of n_bricks variables in this order. The first 15 are signed.
+_BRICK_VARS = ('force_sum_x_pos', 'force_sum_x_neg', 'force_sum_x',
+               'force_sum_y_pos', 'force_sum_y_neg', 'force_sum_y',
+               'force_sum_z_pos', 'force_sum_z_neg', 'force_sum_z',
+               'torque_sum_1_pos', 'torque_sum_1_neg', 'torque_sum_1',
+               'torque_sum_2_pos', 'torque_sum_2_neg', 'torque_sum_2',
+               'force_abs_sum_x', 'force_abs_sum_y', 'force_abs_sum_z', 'torque_abs_sum_1', 'torque_abs_sum_2',
+               'brick_max_f_down')
+_N_SIGNED_BRICK_VARS = 15
+
+# Linear constraints on the per-brick variables, in the order in which they are added for each brick
+_BRICK_CONSTRS = ('force_sum_x_pos', 'force_sum_x_neg', 'force_sum_y_pos', 'force_sum_y_neg',
+                  'force_sum_z_pos', 'force_sum_z_neg', 'force_sum_x', 'force_sum_y', 'force_sum_z',
+                  'torque_sum_1_pos', 'torque_sum_1_neg', 'torque_sum_1',
+                  'torque_sum_2_pos', 'torque_sum_2_neg', 'torque_sum_2')
+
+# Constraints are added in the order of the voxels and then the bricks they belong to, so that the model is
+# identical to one built voxel by voxel. Within a voxel, they are ordered by these offsets.
+_EXTERNAL_ORDER, _TOP_ORDER, _BOTTOM_ORDER, _BRICK_ORDER = 0, 4, 16, 32
+_ORDER_STRIDE = 64
+
+# Offsets (y, x) in brick unit lengths of the points of a knob connection from the centre of the knob.
+# A 1xX brick makes a 4-pt connection, and a 2xX brick makes a 3-pt connection (padded to 4 points).
+_FOUR_PT_OFFSETS = np.array([[-0.25, 0], [0, -0.25], [0.25, 0], [0, 0.25]])
+_THREE_PT_OFFSETS = np.array([[-0.125, 0.125], [0, -0.25], [0.125, 0.125], [0, 0]])
+
+# Directions of horizontal presses: x_pos, x_neg, y_pos, y_neg
+_X_POS, _X_NEG, _Y_POS, _Y_NEG = range(4)
+_OPPOSITE = np.array([_X_NEG, _X_POS, _Y_NEG, _Y_POS])
+
+
+def stability_score(brick_structure, brick_library, cfg=StabilityConfig(), return_path=False):
+    """
+    Returns the stability score of each voxel, the number of variables and constraints of the model, the total time,
+    and the optimization solve time. If cfg.split_components, each connected component of the structure is solved
+    as a separate model, since bricks that are not in contact cannot transmit forces to each other. This gives the
+    same verdict of whether the structure is stable, but where the optimal forces are not unique, the score of a voxel
+    can differ from solving the whole structure, by up to 1, which can change which brick is the first unstable one.
+    If cfg.time_limit runs out before the solve is optimal, the scores are computed from the best solution found so far
+    if cfg.time_limit_fallback == 'incumbent' and there is one, and otherwise from the connectivity of the bricks to
+    the ground, as by connectivity_score.
+    :param return_path: Whether to also return how the scores were computed: 'optimal', 'incumbent' (from the best
+                        solution found in the time limit), 'connectivity', or 'failed' (every voxel is unstable).
+    """
+    result = _split_stability_score(brick_structure, brick_library, cfg)
+    return result if return_path else result[:5]
+
+
+def _split_stability_score(brick_structure, brick_library, cfg):
+    if not cfg.split_components:
+        return _stability_score(brick_structure, brick_library, cfg, len(brick_structure))
 
-
-def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
+    t_start = time.time()
+    keys, brick_x, brick_y, brick_z, brick_h, brick_w, _ = _brick_arrays(brick_structure, brick_library, cfg.g)
+    parallel = cfg.n_workers > 1 and len(keys) >= cfg.parallel_min_bricks
+    if cfg.solver == 'highs' and not parallel:  # The LP solves as fast as a whole, without the overhead per model
+        return _stability_score(brick_structure, brick_library, cfg, len(brick_structure))
+    n_components, labels = _connected_components(brick_x, brick_y, brick_z, brick_h, brick_w, cfg.world_dimension)
+    if n_components <= 1:
+        return _stability_score(brick_structure, brick_library, cfg, len(brick_structure))
+
+    # Keys must be consecutive from 1 within each component, as they index the bricks in the model
+    components = [{str(i + 1): brick_structure[keys[b]] for i, b in enumerate(np.nonzero(labels == c)[0])}
+                  for c in range(n_components)]
+    args = [(component, brick_library, cfg, len(brick_structure)) for component in components]
+    if parallel:
+        results = list(_process_pool(cfg.n_workers).map(_stability_score, *zip(*args)))
+    elif cfg.time_limit is not None:  # The components share the time limit
+        deadline = t_start + cfg.time_limit
+        results = [_stability_score(component, brick_library, replace(cfg, time_limit=max(deadline - time.time(), 0)),
+                                    len(brick_structure)) for component in components]
+    else:
+        results = [_stability_score(*a) for a in args]
+
+    scores = np.max([result[0] for result in results], axis=0)
+    num_vars = sum(result[1] for result in results)
+    num_constr = sum(result[2] for result in results)
+    solve_t = sum(result[4] for result in results)
+    path = max((result[5] for result in results), key=_PATHS.index)
+    return scores, num_vars, num_constr, time.time() - t_start, solve_t, path
+
+
+def _stability_score(brick_structure, brick_library, cfg, n_structure_bricks):
+    """
+    Solves the stability of the given bricks as one model.
+    :param n_structure_bricks: The number of bricks in the whole structure, which the bounds on the force and torque
+                               sums are scaled by, so that solving a component gives the same result as a whole.
+    """
     ############### Setup ###############
-    brick_library = brick_library
     g_ = cfg.g  # N/kg
     T_ = cfg.T / 1000 * g_  # N
     brick_unit_height = cfg.brick_unit_height  # mm
     brick_unit_length = cfg.brick_unit_length  # mm
     print_log = cfg.print_log
+    solve = SOLVERS[cfg.solver]
     world_dim = cfg.world_dimension
     alpha = cfg.alpha
     beta = cfg.beta
 
-    world_grid = construct_world_grid(brick_structure, world_dim, brick_library)
     n_bricks = len(brick_structure)
     t_start = time.time()
 
-    ############### Setup Optimization ###############
-    model = gp.Model("stability_analysis")
-    model.setParam("OutputFlag", print_log)
-    model.Params.IterationLimit = 1000000
-    model.setParam("MIPFocus", 1)
-    big_num = 100 * n_bricks
-
-    # Define variables
-    force_sum_x_pos = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_x_pos")
-    force_sum_x_neg = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_x_neg")
-    force_sum_x = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_x")
-    force_sum_y_pos = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_y_pos")
-    force_sum_y_neg = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_y_neg")
-    force_sum_y = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_y")
-    force_sum_z_pos = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_z_pos")
-    force_sum_z_neg = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_z_neg")
-    force_sum_z = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="force_sum_z")
-    torque_sum_1_pos = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="torque_sum_1_pos")
-    torque_sum_1_neg = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="torque_sum_1_neg")
-    torque_sum_1 = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="torque_sum_1")
-    torque_sum_2_pos = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="torque_sum_2_pos")
-    torque_sum_2_neg = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="torque_sum_2_neg")
-    torque_sum_2 = model.addVars(n_bricks, lb=-big_num, vtype=gp.GRB.CONTINUOUS, name="torque_sum_2")
-    force_abs_sum_x = model.addVars(n_bricks, vtype=gp.GRB.CONTINUOUS, name="force_abs_sum_x")
-    force_abs_sum_y = model.addVars(n_bricks, vtype=gp.GRB.CONTINUOUS, name="force_abs_sum_y")
-    force_abs_sum_z = model.addVars(n_bricks, vtype=gp.GRB.CONTINUOUS, name="force_abs_sum_z")
-    torque_abs_sum_1 = model.addVars(n_bricks, vtype=gp.GRB.CONTINUOUS, name="torque_abs_sum_1")
-    torque_abs_sum_2 = model.addVars(n_bricks, vtype=gp.GRB.CONTINUOUS, name="torque_abs_sum_2")
-    brick_max_f_down = model.addVars(n_bricks, vtype=gp.GRB.CONTINUOUS, name="brick_max_f_down")
-
-    force_dict = dict()
-    sum_f_list = []
-    for key in brick_structure.keys():
-        brick = brick_structure[key]
-        brick_id = str(brick["brick_id"])
-        if brick_id == "0" or brick_id == "1" or brick_id == "13":
-            continue
-        if brick["ori"] == 0:
-            h = brick_library[brick_id]["height"]
-            w = brick_library[brick_id]["width"]
-        else:
-            w = brick_library[brick_id]["height"]
-            h = brick_library[brick_id]["width"]
-        brick_x = brick["x"]
-        brick_y = brick["y"]
-        brick_z = brick["z"]
-        if min(w, h) < 2:
-            four_pt_connections = 1
-        else:
-            four_pt_connections = 0
-        for x in range(brick_x, brick_x + h):
-            for y in range(brick_y, brick_y + w):
-                force_key = gen_key(x, y, brick_z)
-                if force_key not in force_dict.keys():
-                    force_dict[force_key] = dict()
-                force_dict[force_key]["four_pt_connection"] = four_pt_connections
-                force_dict[force_key]["brick_id"] = brick_id
-
-                # Horizontal force from adjacent bricks
-                if (out_boundary([x - 1, y], brick_x, brick_y, h, w) and x - 1 >= 0 and world_grid[
-                    x - 1, y, brick_z] == 1):
-                    force_dict[force_key]["external_x_pos"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                           name=force_key + "_external_x_pos")
-                if (out_boundary([x + 1, y], brick_x, brick_y, h, w) and x + 1 < world_dim[0] and world_grid[
-                    x + 1, y, brick_z] == 1):
-                    force_dict[force_key]["external_x_neg"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                           name=force_key + "_external_x_neg")
-                if (out_boundary([x, y - 1], brick_x, brick_y, h, w) and y - 1 >= 0 and world_grid[
-                    x, y - 1, brick_z] == 1):
-                    force_dict[force_key]["external_y_pos"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                           name=force_key + "_external_y_pos")
-                if (out_boundary([x, y + 1], brick_x, brick_y, h, w) and y + 1 < world_dim[1] and world_grid[
-                    x, y + 1, brick_z] == 1):
-                    force_dict[force_key]["external_y_neg"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                           name=force_key + "_external_y_neg")
-
-    # Construct force variables.
-    # for i in range(world_dim[0]):
-    #     for j in range(world_dim[1]):
-    #         for k in range(world_dim[2]):
-    for key in brick_structure.keys():
-        brick = brick_structure[key]
-        brick_id = str(brick["brick_id"])
-        if brick_id == "0" or brick_id == "1" or brick_id == "13":
-            continue
-        if brick["ori"] == 0:
-            h = brick_library[brick_id]["height"]
-            w = brick_library[brick_id]["width"]
-        else:
-            w = brick_library[brick_id]["height"]
-            h = brick_library[brick_id]["width"]
+    ############### Bricks and voxels ###############
+    keys, brick_x, brick_y, brick_z, brick_h, brick_w, brick_weight = _brick_arrays(brick_structure, brick_library, g_)
+    brick_idx = np.array([int(key) - 1 for key in keys], dtype=int)
+    brick_four_pt = np.minimum(brick_h, brick_w) < 2
+
+    # Voxels of each brick in order, iterating over x and then y
+    sizes = brick_h * brick_w
+    vb = np.repeat(np.arange(len(brick_idx)), sizes)  # Index of the brick of each voxel
+    local = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    vi = brick_x[vb] + local // brick_w[vb]
+    vj = brick_y[vb] + local % brick_w[vb]
+    vk = brick_z[vb]
+    n_voxels = len(vb)
+    voxel_grid = np.full(world_dim, -1)
+    voxel_grid[vi, vj, vk] = np.arange(n_voxels)
+    four_pt = brick_four_pt[vb]
+
+    # Contacts with horizontally adjacent bricks, and with the bricks above and below
+    neighbours = np.stack([_neighbours(voxel_grid, vi - 1, vj, vk), _neighbours(voxel_grid, vi + 1, vj, vk),
+                           _neighbours(voxel_grid, vi, vj - 1, vk), _neighbours(voxel_grid, vi, vj + 1, vk)], axis=1)
+    on_face = np.stack([vi == brick_x[vb], vi == brick_x[vb] + brick_h[vb] - 1,
+                        vj == brick_y[vb], vj == brick_y[vb] + brick_w[vb] - 1], axis=1)
+    has_external = on_face & (neighbours >= 0)
+    above = _neighbours(voxel_grid, vi, vj, vk + 1)
+    below = _neighbours(voxel_grid, vi, vj, vk - 1)
+    has_top = above >= 0
+    has_bottom = (vk == 0) | (below >= 0)
+    n_top_pts = np.where(has_top & four_pt[above], 4, 3)
+    n_bottom_pts = np.where(four_pt, 4, 3)
+
+    ############### Variable indices ###############
+    # Variables are laid out as: the per-brick variables, then the horizontal presses from adjacent bricks of each
+    # voxel, then the top and bottom connection forces of each voxel, then the objective terms.
+    n_brick_vars = len(_BRICK_VARS) * n_bricks
+    brick_var = {name: i * n_bricks + brick_idx for i, name in enumerate(_BRICK_VARS)}  # Of the analysed bricks
+
+    external = n_brick_vars + np.cumsum(has_external.ravel()).reshape(n_voxels, 4) - 1
+    n_external = int(has_external.sum())
+
+    pts = np.arange(4)
+    top_counts = np.where(has_top, 4 + 2 * n_top_pts, 0)
+    bottom_counts = np.where(has_bottom, 4 + 2 * n_bottom_pts, 0)
+    voxel_counts = top_counts + bottom_counts
+    top_start = n_brick_vars + n_external + np.cumsum(voxel_counts) - voxel_counts
+    bottom_start = top_start + top_counts
+    top_press = top_start[:, None] + pts  # x_pos, x_neg, y_pos, y_neg
+    f_up = top_start[:, None] + 4 + pts
+    n_down = f_up + n_top_pts[:, None]
+    top_pt_mask = has_top[:, None] & (pts < n_top_pts[:, None])
+    bottom_press = bottom_start[:, None] + pts
+    f_down = bottom_start[:, None] + 4 + pts
+    n_up = f_down + n_bottom_pts[:, None]
+    bottom_pt_mask = has_bottom[:, None] & (pts < n_bottom_pts[:, None])
+
+    eq_obj = n_brick_vars + n_external + int(voxel_counts.sum())
+    has_f_down = bool(bottom_pt_mask.any())
+    sum_f_up, sum_brick_max_f_down = eq_obj + 1, eq_obj + 2
+    n_vars = eq_obj + (3 if has_f_down else 1)
 
-        brick_x = brick["x"]
-        brick_y = brick["y"]
-        brick_z = brick["z"]
-        for i in range(brick_x, brick_x + h):
-            for j in range(brick_y, brick_y + w):
-                k = brick_z
-                if world_grid[i, j, k] == 0:  # No brick exists
-                    continue
-                force_key = gen_key(i, j, k)
-                # Top knob is connected
-                if k < world_dim[2] - 1 and world_grid[i, j, k + 1] != 0:
-                    force_key_top = gen_key(i, j, k + 1)
-                    top_four_pt_connections = force_dict[force_key_top]["four_pt_connection"]
-
-                    # Horizontal knob presses due to connection in 4 directions
-                    force_dict[force_key]["top_x_pos"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_top_x_pos")
-                    force_dict[force_key]["top_x_neg"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_top_x_neg")
-                    force_dict[force_key]["top_y_pos"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_top_y_pos")
-                    force_dict[force_key]["top_y_neg"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_top_y_neg")
-
-                    # Top is connected to a 2xX brick, 3-pt connection
-                    if top_four_pt_connections == 0:
-                        force_dict[force_key]["f_up"] = model.addVars(3, vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_f_up")
-                        force_dict[force_key]["n_down"] = model.addVars(3, vtype=gp.GRB.CONTINUOUS,
-                                                                        name=force_key + "_n_down")
-                    # Top is connected to a 1xX brick, 4-pt connection
-                    else:
-                        force_dict[force_key]["f_up"] = model.addVars(4, vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_f_up")
-                        force_dict[force_key]["n_down"] = model.addVars(4, vtype=gp.GRB.CONTINUOUS,
-                                                                        name=force_key + "_n_down")
-                # Bottom cavity is connected
-                if k == 0 or world_grid[i, j, k - 1] != 0:
-                    cur_four_pt_connections = force_dict[force_key]["four_pt_connection"]
-
-                    # Horizontal knob presses due to connection in 4 directions
-                    force_dict[force_key]["bottom_x_pos"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                         name=force_key + "_bottom_x_pos")
-                    force_dict[force_key]["bottom_x_neg"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                         name=force_key + "_bottom_x_neg")
-                    force_dict[force_key]["bottom_y_pos"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                         name=force_key + "_bottom_y_pos")
-                    force_dict[force_key]["bottom_y_neg"] = model.addVar(vtype=gp.GRB.CONTINUOUS,
-                                                                         name=force_key + "_bottom_y_neg")
-
-                    # Brick is a 2xX brick, 3-pt connection
-                    if cur_four_pt_connections == 0:
-                        force_dict[force_key]["f_down"] = model.addVars(3, vtype=gp.GRB.CONTINUOUS,
-                                                                        name=force_key + "_f_down")
-                        force_dict[force_key]["n_up"] = model.addVars(3, vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_n_up")
-                    # Brick is a 1xX brick, 4-pt connection
-                    else:
-                        force_dict[force_key]["f_down"] = model.addVars(4, vtype=gp.GRB.CONTINUOUS,
-                                                                        name=force_key + "_f_down")
-                        force_dict[force_key]["n_up"] = model.addVars(4, vtype=gp.GRB.CONTINUOUS,
-                                                                      name=force_key + "_n_up")
-
-    # Setup Constraints
-    for key in brick_structure.keys():
-        brick = brick_structure[key]
-        brick_id = str(brick["brick_id"])
-        if brick_id == "0" or brick_id == "1" or brick_id == "13":
-            continue
-        if brick["ori"] == 0:
-            h = brick_library[brick_id]["height"]
-            w = brick_library[brick_id]["width"]
+    ############### Setup Optimization ###############
+    big_num = 100 * n_structure_bricks
+    lb = np.zeros(n_vars)
+    lb[:_N_SIGNED_BRICK_VARS * n_bricks] = -big_num
+
+    ############### Constraints ###############
+    rows = _SparseRows()
+    voxel_order = np.arange(n_voxels)[:, None] * _ORDER_STRIDE
+
+    # Horizontal presses between adjacent bricks are equal and opposite
+    v, d = np.nonzero(has_external)
+    rows.add_equal(external[v, d], external[neighbours[v, d], _OPPOSITE[d]],
+                   voxel_order[v, 0] + _EXTERNAL_ORDER + d)
+
+    # Forces between a top knob and the bottom cavity of the brick above are equal and opposite, and vice versa
+    v = np.nonzero(has_top)[0]
+    rows.add_equal(top_press[v], bottom_press[above[v]][:, _OPPOSITE], voxel_order[v] + _TOP_ORDER + pts)
+    v, k = np.nonzero(top_pt_mask)
+    rows.add_equal(f_up[v, k], f_down[above[v], k], voxel_order[v, 0] + _TOP_ORDER + 4 + 2 * k)
+    rows.add_equal(n_down[v, k], n_up[above[v], k], voxel_order[v, 0] + _TOP_ORDER + 5 + 2 * k)
+    v = np.nonzero(has_bottom & (vk > 0))[0]
+    rows.add_equal(bottom_press[v], top_press[below[v]][:, _OPPOSITE], voxel_order[v] + _BOTTOM_ORDER + pts)
+    v, k = np.nonzero(bottom_pt_mask & (vk > 0)[:, None])
+    rows.add_equal(f_down[v, k], f_up[below[v], k], voxel_order[v, 0] + _BOTTOM_ORDER + 4 + 2 * k)
+    rows.add_equal(n_up[v, k], n_down[below[v], k], voxel_order[v, 0] + _BOTTOM_ORDER + 5 + 2 * k)
+
+    # Sums of forces and torques on each brick
+    half_height = brick_unit_height / 2
+    dx = vi - (brick_x[vb] + (brick_h[vb] - 1) / 2)
+    dy = vj - (brick_y[vb] + (brick_w[vb] - 1) / 2)
+    top_offsets = np.where((n_top_pts == 4)[:, None, None], _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS)
+    bottom_offsets = np.where((n_bottom_pts == 4)[:, None, None], _FOUR_PT_OFFSETS, _THREE_PT_OFFSETS)
+    top_arm_1 = (dy[:, None] + top_offsets[:, :, 0]) * brick_unit_length
+    top_arm_2 = (dx[:, None] + top_offsets[:, :, 1]) * brick_unit_length
+    bottom_arm_1 = (dy[:, None] + bottom_offsets[:, :, 0]) * brick_unit_length
+    bottom_arm_2 = (dx[:, None] + bottom_offsets[:, :, 1]) * brick_unit_length
+
+    sums = {name: _BrickSum(vb) for name in _BRICK_VARS if name.endswith(('_pos', '_neg'))}
+    for d, name in zip(range(4), ('force_sum_x_pos', 'force_sum_x_neg', 'force_sum_y_pos', 'force_sum_y_neg')):
+        sums[name].add(external[:, d], has_external[:, d])
+        sums[name].add(top_press[:, d], has_top)
+        sums[name].add(bottom_press[:, d], has_bottom)
+    sums['force_sum_z_pos'].add(f_up, top_pt_mask)
+    sums['force_sum_z_pos'].add(n_up, bottom_pt_mask)
+    sums['force_sum_z_neg'].add(n_down, top_pt_mask)
+    sums['force_sum_z_neg'].add(f_down, bottom_pt_mask)
+
+    torque_1_pos, torque_1_neg = sums['torque_sum_1_pos'], sums['torque_sum_1_neg']
+    torque_2_pos, torque_2_neg = sums['torque_sum_2_pos'], sums['torque_sum_2_neg']
+    torque_2_neg.add(external[:, _X_POS], has_external[:, _X_POS], half_height)
+    torque_2_pos.add(external[:, _X_NEG], has_external[:, _X_NEG], half_height)
+    torque_1_pos.add(external[:, _Y_POS], has_external[:, _Y_POS], half_height)
+    torque_1_neg.add(external[:, _Y_NEG], has_external[:, _Y_NEG], half_height)
+    torque_1_pos.add(top_press[:, _Y_NEG], has_top, half_height)
+    torque_1_neg.add(top_press[:, _Y_POS], has_top, half_height)
+    torque_2_pos.add(top_press[:, _X_POS], has_top, half_height)
+    torque_2_neg.add(top_press[:, _X_NEG], has_top, half_height)
+    torque_1_pos.add(f_up, top_pt_mask, top_arm_1)
+    torque_1_neg.add(n_down, top_pt_mask, top_arm_1)
+    torque_2_neg.add(f_up, top_pt_mask, top_arm_2)
+    torque_2_pos.add(n_down, top_pt_mask, top_arm_2)
+    torque_1_pos.add(bottom_press[:, _Y_POS], has_bottom, half_height)
+    torque_1_neg.add(bottom_press[:, _Y_NEG], has_bottom, half_height)
+    torque_2_pos.add(bottom_press[:, _X_NEG], has_bottom, half_height)
+    torque_2_neg.add(bottom_press[:, _X_POS], has_bottom, half_height)
+    torque_1_pos.add(n_up, bottom_pt_mask, bottom_arm_1)
+    torque_1_neg.add(f_down, bottom_pt_mask, bottom_arm_1)
+    torque_2_neg.add(n_up, bottom_pt_mask, bottom_arm_2)
+    torque_2_pos.add(f_down, bottom_pt_mask, bottom_arm_2)
+
+    # Torques due to the weight of each voxel
+    voxel_weight = brick_weight[vb] / sizes[vb]
+    torque_1_neg.add_constant(dy * brick_unit_length * voxel_weight)
+    torque_2_pos.add_constant(dx * brick_unit_length * voxel_weight)
+
+    brick_order = (np.cumsum(sizes) - 1) * _ORDER_STRIDE + _BRICK_ORDER  # After the last voxel of each brick
+    for i, name in enumerate(_BRICK_CONSTRS):
+        if name in sums:
+            rows.add_sum(brick_var[name], sums[name], brick_order + i)
         else:
-            w = brick_library[brick_id]["height"]
-            h = brick_library[brick_id]["width"]
-
-        brick_weight = brick_library[brick_id]["mass"] * g_
-        brick_x = brick["x"]
-        brick_y = brick["y"]
-        brick_z = brick["z"]
-        center_x = brick_x + (h - 1) / 2
-        center_y = brick_y + (w - 1) / 2
-
-        sum_x_pos_list = []
-        sum_x_neg_list = []
-        sum_y_pos_list = []
-        sum_y_neg_list = []
-        sum_z_pos_list = []
-        sum_z_neg_list = []
-        torque1_pos_list = []
-        torque1_neg_list = []
-        torque2_pos_list = []
-        torque2_neg_list = []
-        brick_f_down_list = []
-        for i in range(brick_x, brick_x + h):
-            for j in range(brick_y, brick_y + w):
-                force_key = gen_key(i, j, brick_z)
-
-                # Horizontal presses due to adjacent bricks
-                if "external_x_pos" in force_dict[force_key]:
-                    model.addConstr(force_dict[force_key]["external_x_pos"] == force_dict[gen_key(i - 1, j, brick_z)][
-                        "external_x_neg"])
-                    sum_x_pos_list.append(force_dict[force_key]["external_x_pos"])
-                    torque2_neg_list.append(brick_unit_height / 2 * force_dict[force_key]["external_x_pos"])
-                if "external_x_neg" in force_dict[force_key]:
-                    model.addConstr(force_dict[force_key]["external_x_neg"] == force_dict[gen_key(i + 1, j, brick_z)][
-                        "external_x_pos"])
-                    sum_x_neg_list.append(force_dict[force_key]["external_x_neg"])
-                    torque2_pos_list.append(brick_unit_height / 2 * force_dict[force_key]["external_x_neg"])
-                if "external_y_pos" in force_dict[force_key]:
-                    model.addConstr(force_dict[force_key]["external_y_pos"] == force_dict[gen_key(i, j - 1, brick_z)][
-                        "external_y_neg"])
-                    sum_y_pos_list.append(force_dict[force_key]["external_y_pos"])
-                    torque1_pos_list.append(brick_unit_height / 2 * force_dict[force_key]["external_y_pos"])
-                if "external_y_neg" in force_dict[force_key]:
-                    model.addConstr(force_dict[force_key]["external_y_neg"] == force_dict[gen_key(i, j + 1, brick_z)][
-                        "external_y_pos"])
-                    sum_y_neg_list.append(force_dict[force_key]["external_y_neg"])
-                    torque1_neg_list.append(brick_unit_height / 2 * force_dict[force_key]["external_y_neg"])
-
-                # Top knob is connected
-                if "f_up" in force_dict[force_key]:
-                    force_key_top = gen_key(i, j, brick_z + 1)
-
-                    # Horizontal knob presses
-                    sum_x_pos_list.append(force_dict[force_key]["top_x_pos"])
-                    sum_x_neg_list.append(force_dict[force_key]["top_x_neg"])
-                    sum_y_pos_list.append(force_dict[force_key]["top_y_pos"])
-                    sum_y_neg_list.append(force_dict[force_key]["top_y_neg"])
-                    model.addConstr(force_dict[force_key]["top_x_pos"] == force_dict[force_key_top]["bottom_x_neg"])
-                    model.addConstr(force_dict[force_key]["top_x_neg"] == force_dict[force_key_top]["bottom_x_pos"])
-                    model.addConstr(force_dict[force_key]["top_y_pos"] == force_dict[force_key_top]["bottom_y_neg"])
-                    model.addConstr(force_dict[force_key]["top_y_neg"] == force_dict[force_key_top]["bottom_y_pos"])
-
-                    for k in range(len(force_dict[force_key]["f_up"])):
-                        sum_z_pos_list.append(force_dict[force_key]["f_up"][k])
-                        sum_z_neg_list.append(force_dict[force_key]["n_down"][k])
-                        model.addConstr(force_dict[force_key]["n_down"][k] * force_dict[force_key]["f_up"][k] == 0)
-                        model.addConstr(force_dict[force_key]["f_up"][k] == force_dict[force_key_top]["f_down"][k])
-                        model.addConstr(force_dict[force_key]["n_down"][k] == force_dict[force_key_top]["n_up"][k])
-
-                    torque1_pos_list.append(brick_unit_height / 2 * force_dict[force_key]["top_y_neg"])
-                    torque1_neg_list.append(brick_unit_height / 2 * force_dict[force_key]["top_y_pos"])
-                    torque2_pos_list.append(brick_unit_height / 2 * force_dict[force_key]["top_x_pos"])
-                    torque2_neg_list.append(brick_unit_height / 2 * force_dict[force_key]["top_x_neg"])
-                    if force_dict[force_key_top]["four_pt_connection"] == 1:
-                        torque1_pos_list.append(
-                            (j - center_y - 0.25) * brick_unit_length * force_dict[force_key]["f_up"][0])
-                        torque1_neg_list.append(
-                            (j - center_y - 0.25) * brick_unit_length * force_dict[force_key]["n_down"][0])
-                        torque2_neg_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["f_up"][0])
-                        torque2_pos_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["n_down"][0])
-                        torque1_pos_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["f_up"][1])
-                        torque1_neg_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["n_down"][1])
-                        torque2_neg_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["f_up"][1])
-                        torque2_pos_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["n_down"][1])
-                        torque1_pos_list.append(
-                            (j - center_y + 0.25) * brick_unit_length * force_dict[force_key]["f_up"][2])
-                        torque1_neg_list.append(
-                            (j - center_y + 0.25) * brick_unit_length * force_dict[force_key]["n_down"][2])
-                        torque2_neg_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["f_up"][2])
-                        torque2_pos_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["n_down"][2])
-                        torque1_pos_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["f_up"][3])
-                        torque1_neg_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["n_down"][3])
-                        torque2_pos_list.append(
-                            (i - center_x + 0.25) * brick_unit_length * force_dict[force_key]["n_down"][3])
-                        torque2_neg_list.append(
-                            (i - center_x + 0.25) * brick_unit_length * force_dict[force_key]["f_up"][3])
-                    else:
-                        torque1_pos_list.append(
-                            (j - center_y - 0.125) * brick_unit_length * force_dict[force_key]["f_up"][0])
-                        torque1_neg_list.append(
-                            (j - center_y - 0.125) * brick_unit_length * force_dict[force_key]["n_down"][0])
-                        torque2_pos_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["n_down"][0])
-                        torque2_neg_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["f_up"][0])
-                        torque1_pos_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["f_up"][1])
-                        torque1_neg_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["n_down"][1])
-                        torque2_pos_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["n_down"][1])
-                        torque2_neg_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["f_up"][1])
-                        torque1_pos_list.append(
-                            (j - center_y + 0.125) * brick_unit_length * force_dict[force_key]["f_up"][2])
-                        torque1_neg_list.append(
-                            (j - center_y + 0.125) * brick_unit_length * force_dict[force_key]["n_down"][2])
-                        torque2_pos_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["n_down"][2])
-                        torque2_neg_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["f_up"][2])
-
-                        # Bottom cavity is connected
-                if "f_down" in force_dict[force_key]:
-                    if brick_z > 0:
-                        force_key_bottom = gen_key(i, j, brick_z - 1)
-
-                    # Horizontal knob presses
-                    sum_x_pos_list.append(force_dict[force_key]["bottom_x_pos"])
-                    sum_x_neg_list.append(force_dict[force_key]["bottom_x_neg"])
-                    sum_y_pos_list.append(force_dict[force_key]["bottom_y_pos"])
-                    sum_y_neg_list.append(force_dict[force_key]["bottom_y_neg"])
-                    if brick_z > 0:
-                        model.addConstr(
-                            force_dict[force_key]["bottom_x_pos"] == force_dict[force_key_bottom]["top_x_neg"])
-                        model.addConstr(
-                            force_dict[force_key]["bottom_x_neg"] == force_dict[force_key_bottom]["top_x_pos"])
-                        model.addConstr(
-                            force_dict[force_key]["bottom_y_pos"] == force_dict[force_key_bottom]["top_y_neg"])
-                        model.addConstr(
-                            force_dict[force_key]["bottom_y_neg"] == force_dict[force_key_bottom]["top_y_pos"])
-                    for k in range(len(force_dict[force_key]["f_down"])):
-                        sum_z_pos_list.append(force_dict[force_key]["n_up"][k])
-                        sum_z_neg_list.append(force_dict[force_key]["f_down"][k])
-                        sum_f_list.append(force_dict[force_key]["f_down"][k])
-                        brick_f_down_list.append(force_dict[force_key]["f_down"][k])
-                        model.addConstr(force_dict[force_key]["n_up"][k] * force_dict[force_key]["f_down"][k] == 0)
-                        if brick_z > 0:
-                            model.addConstr(
-                                force_dict[force_key]["f_down"][k] == force_dict[force_key_bottom]["f_up"][k])
-                            model.addConstr(
-                                force_dict[force_key]["n_up"][k] == force_dict[force_key_bottom]["n_down"][k])
-
-                    torque1_pos_list.append(brick_unit_height / 2 * force_dict[force_key]["bottom_y_pos"])
-                    torque1_neg_list.append(brick_unit_height / 2 * force_dict[force_key]["bottom_y_neg"])
-                    torque2_pos_list.append(brick_unit_height / 2 * force_dict[force_key]["bottom_x_neg"])
-                    torque2_neg_list.append(brick_unit_height / 2 * force_dict[force_key]["bottom_x_pos"])
-                    if force_dict[force_key]["four_pt_connection"] == 1:
-                        torque1_pos_list.append(
-                            (j - center_y - 0.25) * brick_unit_length * force_dict[force_key]["n_up"][0])
-                        torque1_neg_list.append(
-                            (j - center_y - 0.25) * brick_unit_length * force_dict[force_key]["f_down"][0])
-                        torque2_neg_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["n_up"][0])
-                        torque2_pos_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["f_down"][0])
-                        torque1_pos_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["n_up"][1])
-                        torque1_neg_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["f_down"][1])
-                        torque2_neg_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["n_up"][1])
-                        torque2_pos_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["f_down"][1])
-                        torque1_pos_list.append(
-                            (j - center_y + 0.25) * brick_unit_length * force_dict[force_key]["n_up"][2])
-                        torque1_neg_list.append(
-                            (j - center_y + 0.25) * brick_unit_length * force_dict[force_key]["f_down"][2])
-                        torque2_neg_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["n_up"][2])
-                        torque2_pos_list.append((i - center_x) * brick_unit_length * force_dict[force_key]["f_down"][2])
-                        torque1_pos_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["n_up"][3])
-                        torque1_neg_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["f_down"][3])
-                        torque2_neg_list.append(
-                            (i - center_x + 0.25) * brick_unit_length * force_dict[force_key]["n_up"][3])
-                        torque2_pos_list.append(
-                            (i - center_x + 0.25) * brick_unit_length * force_dict[force_key]["f_down"][3])
-                    else:
-                        torque1_pos_list.append(
-                            (j - center_y - 0.125) * brick_unit_length * force_dict[force_key]["n_up"][0])
-                        torque1_neg_list.append(
-                            (j - center_y - 0.125) * brick_unit_length * force_dict[force_key]["f_down"][0])
-                        torque2_pos_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["f_down"][0])
-                        torque2_neg_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["n_up"][0])
-                        torque1_pos_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["n_up"][1])
-                        torque1_neg_list.append((j - center_y) * brick_unit_length * force_dict[force_key]["f_down"][1])
-                        torque2_pos_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["f_down"][1])
-                        torque2_neg_list.append(
-                            (i - center_x - 0.25) * brick_unit_length * force_dict[force_key]["n_up"][1])
-                        torque1_pos_list.append(
-                            (j - center_y + 0.125) * brick_unit_length * force_dict[force_key]["n_up"][2])
-                        torque1_neg_list.append(
-                            (j - center_y + 0.125) * brick_unit_length * force_dict[force_key]["f_down"][2])
-                        torque2_pos_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["f_down"][2])
-                        torque2_neg_list.append(
-                            (i - center_x + 0.125) * brick_unit_length * force_dict[force_key]["n_up"][2])
-                torque1_neg_list.append((j - center_y) * brick_unit_length * (brick_weight / (h * w)))
-                torque2_pos_list.append((i - center_x) * brick_unit_length * (brick_weight / (h * w)))
-
-        model.addConstr(
-            force_sum_x_pos[int(key) - 1] == gp.quicksum(sum_x_pos_list[k] for k in range(len(sum_x_pos_list))))
-        model.addConstr(
-            force_sum_x_neg[int(key) - 1] == gp.quicksum(sum_x_neg_list[k] for k in range(len(sum_x_neg_list))))
-        model.addConstr(
-            force_sum_y_pos[int(key) - 1] == gp.quicksum(sum_y_pos_list[k] for k in range(len(sum_y_pos_list))))
-        model.addConstr(
-            force_sum_y_neg[int(key) - 1] == gp.quicksum(sum_y_neg_list[k] for k in range(len(sum_y_neg_list))))
-        model.addConstr(
-            force_sum_z_pos[int(key) - 1] == gp.quicksum(sum_z_pos_list[k] for k in range(len(sum_z_pos_list))))
-        model.addConstr(
-            force_sum_z_neg[int(key) - 1] == gp.quicksum(sum_z_neg_list[k] for k in range(len(sum_z_neg_list))))
-        model.addConstr(force_sum_x[int(key) - 1] == force_sum_x_pos[int(key) - 1] - force_sum_x_neg[int(key) - 1])
-        model.addConstr(force_sum_y[int(key) - 1] == force_sum_y_pos[int(key) - 1] - force_sum_y_neg[int(key) - 1])
-        model.addConstr(
-            force_sum_z[int(key) - 1] == force_sum_z_pos[int(key) - 1] - force_sum_z_neg[int(key) - 1] - brick_weight)
-
-        model.addConstr(
-            torque_sum_1_pos[int(key) - 1] == gp.quicksum(torque1_pos_list[k] for k in range(len(torque1_pos_list))))
-        model.addConstr(
-            torque_sum_1_neg[int(key) - 1] == gp.quicksum(torque1_neg_list[k] for k in range(len(torque1_neg_list))))
-        model.addConstr(torque_sum_1[int(key) - 1] == torque_sum_1_pos[int(key) - 1] - torque_sum_1_neg[int(key) - 1])
-
-        model.addConstr(
-            torque_sum_2_pos[int(key) - 1] == gp.quicksum(torque2_pos_list[k] for k in range(len(torque2_pos_list))))
-        model.addConstr(
-            torque_sum_2_neg[int(key) - 1] == gp.quicksum(torque2_neg_list[k] for k in range(len(torque2_neg_list))))
-        model.addConstr(torque_sum_2[int(key) - 1] == torque_sum_2_pos[int(key) - 1] - torque_sum_2_neg[int(key) - 1])
-
-        model.addConstr(force_abs_sum_x[int(key) - 1] == gp.abs_(force_sum_x[int(key) - 1]))
-        model.addConstr(force_abs_sum_y[int(key) - 1] == gp.abs_(force_sum_y[int(key) - 1]))
-        model.addConstr(force_abs_sum_z[int(key) - 1] == gp.abs_(force_sum_z[int(key) - 1]))
-        model.addConstr(torque_abs_sum_1[int(key) - 1] == gp.abs_(torque_sum_1[int(key) - 1]))
-        model.addConstr(torque_abs_sum_2[int(key) - 1] == gp.abs_(torque_sum_2[int(key) - 1]))
-
-        if len(brick_f_down_list) > 0:
-            model.addConstr(
-                brick_max_f_down[int(key) - 1] == gp.max_(brick_f_down_list[k] for k in range(len(brick_f_down_list))))
-
-    eq_obj = model.addVar(vtype=gp.GRB.CONTINUOUS, name="eq_obj")
-    model.addConstr(eq_obj == gp.quicksum(
-        force_abs_sum_x[i] + force_abs_sum_y[i] + force_abs_sum_z[i] + torque_abs_sum_1[i] + torque_abs_sum_2[i]
-        for i in range(len(force_abs_sum_z))))  # Force Equilibrium
-
-    if len(sum_f_list) > 0:
-        sum_f_up = model.addVar(vtype=gp.GRB.CONTINUOUS, name="sum_f_up")
-        sum_brick_max_f_down = model.addVar(vtype=gp.GRB.CONTINUOUS, name="sum_brick_max_f_down")
-        model.addConstr(sum_f_up == gp.quicksum(sum_f_list[i] for i in range(len(sum_f_list))))
-        model.addConstr(sum_brick_max_f_down == gp.quicksum(brick_max_f_down[i] for i in range(len(brick_max_f_down))))
-        model.setObjective(eq_obj + alpha * sum_brick_max_f_down + beta * sum_f_up)
-    else:
-        model.setObjective(eq_obj)
-
-    t_solve_start = time.time()
-    model.modelSense = GRB.MINIMIZE
-    model.update()
-    model.optimize()
-    t_end = time.time()
-    solve_t = t_end - t_solve_start
-    total_t = t_end - t_start
-
-    if model.Status != gp.GRB.Status.OPTIMAL:
-        print('Model did not solve successfully. Check status code:', model.Status)
-        return np.ones(world_dim), model.NumVars, model.NumConstrs, total_t, solve_t
+            rhs = -brick_weight if name == 'force_sum_z' else 0.0
+            rows.add_difference(brick_var[name], brick_var[name + '_pos'], brick_var[name + '_neg'], rhs,
+                                brick_order + i)
+
+    # Objective terms
+    f_down_vars = f_down[bottom_pt_mask]  # Grouped by brick, as the voxels are
+    abs_vars = np.arange(_BRICK_VARS.index('force_abs_sum_x') * n_bricks, (len(_BRICK_VARS) - 1) * n_bricks)
+    objective_order = n_voxels * _ORDER_STRIDE
+    rows.add_total(eq_obj, abs_vars, objective_order)  # Force Equilibrium
+    if has_f_down:
+        max_f_down_vars = np.arange((len(_BRICK_VARS) - 1) * n_bricks, n_brick_vars)
+        rows.add_total(sum_f_up, f_down_vars, objective_order + 1)
+        rows.add_total(sum_brick_max_f_down, max_f_down_vars, objective_order + 2)
+
+    A, rhs = rows.to_matrix(n_vars)
+
+    # Complementarity of the pulling and pushing forces at each connection point, top before bottom in each voxel
+    pt_mask = np.concatenate([top_pt_mask, bottom_pt_mask], axis=1)
+    pulling = np.concatenate([n_down, n_up], axis=1)[pt_mask]
+    pushing = np.concatenate([f_up, f_down], axis=1)[pt_mask]
+
+    # Absolute values of the sums, and the maximum pulling force on each brick
+    sum_names = ('force_sum_x', 'force_sum_y', 'force_sum_z', 'torque_sum_1', 'torque_sum_2')
+    abs_result = np.stack([brick_var[name.replace('_sum', '_abs_sum')] for name in sum_names], axis=1)
+    abs_arg = np.stack([brick_var[name] for name in sum_names], axis=1)
+    n_brick_f_down = np.bincount(vb[np.nonzero(bottom_pt_mask)[0]], minlength=len(brick_idx))
+    brick_f_down = np.split(f_down_vars, np.cumsum(n_brick_f_down)[:-1]) if len(brick_idx) > 0 else []
+
+    objective = np.zeros(n_vars)
+    objective[eq_obj] = 1
+    if has_f_down:
+        objective[sum_brick_max_f_down] = alpha
+        objective[sum_f_up] = beta
+
+    model = StabilityModel(lb, A, rhs, pulling, pushing, abs_result.reshape(-1, 5), abs_arg.reshape(-1, 5),
+                           brick_var['brick_max_f_down'], brick_f_down, objective)
+    time_limit = None if cfg.time_limit is None else max(cfg.time_limit - (time.time() - t_start), 0)
+    solution = solve(model, print_log, time_limit)
+    total_t = time.time() - t_start
+    solve_t = solution.solve_time
+
+    if solution.timed_out and (solution.values is None or cfg.time_limit_fallback == 'connectivity'):
+        scores = _connectivity_scores(brick_structure, brick_library, world_dim)
+        return scores, solution.num_vars, solution.num_constrs, total_t, solve_t, 'connectivity'
+    if solution.values is None:
+        return np.ones(world_dim), solution.num_vars, solution.num_constrs, total_t, solve_t, 'failed'
+    path = 'incumbent' if solution.timed_out else 'optimal'
+
+    values = solution.values
+    f_down_brick = vb[np.nonzero(bottom_pt_mask)[0]]
+    scores = _brick_scores(T_, values[f_down_vars], f_down_brick, values[abs_result], len(brick_idx))
+    analysis_score = np.zeros(world_dim)
+    analysis_score[vi, vj, vk] = scores[vb]
+    if print_log:
+        print("Obj Val:", solution.objective)
+        print("Eq obj Val:", values[eq_obj])
+        print("Num bricks: ", n_bricks)
+        print("Total solve time: ", total_t, " Optimization Solve Time: ", solve_t)
 
-    heatmap_color = np.zeros((world_dim[0], world_dim[1], world_dim[2], 3))
+    num_vars = solution.num_vars
+    num_constr = solution.num_constrs
+    return analysis_score, num_vars, num_constr, total_t, solve_t, path
+
+
+def _brick_scores(T_, f_down_values, f_down_brick, abs_values, n_bricks):
+    """
+    Returns the stability score of each brick from the solution: 1 if it is unstable, i.e. its forces and torques are
+    not in equilibrium or one of its f_down forces reaches T_, and otherwise its largest f_down force as a fraction
+    of T_.
+    :param f_down_values: The values of the f_down forces of the bottom connection points, and f_down_brick the brick
+                          of each.
+    :param abs_values: The absolute values of the force and torque sums of each brick, of shape (n_bricks, 5).
+    """
+    max_f_down = np.full(n_bricks, -np.inf)
+    np.maximum.at(max_f_down, f_down_brick, f_down_values)
+    min_c = np.minimum(T_, T_ - max_f_down)
+    unstable = (min_c <= 0) | (abs_values > 0).any(axis=1)
+    return np.where(unstable, 1.0, 1 - min_c / T_)
+
+
+def _brick_arrays(brick_structure, brick_library, g):
+    """
+    Returns the keys of the bricks that are analysed, and their positions, dimensions, and weights as arrays.
+    """
+    keys, brick_x, brick_y, brick_z, brick_h, brick_w, brick_weight = [], [], [], [], [], [], []
     for key in brick_structure.keys():
         brick = brick_structure[key]
         brick_id = str(brick["brick_id"])
-        if brick_id == "0" or brick_id == "1" or brick_id == "13":
+        if brick_id in _SKIPPED_BRICK_IDS:
             continue
         if brick["ori"] == 0:
             h = brick_library[brick_id]["height"]
@@ -485,40 +375,164 @@ def stability_score(brick_structure, brick_library, cfg=StabilityConfig()):
         else:
             w = brick_library[brick_id]["height"]
             h = brick_library[brick_id]["width"]
-        brick_x = brick["x"]
-        brick_y = brick["y"]
-        brick_z = brick["z"]
-        min_c = T_
-
-        for i in range(brick_x, brick_x + h):
-            for j in range(brick_y, brick_y + w):
-                force_key = gen_key(i, j, brick_z)
-                if "f_down" in force_dict[force_key]:
-                    for k in range(len(force_dict[force_key]["f_down"])):
-                        c = T_ - force_dict[force_key]["f_down"][k].X
-                        min_c = min(c, min_c)
-        for i in range(brick_x, brick_x + h):
-            for j in range(brick_y, brick_y + w):
-                if (force_abs_sum_z[int(key) - 1].X > 0 or
-                        force_abs_sum_x[int(key) - 1].X > 0 or
-                        force_abs_sum_y[int(key) - 1].X > 0 or
-                        torque_abs_sum_1[int(key) - 1].X > 0 or
-                        torque_abs_sum_2[int(key) - 1].X > 0 or
-                        min_c <= 0):
-                    heatmap_color[i, j, brick_z, 0] = 1
-                    heatmap_color[i, j, brick_z, 1] = 1
-                    heatmap_color[i, j, brick_z, 2] = 1
-                else:
-                    heatmap_color[i, j, brick_z, 0] = 1 - min_c / T_
-                    heatmap_color[i, j, brick_z, 1] = 1
-    if print_log:
-        print("Obj Val:", model.objVal)
-        print("Eq obj Val:", eq_obj.X)
-        print("Num bricks: ", n_bricks)
-        print("Total solve time: ", total_t, " Optimization Solve Time: ", solve_t)
-
-    num_vars = model.NumVars
-    num_constr = model.NumConstrs
-    model.close()
-    analysis_score = heatmap_color[:, :, :, 0]
-    return analysis_score, num_vars, num_constr, total_t, solve_t
+        keys.append(key)
+        brick_x.append(brick["x"])
+        brick_y.append(brick["y"])
+        brick_z.append(brick["z"])
+        brick_h.append(h)
+        brick_w.append(w)
+        brick_weight.append(brick_library[brick_id]["mass"] * g)
+    brick_x, brick_y, brick_z, brick_h, brick_w = (
+        np.array(a, dtype=int) for a in (brick_x, brick_y, brick_z, brick_h, brick_w))
+    return keys, brick_x, brick_y, brick_z, brick_h, brick_w, np.array(brick_weight, dtype=float)
+
+
+def _brick_grid(brick_x, brick_y, brick_z, brick_h, brick_w, world_dim):
+    """
+    Returns the index of the brick at each voxel, or -1 if there is none.
+    """
+    sizes = brick_h * brick_w
+    vb = np.repeat(np.arange(len(brick_x)), sizes)
+    local = np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    brick_grid = np.full(world_dim, -1)
+    brick_grid[brick_x[vb] + local // brick_w[vb], brick_y[vb] + local % brick_w[vb], brick_z[vb]] = vb
+    return brick_grid
+
+
+def _connected_components(brick_x, brick_y, brick_z, brick_h, brick_w, world_dim):
+    """
+    Returns the number of connected components of the bricks, where bricks are connected if they touch vertically
+    or horizontally, and the component of each brick.
+    """
+    edges = _touching_bricks(_brick_grid(brick_x, brick_y, brick_z, brick_h, brick_w, world_dim))
+    graph = sp.coo_matrix((np.ones(edges.shape[1]), (edges[0], edges[1])), shape=(len(brick_x), len(brick_x)))
+    return connected_components(graph, directed=False)
+
+
+def _connectivity_scores(brick_structure, brick_library, world_dim):
+    """
+    Returns 1 at the voxels of the bricks which are not connected to the ground through a series of bricks stacked on
+    each other, and 0 elsewhere, as connectivity_score does.
+    """
+    _, brick_x, brick_y, brick_z, brick_h, brick_w, _ = _brick_arrays(brick_structure, brick_library, 1.0)
+    if len(brick_x) == 0:
+        return np.zeros(world_dim)
+    brick_grid = _brick_grid(brick_x, brick_y, brick_z, brick_h, brick_w, world_dim)
+    below, above = brick_grid[:, :, :-1].ravel(), brick_grid[:, :, 1:].ravel()
+    stacked = (below >= 0) & (above >= 0)
+    graph = sp.coo_matrix((np.ones(stacked.sum()), (below[stacked], above[stacked])),
+                          shape=(len(brick_x), len(brick_x)))
+    _, labels = connected_components(graph, directed=False)
+    grounded = np.isin(labels, labels[brick_z == 0])
+    return np.where(brick_grid >= 0, ~grounded[brick_grid], 0).astype(float)
+
+
+def _touching_bricks(brick_grid):
+    """
+    Returns the pairs of indices of bricks which touch vertically or horizontally, as an array of shape (2, n),
+    possibly with duplicates.
+    """
+    edges = []
+    for axis in range(3):
+        a = np.moveaxis(brick_grid, axis, 0)[:-1].ravel()
+        b = np.moveaxis(brick_grid, axis, 0)[1:].ravel()
+        touching = (a >= 0) & (b >= 0) & (a != b)
+        edges.append(np.stack([a[touching], b[touching]]))
+    return np.concatenate(edges, axis=1)
+
+
+@functools.cache
+def _process_pool(n_workers):
+    return ProcessPoolExecutor(n_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def _neighbours(voxel_grid, i, j, k):
+    """
+    Returns the index of the voxel at each of the given positions, or -1 if there is none.
+    """
+    in_bounds = ((i >= 0) & (i < voxel_grid.shape[0]) & (j >= 0) & (j < voxel_grid.shape[1]) &
+                 (k >= 0) & (k < voxel_grid.shape[2]))
+    result = np.full(len(i), -1)
+    result[in_bounds] = voxel_grid[i[in_bounds], j[in_bounds], k[in_bounds]]
+    return result
+
+
+class _BrickSum:
+    """
+    The terms of a sum over the voxels of each brick, as variable indices and coefficients per brick.
+    """
+
+    def __init__(self, voxel_brick):
+        self.voxel_brick = voxel_brick
+        self.bricks, self.vars, self.coefs = [], [], []
+        self.constant = np.zeros(voxel_brick.max() + 1 if len(voxel_brick) else 0)
+
+    def add(self, var, mask, coef=1.0):
+        """
+        Adds the variables var[mask], where var has a row for each voxel.
+        """
+        voxel_brick = np.broadcast_to(self.voxel_brick.reshape((-1,) + (1,) * (var.ndim - 1)), var.shape)
+        self.bricks.append(voxel_brick[mask])
+        self.vars.append(var[mask])
+        self.coefs.append(np.broadcast_to(coef, var.shape)[mask])
+
+    def add_constant(self, constant):
+        self.constant += np.bincount(self.voxel_brick, weights=constant, minlength=len(self.constant))
+
+
+class _SparseRows:
+    """
+    Collects linear equality constraints as the rows of a sparse matrix, each with a key giving its position in the
+    order in which the rows are added to the model.
+    """
+
+    def __init__(self):
+        self.n_rows = 0
+        self.rows, self.cols, self.coefs, self.rhs, self.order = [], [], [], [], []
+
+    def _add(self, cols, coefs, rhs, order):
+        """
+        Adds the rows coefs @ x[cols] == rhs, where cols and coefs have a row for each constraint.
+        """
+        n = len(cols)
+        self.rows.append(np.repeat(np.arange(self.n_rows, self.n_rows + n), cols.shape[1]))
+        self.cols.append(cols.ravel())
+        self.coefs.append(np.broadcast_to(coefs, cols.shape).ravel())
+        self.rhs.append(np.broadcast_to(rhs, n))
+        self.order.append(np.broadcast_to(order, n))
+        self.n_rows += n
+
+    def add_equal(self, a, b, order):
+        a, b = a.reshape(-1, 1), b.reshape(-1, 1)
+        self._add(np.hstack([a, b]), np.array([1.0, -1.0]), 0.0, np.ravel(order))
+
+    def add_difference(self, result, pos, neg, rhs, order):
+        self._add(np.stack([result, pos, neg], axis=1), np.array([1.0, -1.0, 1.0]), rhs, order)
+
+    def add_sum(self, result, brick_sum, order):
+        """
+        Adds result[b] == sum of the terms of brick b + its constant, for each brick b.
+        """
+        bricks = np.concatenate(brick_sum.bricks)
+        self.rows.append(self.n_rows + np.concatenate([np.arange(len(result)), bricks]))
+        self.cols.append(np.concatenate([result, np.concatenate(brick_sum.vars)]))
+        self.coefs.append(np.concatenate([np.ones(len(result)), -np.concatenate(brick_sum.coefs)]))
+        self.rhs.append(brick_sum.constant)
+        self.order.append(order)
+        self.n_rows += len(result)
+
+    def add_total(self, result, terms, order):
+        self._add(np.concatenate([[result], terms]).reshape(1, -1),
+                  np.concatenate([[1.0], -np.ones(len(terms))]), 0.0, order)
+
+    def to_matrix(self, n_cols):
+        """
+        Returns the constraint matrix and right-hand side, with the rows in order.
+        """
+        rank = np.empty(self.n_rows, dtype=int)
+        rank[np.argsort(np.concatenate(self.order), kind='stable')] = np.arange(self.n_rows)
+        A = sp.csr_matrix((np.concatenate(self.coefs), (rank[np.concatenate(self.rows)], np.concatenate(self.cols))),
+                          shape=(self.n_rows, n_cols))
+        rhs = np.empty(self.n_rows)
+        rhs[rank] = np.concatenate(self.rhs)
+        return A, rhs
@@ -77,6 +77,12 @@ class Voxel2Brick:
         return self.voxels.shape[2]
 
     def __call__(self) -> list[Brick]:
+        try:
+            return self._brickify()
+        finally:
+            self.bricks.close()
+
+    def _brickify(self) -> list[Brick]:
         t_start = time.time()
 
         # Initialize structure greedily
@@ -0,0 +1,44 @@
+import pytest
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import LlamaConfig, LlamaForCausalLM, PreTrainedTokenizerFast
+
+from brickgpt.models import LLM
+
+# Vocabulary of the tiny model, in which each string of the brick syntax is 1 token
+_TINY_VOCAB = ['<unk>', '<eos>', 'x', '(', ',', ')'] + [str(i) for i in range(20)]
+
+
+@pytest.fixture(scope='session')
+def tiny_model_path(tmp_path_factory) -> str:
+    """
+    Saves a tiny randomly initialized Llama model with a word-level tokenizer, which can be loaded without the network.
+    """
+    path = tmp_path_factory.mktemp('tiny_llama')
+    tokenizer = Tokenizer(WordLevel({token: idx for idx, token in enumerate(_TINY_VOCAB)}, unk_token='<unk>'))
+    tokenizer.pre_tokenizer = Whitespace()
+    PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token='<unk>', eos_token='<eos>', pad_token='<eos>',
+    ).save_pretrained(path)
+
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=len(_TINY_VOCAB),
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        eos_token_id=_TINY_VOCAB.index('<eos>'),
+        pad_token_id=_TINY_VOCAB.index('<eos>'),
+    )
+    LlamaForCausalLM(config).save_pretrained(path)
+    return str(path)
+
+
+@pytest.fixture
+def tiny_llm(tiny_model_path) -> LLM:
+    return LLM(tiny_model_path, device='cpu')
@@ -0,0 +1,69 @@
+import asyncio
+import threading
+
+from brickgpt.models import BrickGPT
+
+
+class _StubBrickGPT:
+    """
+    Streams numbered events, pausing before each event after the first until it is released.
+    """
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.released = threading.Event()
+        self.n_generated = 0
+        self.closed = False
+
+    def stream(self, caption: str):
+        try:
+            while True:
+                if self.n_generated > 0:
+                    self.started.set()
+                    self.released.wait(5)
+                    self.released.clear()
+                self.n_generated += 1
+                yield self.n_generated
+        except GeneratorExit:
+            self.closed = True
+            raise
+
+    astream = BrickGPT.astream
+
+
+def test_astream():
+    async def consume(stub: _StubBrickGPT) -> list[int]:
+        events = []
+        async for event in stub.astream('caption'):
+            events.append(event)
+            stub.released.set()
+            if len(events) == 3:
+                break
+        return events
+
+    stub = _StubBrickGPT()
+    assert asyncio.run(consume(stub)) == [1, 2, 3]
+
+
+def test_astream_cancelled_mid_event():
+    async def consume(stub: _StubBrickGPT) -> None:
+        async def collect():
+            async for _ in stub.astream('caption'):
+                pass
+
+        task = asyncio.create_task(collect())
+        await asyncio.to_thread(stub.started.wait, 5)  # The worker thread is now generating the second event
+        task.cancel()
+        await asyncio.sleep(0.1)
+        assert not task.done()  # Waits for the worker thread to leave the generator before closing it
+        stub.released.set()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        assert task.cancelled()
+
+    stub = _StubBrickGPT()
+    asyncio.run(consume(stub))
+    assert stub.closed
+    assert stub.n_generated == 2  # Generation stopped after the event in progress
@@ -0,0 +1,116 @@
+import warnings
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from brickgpt.data import BrickStructure
+from brickgpt.models import BrickDecoder, BrickGPT
+from brickgpt.models.batch_generation import BatchedBrickGenerator
+
+# Captions of different lengths, so that the rows are left-padded differently in the shared KV cache
+CAPTIONS = ['6 7 8 2 9', '10 11', '12 13 14 2 15 16 17 18', '19 6 7']
+
+
+def _stub_brickgpt(llm, max_brick_rejections: int = 0, max_regenerations: int = 0) -> SimpleNamespace:
+    """
+    Returns a stand-in for BrickGPT with the tiny model. Each row rejects its first max_brick_rejections bricks,
+    and structures of more than 2 bricks are unstable, and are rolled back to their first 2 bricks.
+    """
+    return SimpleNamespace(
+        llm=llm,
+        decoder=BrickDecoder(llm, 20),
+        world_dim=20,
+        temperature=1.0,
+        max_bricks=4,
+        use_geometry_masking=True,
+        max_brick_rejections=max_brick_rejections,
+        max_regenerations=max_regenerations,
+        max_temperature=2.0,
+        temperature_increase=0.1,
+        _build_prompt=lambda caption: llm.tokenizer(caption, return_tensors='pt')['input_ids'],
+        _to_brick=BrickGPT._to_brick,
+        _try_adding_brick=lambda brick, bricks, rejected_bricks: (
+            'success' if len(rejected_bricks) >= max_brick_rejections else 'stub_rejection'),
+        _is_stable=lambda bricks: len(bricks) <= 2,
+        _remove_all_bricks_after_first_unstable_brick=lambda bricks: BrickStructure(bricks.bricks[:2]),
+    )
+
+
+def _generate(brickgpt: SimpleNamespace, captions: list[str], join_after: int = 0) -> tuple[dict, dict, list[int]]:
+    """
+    Generates a brick structure for each caption in one batch, with the last caption joining after join_after steps.
+    :return: The bricks of each caption, the logits each caption's tokens were sampled from along with the token ids
+             they follow, and the length of the shared KV cache before and after each compaction.
+    """
+    generator = BatchedBrickGenerator(brickgpt)
+    logits_by_caption = {caption: [] for caption in captions}
+    compactions = []
+    sample, compact_if_needed = generator._sample, generator._compact_if_needed
+
+    def record_sample(idx, row, logits):
+        logits_by_caption[row.caption].append((logits, list(row.token_ids)))
+        sample(idx, row, logits)
+
+    def record_compaction():
+        length = generator.attention_mask.shape[1]
+        compact_if_needed()
+        if generator.attention_mask.shape[1] != length:
+            compactions.append((length, generator.attention_mask.shape[1]))
+
+    generator._sample, generator._compact_if_needed = record_sample, record_compaction
+    rows = [generator.add(caption, seed=CAPTIONS.index(caption)) for caption in captions[:-1]]
+    for _ in range(join_after):
+        generator.step()
+    rows.append(generator.add(captions[-1], seed=CAPTIONS.index(captions[-1])))
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # Rows which are still unstable after regenerating
+        generator.run()
+    bricks = {caption: row.result['bricks'].bricks for caption, row in zip(captions, rows)}
+    return bricks, logits_by_caption, compactions
+
+
+def _assert_batch_matches_rows_alone(brickgpt: SimpleNamespace, join_after: int = 0) -> list[tuple[int, int]]:
+    """
+    Checks that each row of a batch samples from the logits of its own token ids, recomputed without a KV cache,
+    and generates the same bricks as when it is generated alone. Returns the compactions of the batch.
+    """
+    bricks, logits_by_caption, compactions = _generate(brickgpt, CAPTIONS, join_after)
+    for caption in CAPTIONS:
+        for logits, token_ids in logits_by_caption[caption]:
+            with torch.no_grad():
+                expected = brickgpt.llm.model(input_ids=torch.tensor([token_ids])).logits[0, -1]
+            torch.testing.assert_close(logits, expected, atol=1e-4, rtol=1e-4)
+        row_bricks, row_logits_by_caption, _ = _generate(brickgpt, [caption])
+        assert row_bricks[caption] == bricks[caption]
+        assert [ids for _, ids in row_logits_by_caption[caption]] == [ids for _, ids in logits_by_caption[caption]]
+    return compactions
+
+
+@pytest.mark.parametrize('join_after', [0, 7])
+def test_batch_matches_rows_alone(tiny_llm, join_after):
+    _assert_batch_matches_rows_alone(_stub_brickgpt(tiny_llm), join_after)
+
+
+def test_batch_with_rejections_matches_rows_alone(tiny_llm):
+    # Rejected bricks are masked out of the attention, until they make up more than half of the KV cache
+    compactions = _assert_batch_matches_rows_alone(_stub_brickgpt(tiny_llm, max_brick_rejections=3), join_after=5)
+    assert compactions
+
+
+def test_batch_with_regenerations_matches_rows_alone(tiny_llm):
+    # Unstable structures are rolled back to their first 2 bricks
+    _assert_batch_matches_rows_alone(_stub_brickgpt(tiny_llm, max_regenerations=1), join_after=5)
+
+
+def test_failed_add_leaves_batch_unchanged(tiny_llm):
+    brickgpt = _stub_brickgpt(tiny_llm)
+    generator = BatchedBrickGenerator(brickgpt)
+    row = generator.add(CAPTIONS[0], seed=0)
+    with pytest.raises(RuntimeError):  # Sampling at temperature 0 fails after the row has joined the batch
+        generator.add(CAPTIONS[1], temperature=0.0)
+    assert generator.rows == [row] and generator.attention_mask.shape[0] == 1
+
+    generator.run()
+    bricks, _, _ = _generate(brickgpt, CAPTIONS[:1])
+    assert row.result['bricks'].bricks == bricks[CAPTIONS[0]]
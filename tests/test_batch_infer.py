@@ -0,0 +1,50 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from brickgpt.batch_infer import read_jobs, read_manifest, repair_manifest
+
+
+def _write_jsonl(path: Path, lines: list[dict]) -> None:
+    path.write_text(''.join(json.dumps(line) + '\n' for line in lines))
+
+
+def test_read_jobs(tmp_path: Path):
+    input_path = tmp_path / 'jobs.jsonl'
+    input_path.write_text('{"caption": "A chair.", "name": "chair", "seed": 1}\n\n{"caption": "A table."}\n')
+    assert read_jobs(str(input_path)) == [
+        {'name': 'chair', 'caption': 'A chair.', 'seed': 1},
+        {'name': '000002', 'caption': 'A table.', 'seed': 42},
+    ]
+
+
+@pytest.mark.parametrize('name', ['../chair', '/tmp/chair', 'a/b', '..', ''])
+def test_read_jobs_rejects_paths(tmp_path: Path, name: str):
+    input_path = tmp_path / 'jobs.jsonl'
+    _write_jsonl(input_path, [{'caption': 'A chair.', 'name': name}])
+    with pytest.raises(ValueError):
+        read_jobs(str(input_path))
+
+
+def test_read_jobs_rejects_duplicate_names(tmp_path: Path):
+    input_path = tmp_path / 'jobs.jsonl'
+    _write_jsonl(input_path, [{'caption': 'A chair.', 'name': 'x'}, {'caption': 'A table.', 'name': 'x'}])
+    with pytest.raises(ValueError):
+        read_jobs(str(input_path))
+
+
+def test_resume_from_manifest(tmp_path: Path):
+    manifest_path = tmp_path / 'manifest.jsonl'
+    assert read_manifest(str(manifest_path)) == {}
+
+    # A crash left the last line partially written
+    manifest_path.write_text('{"name": "a", "n_bricks": 3}\n{"name": "b", "n_bri')
+    assert read_manifest(str(manifest_path)).keys() == {'a'}
+
+    # The partial line is terminated, so that results appended after resuming are read back
+    repair_manifest(str(manifest_path))
+    with open(manifest_path, 'a') as f:
+        f.write(json.dumps({'name': 'b', 'n_bricks': 5}) + '\n')
+    finished = read_manifest(str(manifest_path))
+    assert finished == {'a': {'name': 'a', 'n_bricks': 3}, 'b': {'name': 'b', 'n_bricks': 5}}
@@ -0,0 +1,133 @@
+import pytest
+import torch
+
+from brickgpt.data import Brick, BrickStructure
+from brickgpt.models import BrickDecoder
+from brickgpt.models.brick_codec import GEOMETRY_STEPS
+
+WORLD_DIM = 20
+PROMPT = torch.tensor([[6, 7, 8, 2, 9]])
+
+
+@pytest.fixture
+def decoder(tiny_llm) -> BrickDecoder:
+    return BrickDecoder(tiny_llm, WORLD_DIM)
+
+
+@pytest.fixture
+def bricks() -> BrickStructure:
+    return BrickStructure([Brick(h=2, w=4, x=0, y=0, z=0), Brick(h=1, w=1, x=5, y=5, z=0)], WORLD_DIM)
+
+
+@torch.no_grad()
+def _target_log_probs(
+        decoder: BrickDecoder,
+        input_ids: torch.Tensor,
+        bricks: BrickStructure | None,
+        sample_idxs: list[int],
+        temperature: float = 1.0,
+) -> torch.Tensor:
+    """
+    Returns the constrained log-probabilities of the allowed tokens following the given token ids,
+    recomputed from scratch without a KV cache.
+    """
+    step = len(sample_idxs)
+    logits = decoder.llm.model(input_ids=input_ids).logits[0, -1, decoder.grammar[step]]
+    if bricks is not None and step in GEOMETRY_STEPS:
+        logits = logits.masked_fill(~torch.tensor(decoder.geometry_mask(step, bricks, sample_idxs)), -torch.inf)
+    return torch.log_softmax(logits / temperature, dim=-1)
+
+
+def _greedy_brick_ids(decoder: BrickDecoder, bricks: BrickStructure | None) -> list[int]:
+    """
+    Returns the token ids of the most likely brick following the prompt, decoded from scratch without a KV cache.
+    """
+    result_ids = []
+    sample_idxs = []
+    for allowed_ids in decoder.grammar:
+        input_ids = torch.cat([PROMPT, torch.tensor([result_ids], dtype=torch.long)], dim=1)
+        sample_idx = _target_log_probs(decoder, input_ids, bricks, sample_idxs).argmax().item()
+        result_ids.append(allowed_ids[sample_idx].item())
+        sample_idxs.append(sample_idx)
+        if result_ids[-1] == decoder.codec.eos_token_id:
+            break
+    return result_ids
+
+
+def _assert_cache_consistent(decoder: BrickDecoder, row: int = 0) -> None:
+    """
+    Checks that the next-token logits from the KV cache match those recomputed from scratch.
+    """
+    input_ids = decoder.llm.input_ids_cache[row:row + 1]
+    expected = decoder.llm.model(input_ids=input_ids).logits[:, -1, :]
+    torch.testing.assert_close(decoder.llm.next_token_logits()[row:row + 1], expected)
+
+
+@pytest.mark.parametrize('use_bricks', [False, True])
+def test_generate_brick_candidates(decoder, bricks, use_bricks):
+    bricks = bricks if use_bricks else None
+    torch.manual_seed(0)
+    candidates = decoder.generate_brick_candidates(4, PROMPT, bricks=bricks)
+    assert len(candidates) == 4
+    assert decoder.llm.input_ids_cache.shape[0] == 4
+
+    for row, candidate in enumerate(candidates):
+        row_ids = decoder.llm.input_ids_cache[row, PROMPT.shape[1]:PROMPT.shape[1] + candidate.n_tokens].tolist()
+        assert decoder.codec.decode(row_ids) == candidate.brick
+        if candidate.brick is not None and bricks is not None:
+            h, w, x, y, z = candidate.brick
+            assert bricks.placement_mask(h, w)[x, y, z]
+
+        # The log-likelihood is that of the sampled tokens under the constrained sampling distribution
+        log_likelihood = 0.0
+        for step, token_id in enumerate(row_ids):
+            input_ids = torch.cat([PROMPT, torch.tensor([row_ids[:step]], dtype=torch.long)], dim=1)
+            sample_idxs = [decoder._allowed_idxs[i][row_ids[i]] for i in range(step)]
+            log_probs = _target_log_probs(decoder, input_ids, bricks, sample_idxs)
+            log_likelihood += log_probs[decoder._allowed_idxs[step][token_id]].item()
+        assert candidate.log_likelihood == pytest.approx(log_likelihood, abs=1e-4)
+
+    decoder.llm.select_row(2)
+    assert decoder.llm.input_ids_cache.shape[0] == 1
+    _assert_cache_consistent(decoder)
+
+
+@pytest.mark.parametrize('use_bricks', [False, True])
+def test_generate_brick_candidates_greedy(decoder, bricks, use_bricks):
+    bricks = bricks if use_bricks else None
+    greedy_ids = _greedy_brick_ids(decoder, bricks)
+    candidates = decoder.generate_brick_candidates(3, PROMPT, temperature=1e-6, bricks=bricks)
+    assert all(candidate.brick == decoder.codec.decode(greedy_ids) for candidate in candidates)
+    assert all(candidate.n_tokens == len(greedy_ids) for candidate in candidates)
+
+
+@pytest.mark.parametrize('use_bricks', [False, True])
+@pytest.mark.parametrize('mismatch_step', [None, 0, 2, 4, 8])
+def test_speculative_decoding_greedy(decoder, bricks, use_bricks, mismatch_step):
+    bricks = bricks if use_bricks else None
+    greedy_ids = _greedy_brick_ids(decoder, bricks)
+    draft = list(decoder.codec.decode(greedy_ids))
+    if mismatch_step is not None:  # Draft a different token at this step, which must be rejected
+        field = GEOMETRY_STEPS.index(mismatch_step)
+        draft[field] = draft[field] % 3 + 1
+
+    candidate = decoder.generate_brick_candidates(1, PROMPT, temperature=1e-6, bricks=bricks, draft=tuple(draft))[0]
+    assert candidate.brick == decoder.codec.decode(greedy_ids)
+    assert candidate.n_tokens == len(greedy_ids)
+    assert decoder.llm.input_ids_cache[0, PROMPT.shape[1]:].tolist() == greedy_ids
+    _assert_cache_consistent(decoder)
+
+
+def test_speculative_decoding_distribution(decoder):
+    # Draft the most likely brick, so that rejecting the drafted height would bias the sampled heights noticeably
+    draft = decoder.codec.decode(_greedy_brick_ids(decoder, None))
+    n_samples = 1000
+    torch.manual_seed(0)
+    counts = torch.zeros(len(decoder.grammar[0]))
+    for _ in range(n_samples):
+        candidate = decoder.generate_brick_candidates(1, PROMPT, draft=draft)[0]
+        counts[-1 if candidate.brick is None else candidate.brick[0] - 1] += 1
+
+    # The sampled heights follow the target distribution, as without speculative decoding
+    h_probs = _target_log_probs(decoder, PROMPT, None, []).exp()
+    assert (counts / n_samples - h_probs).abs().sum() / 2 < 0.05
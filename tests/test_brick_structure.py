@@ -1,6 +1,7 @@
+import numpy as np
 import pytest
 
-from brickgpt.data import Brick, BrickStructure
+from brickgpt.data import Brick, BrickStructure, stability_tier_counts
 
 
 def test_brick():
@@ -67,6 +68,22 @@ def test_stability_check(brick_txt: str, is_stable: bool):
     assert bricks.is_stable() == is_stable
 
 
+@pytest.mark.parametrize(
+    'brick_txt,tier,is_stable', [
+        ('2x6 (0,0,0)\n2x6 (2,0,1)\n', 'floating', False),
+        ('2x6 (0,0,0)\n2x6 (1,0,0)\n', 'collision', False),
+        ('2x6 (0,0,0)\n2x6 (2,0,0)\n', 'prescreen', True),
+        ('2x6 (0,0,0)\n2x4 (0,1,1)\n1x1 (0,0,1)\n', 'prescreen', True),
+        ('1x1 (0,0,0)\n1x8 (0,0,1)\n1x8 (0,7,2)\n1x8 (0,7,3)\n1x8 (0,7,4)\n', 'prescreen', False),
+        ('2x4 (0,0,0)\n2x4 (0,3,1)\n', 'solver', True),
+    ])
+def test_stability_check_tiers(brick_txt: str, tier: str, is_stable: bool):
+    bricks = BrickStructure.from_txt(brick_txt)
+    counts_before = stability_tier_counts.copy()
+    assert bricks.check_stability(lambda b: np.zeros((b.world_dim,) * 3)) == is_stable
+    assert stability_tier_counts - counts_before == {tier: 1}
+
+
 @pytest.mark.parametrize(
     'brick_txt,is_connected', [
         ('2x6 (0,0,0)\n2x6 (2,0,0)\n', True),
@@ -87,3 +104,22 @@ def test_in_bounds(brick_txt: str, is_in_bounds: bool):
     bricks = BrickStructure([], world_dim=20)
     brick = Brick.from_txt(brick_txt)
     assert bricks.brick_in_bounds(brick) == is_in_bounds
+
+
+def test_placement_mask():
+    bricks = BrickStructure.from_txt('2x6 (0,0,0)\n2x4 (5,5,0)\n')
+    placement_masks = {(h, w): bricks.placement_mask(h, w).copy() for h, w in [(1, 1), (2, 4), (4, 2), (1, 8)]}
+    bricks.add_brick(Brick.from_txt('1x8 (3,10,1)\n'))
+
+    # Incrementally updated masks should match masks computed from scratch
+    fresh_bricks = BrickStructure(bricks.bricks)
+    for h, w in placement_masks.keys():
+        assert np.array_equal(bricks.placement_mask(h, w), fresh_bricks.placement_mask(h, w))
+        assert not np.array_equal(bricks.placement_mask(h, w), placement_masks[(h, w)])
+
+    # Placement masks should agree with the bounds and collision checks
+    for h, w in placement_masks.keys():
+        placement_mask = bricks.placement_mask(h, w)
+        for x, y, z in np.ndindex(placement_mask.shape):
+            brick = Brick(h=h, w=w, x=x, y=y, z=z)
+            assert placement_mask[x, y, z] == (bricks.brick_in_bounds(brick) and not bricks.brick_collides(brick))
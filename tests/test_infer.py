@@ -1,7 +1,9 @@
 import time
 
 from brickgpt.data import BrickStructure
-from brickgpt.models import LLM, BrickGPT, BrickGPTConfig, create_instruction
+from brickgpt.models import (LLM, BrickCodec, BrickGPT, BrickGPTConfig, BrickPlacedEvent, FinishedEvent,
+                             create_instruction, create_instruction_few_shot, create_instruction_few_shot_examples_first,
+                             create_instruction_zero_shot)
 
 BRICKGPT_PATH = 'AvaLovelace/BrickGPT'
 
@@ -72,3 +74,79 @@ def test_finish_partial_structure():
     print(bricks)
     print('# of bricks:', len(bricks))
     print('Brick rejection reasons:', rejections)
+
+
+def test_stream():
+    """
+    Streams the events of BrickGPT inference, and checks that they are consistent with the final result.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH))
+    events = list(brickgpt.stream('A basic chair with four legs.'))
+    for event in events:
+        print(event)
+
+    assert isinstance(events[-1], FinishedEvent)
+    bricks = events[-1].result['bricks']
+    placed = {event.brick_idx: event.brick for event in events if isinstance(event, BrickPlacedEvent)}
+    assert all(placed[i] == brick for i, brick in enumerate(bricks.bricks))
+
+
+def test_brick_codec():
+    """
+    Tests that encoding a brick structure to token ids matches tokenizing its text, and that decoding inverts encoding.
+    """
+    llm = LLM(BRICKGPT_PATH)
+    codec = BrickCodec(llm.tokenizer, world_dim=20)
+    bricks = BrickStructure.from_txt('2x4 (0,0,0)\n1x8 (12,19,1)\n6x1 (3,10,2)\n')
+
+    token_ids = codec.encode(bricks)
+    assert token_ids == llm.tokenizer(bricks.to_txt(), add_special_tokens=False)['input_ids']
+    decoded = [codec.decode(token_ids[i:i + 10]) for i in range(0, len(token_ids), 10)]
+    assert decoded == [(2, 4, 0, 0, 0), (1, 8, 12, 19, 1), (6, 1, 3, 10, 2)]
+    assert codec.decode([llm.tokenizer.eos_token_id]) is None
+
+
+def test_generate_batch():
+    """
+    Runs batched BrickGPT inference on several prompts at once.
+    """
+    brickgpt = BrickGPT(BrickGPTConfig(BRICKGPT_PATH))
+    captions = ['A basic chair with four legs.', 'A simple table.', 'A tall tower.']
+
+    start_time = time.time()
+    outputs = brickgpt.generate_batch(captions, seeds=[42, 43, 44])
+    end_time = time.time()
+
+    for caption, output in zip(captions, outputs):
+        print(caption)
+        print(output['bricks'])
+        print('# of bricks:', len(output['bricks']))
+        print('Brick rejection reasons:', output['rejection_reasons'])
+        print('# regenerations:', output['n_regenerations'])
+    print(f'Time taken: {end_time - start_time:.2f}s')
+
+
+def test_few_shot_instruction():
+    """
+    Tests that the few-shot instruction starts with the zero-shot instruction, followed by the examples.
+    """
+    caption = 'A basic chair with four legs.'
+    instruction = create_instruction_few_shot(caption)
+    assert instruction.startswith(create_instruction_zero_shot(caption) + '\n\nHere are some example LEGO models:')
+    assert instruction.endswith(f'### Input:\n{caption}\n\n### Output:\n')
+
+
+def test_few_shot_examples_first_instruction():
+    """
+    Tests that the examples-first few-shot instruction has the same examples as the few-shot instruction,
+    and that everything before the caption is the same for every caption.
+    """
+    caption = 'A basic chair with four legs.'
+    instruction = create_instruction_few_shot_examples_first(caption)
+    few_shot_instruction = create_instruction_few_shot(caption)
+    examples_start = few_shot_instruction.index('Here are some example LEGO models:')
+    assert instruction.endswith(few_shot_instruction[examples_start:])
+
+    prefix = instruction[:instruction.index(caption)]
+    assert create_instruction_few_shot_examples_first('A table.').startswith(prefix)
+    assert prefix.endswith('### Input:\n')
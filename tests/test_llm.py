@@ -0,0 +1,111 @@
+import pytest
+import torch
+
+from brickgpt.models import LLM
+
+
+def _ids(*token_ids: int) -> torch.Tensor:
+    return torch.tensor([token_ids])
+
+
+@torch.no_grad()
+def _cold_logits(llm: LLM, input_ids: torch.Tensor) -> torch.Tensor:
+    """
+    Returns the logits for the next token, recomputed from scratch without a KV cache.
+    """
+    return llm.model(input_ids=input_ids).logits[:, -1, :]
+
+
+def test_rollback(tiny_llm):
+    prompt = _ids(6, 7, 8, 2, 9)
+    tiny_llm.set_prompt(prompt)
+    tiny_llm.next_token_logits()
+    tiny_llm.save_state()
+
+    tiny_llm.append_tokens(_ids(10, 11))
+    tiny_llm.next_token_logits()
+    tiny_llm.save_state('brick')
+    tiny_llm.append_tokens(_ids(12, 13, 14))
+    tiny_llm.next_token_logits()
+
+    tiny_llm.rollback_to_saved_state()
+    assert torch.equal(tiny_llm.input_ids_cache, prompt)
+    torch.testing.assert_close(tiny_llm.next_token_logits(), _cold_logits(tiny_llm, prompt))
+
+    # Checkpoints saved after the one rolled back to are discarded, but the one rolled back to is kept
+    with pytest.raises(KeyError):
+        tiny_llm.rollback_to_saved_state('brick')
+    tiny_llm.append_tokens(_ids(15))
+    tiny_llm.next_token_logits()
+    tiny_llm.rollback_to_saved_state()
+    torch.testing.assert_close(tiny_llm.next_token_logits(), _cold_logits(tiny_llm, prompt))
+
+
+@pytest.mark.parametrize('length', [1, 3, 6])
+def test_truncate(tiny_llm, length):
+    input_ids = _ids(6, 7, 8, 2, 9, 10, 11)
+    tiny_llm.set_prompt(input_ids)
+    tiny_llm.next_token_logits()
+
+    tiny_llm.truncate(length)
+    torch.testing.assert_close(tiny_llm.next_token_logits(), _cold_logits(tiny_llm, input_ids[:, :length]))
+
+
+def test_truncate_before_forward_pass(tiny_llm):
+    # Tokens appended after the last forward pass are not yet in the KV cache
+    tiny_llm.set_prompt(_ids(6, 7, 8))
+    tiny_llm.next_token_logits()
+    tiny_llm.append_tokens(_ids(9, 10, 11))
+
+    tiny_llm.truncate(5)
+    torch.testing.assert_close(tiny_llm.next_token_logits(), _cold_logits(tiny_llm, _ids(6, 7, 8, 9, 10)))
+
+
+@pytest.mark.parametrize('new_prompt, expected_cache_length', [
+    (_ids(6, 7, 8, 2, 12, 13), 4),  # Diverges from the previous sequence
+    (_ids(6, 7, 8, 2, 9, 10, 11, 12), 7),  # Extends the previous sequence
+    (_ids(6, 7, 8), 2),  # Is a prefix of the previous sequence
+    (_ids(12, 13), 0),  # Shares no prefix with the previous sequence
+])
+def test_set_prompt_reuses_cache(tiny_llm, new_prompt, expected_cache_length):
+    tiny_llm.set_prompt(_ids(6, 7, 8, 2, 9))
+    tiny_llm.next_token_logits()
+    tiny_llm.append_tokens(_ids(10, 11))
+    tiny_llm.next_token_logits()
+
+    tiny_llm.set_prompt(new_prompt)
+    assert tiny_llm.kv_cache.get_seq_length() == expected_cache_length
+    torch.testing.assert_close(tiny_llm.next_token_logits(), _cold_logits(tiny_llm, new_prompt))
+
+
+def test_set_prompt_reuses_cached_prefix(tiny_llm, tmp_path):
+    prefix = _ids(6, 7, 8, 2)
+    prompt = torch.cat([prefix, _ids(9, 10)], dim=1)
+    tiny_llm.cache_prefix(prefix, tmp_path / 'prefix.pt')
+    tiny_llm.set_prompt(prompt)
+    assert tiny_llm.kv_cache.get_seq_length() == prefix.shape[1]
+    torch.testing.assert_close(tiny_llm.next_token_logits(), _cold_logits(tiny_llm, prompt))
+
+    # The prefix cache loaded from disk gives the same logits, and is not modified by generation
+    llm = LLM(tiny_llm.model.name_or_path, device='cpu')
+    llm.cache_prefix(prefix, tmp_path / 'prefix.pt')
+    for _ in range(2):
+        llm.set_prompt(prompt)
+        torch.testing.assert_close(llm.next_token_logits(), _cold_logits(llm, prompt))
+        llm.set_prompt(_ids(12, 13))
+        llm.next_token_logits()
+    assert llm.prefix_cache[1].get_seq_length() == prefix.shape[1]
+
+
+def test_prefix_cache_file_is_not_shared_across_quantizations(tiny_llm, tmp_path):
+    prefix = _ids(6, 7, 8, 2)
+    tiny_llm.cache_prefix(prefix, tmp_path / 'prefix.pt')
+
+    # The quantized model keeps the dtype of the full-precision model, but must recompute the prefix KV cache
+    quantized_llm = LLM(tiny_llm.model_name, device='cpu', quantization='int8')
+    quantized_llm.cache_prefix(prefix, tmp_path / 'prefix.pt')
+    loaded_keys = quantized_llm.prefix_cache[1].to_legacy_cache()[0][0]
+    quantized_llm.cache_prefix(prefix)
+    torch.testing.assert_close(loaded_keys, quantized_llm.prefix_cache[1].to_legacy_cache()[0][0])
+    assert not torch.allclose(loaded_keys, tiny_llm.prefix_cache[1].to_legacy_cache()[0][0])
+    assert torch.load(tmp_path / 'prefix.pt')['quantization'] == 'int8'
@@ -0,0 +1,122 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from brickgpt.data import BrickStructure
+from brickgpt.serve import Job, Scheduler, parse_job
+
+
+class _StubRow:
+    def __init__(self, n_steps: float):
+        self.n_steps = n_steps
+        self.result = None
+
+
+class _StubGenerator:
+    """
+    Stands in for BatchedBrickGenerator: each row is finished after the number of steps given by its max_bricks,
+    or never if max_bricks is 1000. Adding a row with the caption 'fails' raises an error.
+    """
+
+    def __init__(self, brickgpt):
+        self.rows = []
+        self.max_rows = 0
+
+    def add(self, caption, seed=None, temperature=None, max_bricks=None, world_dim=None):
+        row = _StubRow(float('inf') if max_bricks == 1000 else max_bricks or 1)
+        self.rows.append(row)
+        self.max_rows = max(self.max_rows, len(self.rows))
+        if caption == 'fails':  # Fails after the row has joined the batch
+            raise RuntimeError('Failed to add row')
+        return row
+
+    def step(self):
+        time.sleep(0.001)
+        for row in self.rows:
+            row.n_steps -= 1
+            if row.n_steps <= 0:
+                row.result = {'bricks': BrickStructure([]), 'rejection_reasons': {}, 'n_regenerations': 0}
+        finished_rows = [row for row in self.rows if row.result is not None]
+        self.rows = [row for row in self.rows if row.result is None]
+        return finished_rows
+
+    def remove(self, row):
+        self.rows.remove(row)
+
+
+@pytest.fixture
+def scheduler() -> Scheduler:
+    brickgpt = SimpleNamespace(world_dim=20, n_closed=0)
+    brickgpt.close_stability_model = lambda: setattr(brickgpt, 'n_closed', brickgpt.n_closed + 1)
+    scheduler = Scheduler(brickgpt, max_batch_size=2, make_generator=_StubGenerator)
+    scheduler.start()
+    return scheduler
+
+
+def test_scheduler_batches_jobs(scheduler: Scheduler):
+    jobs = [Job(caption=f'caption {i}', max_bricks=i + 1) for i in range(5)]
+    for job in jobs:
+        scheduler.submit(job)
+    for job in jobs:
+        assert job.done.wait(5)
+        assert job.error is None and len(job.result['bricks']) == 0
+    assert scheduler.generator.max_rows == 2
+    assert scheduler.metrics()['n_completed'] == 5
+
+
+def test_scheduler_frees_stability_model_when_idle(scheduler: Scheduler):
+    job = Job(caption='caption', max_bricks=3)
+    scheduler.submit(job)
+    assert job.done.wait(5)
+    deadline = time.monotonic() + 5
+    while scheduler.brickgpt.n_closed < 2 and time.monotonic() < deadline:  # Before and after the job
+        time.sleep(0.001)
+    assert scheduler.brickgpt.n_closed == 2
+
+
+@pytest.mark.parametrize('options', [{'temperature': 0.0}, {'temperature': float('nan')}, {'max_bricks': 0},
+                                     {'world_dim': 21}, {'world_dim': 0}])
+def test_scheduler_rejects_invalid_jobs(scheduler: Scheduler, options: dict):
+    with pytest.raises(ValueError):
+        scheduler.submit(Job(caption='caption', **options))
+
+
+def test_scheduler_cancels_jobs(scheduler: Scheduler):
+    running_job = Job(caption='never finishes', max_bricks=1000)
+    scheduler.submit(running_job)
+    while not scheduler.running:
+        time.sleep(0.001)
+
+    scheduler.cancel(running_job)
+    assert running_job.done.wait(5) and running_job.error == 'Cancelled'
+    assert not scheduler.generator.rows
+
+    # The freed place in the batch is used by the next job
+    job = Job(caption='caption')
+    scheduler.submit(job)
+    assert job.done.wait(5) and job.error is None
+    assert scheduler.metrics()['n_cancelled'] == 1
+
+
+def test_scheduler_survives_failed_add(scheduler: Scheduler):
+    failed_job = Job(caption='fails', max_bricks=2)
+    scheduler.submit(failed_job)
+    assert failed_job.done.wait(5) and 'Failed to add row' in failed_job.error
+
+    # The row left behind by the failed add finishes without a job, and the scheduler keeps running
+    job = Job(caption='caption', max_bricks=3)
+    scheduler.submit(job)
+    assert job.done.wait(5) and job.error is None
+    assert scheduler.metrics()['n_failed'] == 1
+
+
+def test_parse_job():
+    job = parse_job({'caption': 'A chair.', 'seed': '3', 'temperature': 0.5, 'max_bricks': None})
+    assert (job.caption, job.seed, job.temperature, job.max_bricks, job.world_dim) == ('A chair.', 3, 0.5, None, None)
+    with pytest.raises(KeyError):
+        parse_job({'seed': 3})
+    with pytest.raises(ValueError):
+        parse_job({'caption': 'A chair.', 'max_bricks': 'many'})
+    with pytest.raises(TypeError):
+        parse_job(['A chair.'])
@@ -0,0 +1,71 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from brickgpt.data import Brick, BrickStructure
+from brickgpt.models.stability_monitor import StabilityMonitor
+
+
+class _StubStability:
+    """
+    Records the sizes of the checked structures, and reports structures of at least unstable_n_bricks bricks as
+    unstable. If blocked, checks wait until it is released.
+    """
+
+    def __init__(self, unstable_n_bricks: int = 1000, blocked: bool = False):
+        self.unstable_n_bricks = unstable_n_bricks
+        self.checked: list[int] = []
+        self.released = threading.Event()
+        if not blocked:
+            self.released.set()
+
+    def __call__(self, bricks: BrickStructure) -> bool:
+        self.released.wait(5)
+        self.checked.append(len(bricks))
+        return len(bricks) < self.unstable_n_bricks
+
+
+def _add_bricks(monitor: StabilityMonitor, bricks: BrickStructure, zs: list[int]) -> list[int | None]:
+    results = []
+    for z in zs:
+        bricks.add_brick(Brick(h=1, w=1, x=len(bricks), y=0, z=z))
+        results.append(monitor.update(bricks))
+    return results
+
+
+def test_interval():
+    is_stable = _StubStability(unstable_n_bricks=4)
+    monitor = StabilityMonitor(is_stable, interval=2)
+    assert _add_bricks(monitor, BrickStructure([]), [0] * 4) == [None, None, None, 4]
+    assert is_stable.checked == [2, 4]
+
+
+def test_per_layer():
+    is_stable = _StubStability()
+    monitor = StabilityMonitor(is_stable, per_layer=True)
+    assert _add_bricks(monitor, BrickStructure([]), [0, 0, 1, 1, 1, 2]) == [None] * 6
+    assert monitor.finish() is None
+    assert is_stable.checked == [2, 5]  # The completed layers, without the first brick of the next layer
+
+
+def test_background():
+    is_stable = _StubStability(unstable_n_bricks=4, blocked=True)
+    with ThreadPoolExecutor(1) as executor:
+        monitor = StabilityMonitor(is_stable, interval=2, executor=executor)
+
+        # The check of 4 bricks waits while the check of 2 bricks is running
+        assert _add_bricks(monitor, BrickStructure([]), [0] * 5) == [None] * 5
+        is_stable.released.set()
+
+        # The waiting check is run when generation finishes
+        assert monitor.finish() == 4
+    assert is_stable.checked == [2, 4]
+
+
+def test_background_reports_at_next_update():
+    is_stable = _StubStability(unstable_n_bricks=2)
+    with ThreadPoolExecutor(1) as executor:
+        monitor = StabilityMonitor(is_stable, interval=2, executor=executor)
+        bricks = BrickStructure([])
+        assert _add_bricks(monitor, bricks, [0, 0]) == [None, None]
+        monitor.pending[1].result()
+        assert _add_bricks(monitor, bricks, [0]) == [2]
@@ -0,0 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from pathlib import Path
+
+import gurobipy as gp
+import numpy as np
+import pytest
+
+from brickgpt.data import Brick, BrickStructure, brick_library
+from brickgpt.stability_analysis import (IncrementalStabilityModel, StabilityCache, StabilityConfig, stability_score,
+                                        gurobi_env_pool)
+
+_repo_dir = Path(__file__).parents[1]
+
+_structures = {
+    'small': '1x2 (0,0,0)\n1x2 (0,1,1)\n1x1 (0,2,0)\n',
+    'two_bricks': '2x6 (0,0,0)\n2x6 (2,0,0)\n',
+    'stack': '2x4 (0,0,0)\n2x4 (0,0,1)\n2x4 (0,0,2)\n',
+    'overhang': '2x4 (0,0,0)\n2x4 (0,3,1)\n2x4 (0,6,2)\n',
+    'bridge': '2x2 (0,0,0)\n2x2 (0,0,1)\n2x2 (0,4,0)\n2x2 (0,4,1)\n2x6 (0,0,2)\n',
+    'cantilever': '1x1 (0,0,0)\n1x8 (0,0,1)\n1x8 (0,7,2)\n1x8 (0,7,3)\n1x8 (0,7,4)\n',
+    'table': (_repo_dir / 'table.txt').read_text(),
+    'tetrahedron': (_repo_dir / 'tetrahedron.txt').read_text(),
+}
+
+
+def _gurobi_scores(bricks: BrickStructure, model: IncrementalStabilityModel | None = None) -> np.ndarray:
+    try:
+        return bricks.stability_scores('gurobi', model)
+    except gp.GurobiError as e:
+        if e.errno == gp.GRB.Error.SIZE_LIMIT_EXCEEDED:
+            pytest.skip('The Gurobi license does not allow models of this size.')
+        raise
+
+
+@pytest.mark.parametrize('name', _structures)
+def test_highs_matches_gurobi(name: str):
+    bricks = BrickStructure.from_txt(_structures[name])
+    gurobi_scores = _gurobi_scores(bricks)
+    highs_scores = bricks.stability_scores('highs')
+
+    # The forces may be distributed differently between optimal solutions, but the unstable voxels are the same
+    np.testing.assert_array_equal(highs_scores >= 1, gurobi_scores >= 1)
+    np.testing.assert_allclose(highs_scores, gurobi_scores, atol=0.05)
+
+
+@pytest.mark.parametrize(
+    'brick_txt,is_stable', [
+        (_structures['two_bricks'], True),
+        (_structures['overhang'], True),
+        (_structures['cantilever'], False),
+        (_structures['table'], True),
+    ])
+def test_highs_stability_check(brick_txt: str, is_stable: bool):
+    bricks = BrickStructure.from_txt(brick_txt)
+    assert bricks.is_stable('highs') == is_stable
+
+
+def test_incremental_model_matches_gurobi():
+    model = IncrementalStabilityModel(brick_library, StabilityConfig())
+
+    # Add bricks one at a time, then remove one, then add it back in a different order
+    structures = [BrickStructure.from_txt(txt) for txt in ('1x2 (0,0,0)\n',
+                                                           '1x2 (0,0,0)\n1x2 (0,1,1)\n',
+                                                           '1x2 (0,0,0)\n1x2 (0,1,1)\n1x1 (0,2,0)\n',
+                                                           '1x2 (0,0,0)\n1x1 (0,2,0)\n',
+                                                           '1x2 (0,0,0)\n1x1 (0,2,0)\n1x2 (0,1,1)\n')]
+    for bricks in structures:
+        scores = _gurobi_scores(bricks, model)
+        np.testing.assert_array_equal(scores >= 1, _gurobi_scores(bricks) >= 1)
+        np.testing.assert_allclose(scores, _gurobi_scores(bricks), atol=0.05)
+    model.close()
+
+
+@pytest.mark.parametrize('solver,n_workers', [('gurobi', 1), ('highs', 2)])
+def test_split_components(solver: str, n_workers: int):
+    bricks = BrickStructure.from_txt('1x1 (0,0,0)\n1x1 (0,0,1)\n1x1 (5,5,0)\n1x2 (9,0,0)\n')
+    cfg = StabilityConfig(solver=solver, split_components=True, n_workers=n_workers, parallel_min_bricks=1)
+    try:
+        split_scores, _, _, _, _ = stability_score(bricks.to_json(), brick_library, cfg)
+        scores, _, _, _, _ = stability_score(bricks.to_json(), brick_library, replace(cfg, split_components=False))
+    except gp.GurobiError as e:
+        if e.errno == gp.GRB.Error.SIZE_LIMIT_EXCEEDED:
+            pytest.skip('The Gurobi license does not allow models of this size.')
+        raise
+    np.testing.assert_allclose(split_scores, scores, atol=1e-6)
+
+
+def _random_structure(rng: np.random.Generator, n_bricks: int, base: str = '') -> BrickStructure:
+    """
+    Returns a structure of the base bricks and up to n_bricks random bricks, each dropped onto the bricks below it.
+    """
+    bricks = BrickStructure.from_txt(base)
+    heights = np.zeros((bricks.world_dim, bricks.world_dim), dtype=int)
+    for brick in bricks.bricks:
+        heights[brick.slice_2d] = np.maximum(heights[brick.slice_2d], brick.z + 1)
+    dims = [(1, 1), (1, 2), (2, 1), (1, 4), (4, 1), (2, 2), (1, 8), (8, 1)]
+    for _ in range(n_bricks):
+        h, w = dims[rng.integers(len(dims))]
+        x, y = rng.integers(bricks.world_dim + 1 - h), rng.integers(bricks.world_dim + 1 - w)
+        z = heights[x:x + h, y:y + w].max()
+        if z < bricks.world_dim:
+            bricks.add_brick(Brick(h=h, w=w, x=x, y=y, z=z))
+            heights[x:x + h, y:y + w] = z + 1
+    return bricks
+
+
+def test_split_components_verdict():
+    # Splitting can change the scores of single voxels where the optimal forces are not unique, but not the verdict
+    rng = np.random.default_rng(0)
+    cfg = StabilityConfig(solver='highs', n_workers=2, parallel_min_bricks=1)
+    verdicts = []
+    for i in range(30):
+        bricks = _random_structure(rng, 6, base=_structures['cantilever'] if i % 2 else '').to_json()
+        split_scores, *_ = stability_score(bricks, brick_library, replace(cfg, split_components=True))
+        scores, *_ = stability_score(bricks, brick_library, cfg)
+        assert (split_scores.max() >= 1) == (scores.max() >= 1)
+        verdicts.append(scores.max() >= 1)
+    assert any(verdicts) and not all(verdicts)
+
+
+def test_stability_cache(tmp_path: Path):
+    bricks = BrickStructure.from_txt(_structures['bridge'])
+    permuted_bricks = BrickStructure.from_txt(''.join(reversed(_structures['bridge'].splitlines(keepends=True))))
+    cache = StabilityCache(tmp_path / 'stability_cache.db')
+
+    scores = bricks.stability_scores('highs', cache=cache)
+    np.testing.assert_array_equal(permuted_bricks.stability_scores('highs', cache=cache), scores)
+    assert cache.stats['misses'] == 1 and cache.stats['memory_hits'] == 1
+    cache.close()
+
+    # The scores are found on disk by another cache, but only for the same stability config
+    other_cache = StabilityCache(tmp_path / 'stability_cache.db')
+    np.testing.assert_array_equal(bricks.stability_scores('highs', cache=other_cache), scores)
+    assert other_cache.stats['disk_hits'] == 1
+    assert other_cache.get(StabilityCache.key(bricks.to_json(), StabilityConfig(solver='gurobi'))) is None
+
+    other_cache.close()
+
+
+def test_stability_cache_time_limit(tmp_path: Path):
+    bricks = BrickStructure.from_txt(_structures['bridge'])
+    cache = StabilityCache(tmp_path / 'stability_cache.db')
+
+    # Fallback scores, e.g. after running out of time, are not cached, so the structure is solved again next time
+    bricks.stability_scores('highs', cache=cache, time_limit=0)
+    bricks.stability_scores('highs', cache=cache, time_limit=0)
+    assert cache.stats['misses'] == 2
+
+    # Optimal scores do not depend on the time budget, so they are shared by any time limit
+    scores = bricks.stability_scores('highs', cache=cache, time_limit=60)
+    for time_limit in [None, 0, 30]:
+        np.testing.assert_array_equal(bricks.stability_scores('highs', cache=cache, time_limit=time_limit), scores)
+    assert cache.stats['misses'] == 3 and cache.stats['memory_hits'] == 3
+    cache.close()
+
+
+def test_gurobi_env_pool_threads():
+    bricks = BrickStructure.from_txt(_structures['small'])
+    scores = _gurobi_scores(bricks)
+    gurobi_env_pool.warm_up(4)
+    n_envs = len(gurobi_env_pool.free_envs)
+
+    # Each thread checks out its own environment, and the environments are returned to the pool after each solve
+    with ThreadPoolExecutor(4) as executor:
+        for thread_scores in executor.map(_gurobi_scores, [bricks] * 16):
+            np.testing.assert_array_equal(thread_scores, scores)
+    assert len(gurobi_env_pool.free_envs) == n_envs
+
+
+def test_time_limit_falls_back_to_connectivity():
+    bricks = BrickStructure.from_txt(_structures['cantilever'] + '1x1 (5,5,3)\n')
+    cfg = StabilityConfig(world_dimension=(bricks.world_dim,) * 3, solver='highs')
+    *_, path = stability_score(bricks.to_json(), brick_library, cfg, return_path=True)
+    assert path == 'optimal'
+
+    scores, *_, path = stability_score(bricks.to_json(), brick_library, replace(cfg, time_limit=0), return_path=True)
+    assert path == 'connectivity'
+    np.testing.assert_array_equal(scores, bricks.connectivity_scores())
+
+
+def test_stability_scores_path(tmp_path: Path):
+    bricks = BrickStructure.from_txt(_structures['cantilever'] + '1x1 (5,5,3)\n')
+    cache = StabilityCache(tmp_path / 'stability_cache.db')
+    for kwargs in [{}, {'cache': cache}]:
+        scores, path = bricks.stability_scores('highs', time_limit=0, return_path=True, **kwargs)
+        assert path == 'connectivity'
+        np.testing.assert_array_equal(scores, bricks.connectivity_scores())
+        assert bricks.stability_scores('highs', return_path=True, **kwargs)[1] == 'optimal'
+
+    # Cached scores are from an optimal solve
+    assert bricks.stability_scores('highs', cache=cache, return_path=True)[1] == 'optimal'
+    assert cache.stats['memory_hits'] == 1
+    cache.close()